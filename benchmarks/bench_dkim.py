@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Measure DKIM signing of an email re-sent to many recipients, with and without the memo of
+body hashes.
+
+python benchmarks/bench_dkim.py [--messages 200] [--attachment-kb 512] [--key path/to/key.pem]
+
+Results are printed as JSON, in seconds per message.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from strudelpy import Email, DKIMSigner  # noqa: E402
+
+
+def run(email, signer, messages):
+    email.dkim_signer = signer
+    start = time.perf_counter()
+    for i in range(messages):
+        email.recipients = ['rcpt%d@example.com' % i]
+        email.get_payload_bytes()
+    return (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--attachment-kb', type=int, default=512)
+    parser.add_argument('--key', default=os.path.join(ROOT, 'strudelpy', 'tests', 'dkim.pem'))
+    args = parser.parse_args()
+    with open(args.key) as key_file:
+        key = key_file.read()
+    with tempfile.NamedTemporaryFile(suffix='.bin') as attachment:
+        attachment.write(os.urandom(args.attachment_kb * 1024))
+        attachment.flush()
+        email = Email(sender='me@example.com', recipients=[], subject='Your statement',
+                      text='Dear customer,\n\nyour statement is attached.\n' * 20,
+                      html='<p>Dear customer,</p><p>your statement is attached.</p>' * 20,
+                      attachments=[attachment.name])
+        unsigned = run(email, None, args.messages)
+        # a body hash memo too small for the body: hashed for every message
+        uncached = run(email, DKIMSigner('example.com', 'bench', key, max_cached_bytes=0), args.messages)
+        cached = run(email, DKIMSigner('example.com', 'bench', key), args.messages)
+    results = {
+        'benchmark': 'dkim',
+        'messages': args.messages,
+        'attachment_kb': args.attachment_kb,
+        'unsigned': unsigned,
+        'signed_uncached': uncached,
+        'signed_cached': cached,
+        'signing_overhead_uncached': uncached - unsigned,
+        'signing_overhead_cached': cached - unsigned,
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Measure address header encoding: email.header.Header built one address at a time (as
+Email.format_email_address used to do) against AddressEncoder, for large To headers.
+
+python benchmarks/bench_headers.py [--addresses 10000] [--non-ascii 0.1] [--repeat 3]
+
+Results are printed as JSON, in seconds per header.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email.header import Header  # noqa: E402
+from email.policy import compat32  # noqa: E402
+from email.utils import formataddr  # noqa: E402
+
+from strudelpy import AddressEncoder  # noqa: E402
+
+POLICY = compat32.clone(linesep='\r\n', max_line_length=0)
+
+
+def build_addresses(count, non_ascii):
+    step = int(1 / non_ascii) if non_ascii else 0
+    addresses = []
+    for i in range(count):
+        if step and i % step == 0:
+            addresses.append((u'Zoë Müller %d' % i, 'zoe%d@example.com' % i))
+        elif i % 3 == 0:
+            addresses.append('rcpt%d@example.com' % i)
+        else:
+            addresses.append(('Recipient %d' % i, 'rcpt%d@example.com' % i))
+    return addresses
+
+
+def header_encode(addresses):
+    """
+    The previous Email.format_email_address
+    """
+    header = Header(header_name='to', charset='utf-8')
+    for i, address in enumerate(addresses):
+        if i > 0:
+            header.append(',', 'us-ascii')
+        if isinstance(address, str):
+            try:
+                header.append(address, charset='us-ascii')
+            except UnicodeError:
+                header.append(address, charset='utf-8')
+        else:
+            name, email = address
+            try:
+                name.encode('us-ascii')
+                header.append(formataddr(address), charset='us-ascii')
+            except UnicodeError:
+                header.append(name)
+                header.append('<{0}>'.format(email), charset='us-ascii')
+    return header
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--addresses', type=int, default=10000)
+    parser.add_argument('--non-ascii', type=float, default=0.1, help='share of non ascii display names')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    addresses = build_addresses(args.addresses, args.non_ascii)
+
+    def header():
+        POLICY.fold_binary('To', header_encode(addresses))
+
+    def encoder(encoder):
+        POLICY.fold_binary('To', encoder.encode(addresses, header_name='To'))
+
+    warm = AddressEncoder()
+    encoder(warm)
+    results = {
+        'benchmark': 'headers',
+        'addresses': args.addresses,
+        'non_ascii': args.non_ascii,
+        'header': timed(header, args.repeat),
+        # a fresh memo every time: every address is encoded
+        'encoder_cold': timed(lambda: encoder(AddressEncoder()), args.repeat),
+        # the memo holds all the addresses, as when the same list is used for many messages
+        'encoder_warm': timed(lambda: encoder(warm), args.repeat),
+    }
+    results['speedup_cold'] = results['header'] / results['encoder_cold']
+    results['speedup_warm'] = results['header'] / results['encoder_warm']
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure the cold start cost of importing strudelpy, in fresh interpreters.
+
+python benchmarks/bench_import.py [--runs 20] [--baseline previous.json]
+
+For every statement, reports the median wall time of the import (minus the time of an empty
+interpreter) and which of the expensive modules it loaded. Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = {
+    'email': 'from strudelpy import Email',
+    'smtp': 'from strudelpy import SMTP, Email',
+    'async': 'from strudelpy import AsyncSMTP',
+}
+
+# modules which should only be imported when they are used
+HEAVY_MODULES = ('asyncio', 'concurrent.futures', 'email.mime.base', 'email.utils', 'hashlib',
+                 'mimetypes', 'smtplib', 'ssl', 'uuid')
+
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(repr((elapsed, [name for name in {heavy!r} if name in sys.modules])))
+'''
+
+
+def run(statement):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    output = subprocess.check_output([sys.executable, '-c', PROBE.format(statement=statement, heavy=HEAVY_MODULES)],
+                                     env=env)
+    return eval(output.decode('ascii'))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    args = parser.parse_args()
+    # compile the bytecode once, so every run measures a cold interpreter with warm .pyc files
+    run('import strudelpy')
+    empty = median([run('pass')[0] for _ in range(args.runs)])
+    results = {'benchmark': 'import', 'runs': args.runs, 'statements': {}}
+    for name, statement in sorted(STATEMENTS.items()):
+        timings = []
+        loaded = []
+        for _ in range(args.runs):
+            elapsed, loaded = run(statement)
+            timings.append(elapsed)
+        results['statements'][name] = {
+            'statement': statement,
+            'seconds': max(median(timings) - empty, 0),
+            'loaded': loaded,
+        }
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for name, result in results['statements'].items():
+            previous = baseline['statements'].get(name)
+            if previous and result['seconds']:
+                result['speedup'] = previous['seconds'] / result['seconds']
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
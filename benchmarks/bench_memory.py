@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure the memory held per queued email: Email objects before and after compilation, and
+their CompactEmail form.
+
+python benchmarks/bench_memory.py [--messages 2000]
+
+Results are printed as JSON, in bytes per queued email.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from strudelpy import Email, PartCache, SegmentTable  # noqa: E402
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'strudelpy', 'tests')
+
+SCENARIOS = {
+    'plain': dict(text='Hello,\n\nThis is a queued message.\n' * 10),
+    'multipart': dict(text='Hello,\n\nThis is a queued message.\n' * 10,
+                      html='<p>Hello,</p><p>This is a <strong>queued</strong> message.</p>' * 10,
+                      attachments=[os.path.join(TESTS_DIR, 'doctest.doc')],
+                      embedded=[os.path.join(TESTS_DIR, 'cat.jpg')]),
+}
+
+
+def build(scenario, i):
+    return Email(sender='queue@example.com', recipients=[('Recipient %d' % i, 'rcpt%d@example.com' % i)],
+                 subject='Queued message %d' % i, **SCENARIOS[scenario])
+
+
+def measure(factory, count):
+    """
+    :return: bytes allocated per object kept alive by factory
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [factory(i) for i in range(count)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+    results = {'benchmark': 'memory', 'messages': args.messages, 'scenarios': {}}
+    for scenario in sorted(SCENARIOS):
+        # fresh caches, so their entries are counted once in every measurement
+        Email.part_cache = PartCache()
+
+        def compiled(i):
+            email = build(scenario, i)
+            email.get_payload_bytes()
+            return email
+
+        table = SegmentTable()
+        email = measure(lambda i: build(scenario, i), args.messages)
+        email_compiled = measure(compiled, args.messages)
+        compact = measure(lambda i: build(scenario, i).compact(table), args.messages)
+        results['scenarios'][scenario] = {
+            'email': email,
+            'email_compiled': email_compiled,
+            'compact': compact,
+            'reduction': email_compiled / compact,
+        }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Measure compile time, send throughput, latency and memory across message shapes, against
+an in-process SMTP sink.
+
+python benchmarks/bench_send.py [--messages 200] [--latency 0] [--extensions PIPELINING 8BITMIME]
+                                [--tempfail-rate 0] [--scenario plain ...]
+                                [--output results.json] [--baseline baseline.json]
+
+Every scenario runs in its own process so the peak RSS figures don't bleed into each other.
+Results are printed as JSON. With --baseline, the messages per second of every scenario are
+compared with a previously saved run.
+"""
+import argparse
+import json
+import os
+import shutil
+import smtplib
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from strudelpy import Email, SMTP  # noqa: E402
+from strudelpy.tests.sink import SMTPSink  # noqa: E402
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'strudelpy', 'tests')
+
+SENDER = 'bench@example.com'
+TEXT = 'Hello,\n\nThis is a benchmark message.\n' * 20
+HTML = '<p>Hello,</p><p>This is a <strong>benchmark</strong> message.</p>' * 20
+
+SCENARIOS = ('plain', 'multipart', 'many_recipients', 'large_attachment', 'many_embedded')
+
+
+def get_peak_rss():
+    """
+    :return: peak resident set size of this process in bytes, or None where unavailable
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def get_email_factory(scenario, workdir, attachment_size):
+    """
+    :return: function building the i-th Email of a scenario
+    """
+    recipients = ['rcpt@example.com']
+    kwargs = dict(sender=SENDER, text=TEXT)
+    if scenario == 'multipart':
+        kwargs['html'] = HTML
+        kwargs['attachments'] = [os.path.join(TESTS_DIR, 'doctest.doc')]
+    elif scenario == 'many_recipients':
+        recipients = [('Recipient %d' % i, 'rcpt%d@example.com' % i) for i in range(250)]
+    elif scenario == 'large_attachment':
+        path = os.path.join(workdir, 'large.bin')
+        with open(path, 'wb') as large:
+            for _ in range(attachment_size // (1024 * 1024)):
+                large.write(os.urandom(1024 * 1024))
+        kwargs['attachments'] = [path]
+    elif scenario == 'many_embedded':
+        images = []
+        for i in range(20):
+            images.append(os.path.join(workdir, 'image%d.jpg' % i))
+            shutil.copy(os.path.join(TESTS_DIR, 'cat.jpg'), images[-1])
+        kwargs['html'] = ''.join('<img src="cid:image%d">' % i for i in range(20))
+        kwargs['embedded'] = images
+
+    def factory(i):
+        return Email(recipients=recipients, subject='Benchmark %s %d' % (scenario, i), **kwargs)
+    return factory
+
+
+def run_scenario(scenario, args):
+    workdir = tempfile.mkdtemp()
+    try:
+        factory = get_email_factory(scenario, workdir, args.attachment_size)
+        messages = args.messages if scenario != 'large_attachment' else max(1, args.messages // 20)
+
+        compile_times = []
+        for i in range(messages):
+            email = factory(i)
+            start = time.time()
+            email.compile_message()
+            compile_times.append(time.time() - start)
+
+        tempfail_rate = args.tempfail_rate
+        replies = {}
+        if tempfail_rate:
+            replies['RCPT'] = lambda argument: (451, '4.3.0 Try again later') \
+                if sink.random.random() < tempfail_rate else None
+        latencies = []
+        errors = 0
+        with SMTPSink(latency=args.latency, extensions=args.extensions, replies=replies, seed=0) as sink:
+            start = time.time()
+            with SMTP(sink.host, sink.port) as smtp:
+                for i in range(messages):
+                    email = factory(i)
+                    sent = time.time()
+                    try:
+                        smtp.send(email)
+                    except smtplib.SMTPRecipientsRefused:
+                        errors += 1
+                    latencies.append(time.time() - sent)
+            elapsed = time.time() - start
+            received = sink.stats['messages']
+        return {
+            'messages': messages,
+            'received': received,
+            'errors': errors,
+            'seconds': elapsed,
+            'messages_per_second': messages / elapsed,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'compile_mean': sum(compile_times) / len(compile_times),
+            'compile_p99': percentile(compile_times, 0.99),
+            'peak_rss': get_peak_rss(),
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+
+def compare(results, baseline):
+    """
+    :return: {scenario: current / baseline messages per second}
+    """
+    ratios = {}
+    for scenario, result in results.items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if previous and previous.get('messages_per_second'):
+            ratios[scenario] = result['messages_per_second'] / previous['messages_per_second']
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0, help='sink reply latency in seconds')
+    parser.add_argument('--extensions', nargs='*', default=['PIPELINING', '8BITMIME'],
+                        help='ESMTP extensions advertised by the sink')
+    parser.add_argument('--tempfail-rate', type=float, default=0,
+                        help='fraction of recipients refused with 451')
+    parser.add_argument('--attachment-size', type=int, default=10 * 1024 * 1024,
+                        help='size of the large_attachment file in bytes')
+    parser.add_argument('--scenario', nargs='*', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--baseline', help='results file to compare messages per second with')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the scenarios in this process (peak RSS is then cumulative)')
+    args = parser.parse_args()
+
+    if args.in_process or len(args.scenario) == 1:
+        scenarios = dict((scenario, run_scenario(scenario, args)) for scenario in args.scenario)
+    else:
+        scenarios = {}
+        for scenario in args.scenario:
+            command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario,
+                       '--messages', str(args.messages), '--latency', str(args.latency),
+                       '--tempfail-rate', str(args.tempfail_rate),
+                       '--attachment-size', str(args.attachment_size), '--extensions'] + args.extensions
+            output = subprocess.check_output(command)
+            scenarios.update(json.loads(output.decode('utf-8'))['scenarios'])
+
+    results = {
+        'benchmark': 'send',
+        'python': sys.version.split()[0],
+        'latency': args.latency,
+        'extensions': args.extensions,
+        'tempfail_rate': args.tempfail_rate,
+        'scenarios': scenarios,
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            results['baseline_ratio'] = compare(scenarios, json.load(baseline))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
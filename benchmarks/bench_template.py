@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Compare rendering a precompiled EmailTemplate with compiling a new Email for every recipient.
+
+python benchmarks/bench_template.py [--messages 2000]
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from strudelpy import Email, EmailTemplate  # noqa: E402
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'strudelpy', 'tests')
+
+SENDER = 'campaigns@example.com'
+SUBJECT = 'Your monthly statement, $name'
+TEXT = 'Dear $name,\n\nYour statement for this month is attached.\n'
+HTML = '<p>Dear <strong>$name</strong>,</p><p>Your statement is attached.</p><img src="cid:cat">'
+ATTACHMENTS = [os.path.join(TESTS_DIR, 'doctest.doc')]
+EMBEDDED = [os.path.join(TESTS_DIR, 'cat.jpg')]
+
+
+def get_recipients(count):
+    return [('Customer %d' % i, 'customer%d@example.com' % i) for i in range(count)]
+
+
+def bench_email(recipients):
+    start = time.time()
+    for name, address in recipients:
+        Email(sender=SENDER, recipients=[(name, address)], subject=SUBJECT.replace('$name', name),
+              text=TEXT.replace('$name', name), html=HTML.replace('$name', name),
+              attachments=ATTACHMENTS, embedded=EMBEDDED).get_payload()
+    return time.time() - start
+
+
+def bench_template(recipients):
+    start = time.time()
+    template = EmailTemplate(sender=SENDER, subject=SUBJECT, text=TEXT, html=HTML,
+                             attachments=ATTACHMENTS, embedded=EMBEDDED)
+    compiled = time.time()
+    for name, address in recipients:
+        template.render([(name, address)], name=name).get_payload()
+    return compiled - start, time.time() - compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+    recipients = get_recipients(args.messages)
+    email_time = bench_email(recipients)
+    compile_time, render_time = bench_template(recipients)
+    print(json.dumps({
+        'benchmark': 'template',
+        'messages': args.messages,
+        'email': {
+            'seconds': email_time,
+            'messages_per_second': args.messages / email_time,
+        },
+        'template': {
+            'compile_seconds': compile_time,
+            'seconds': render_time,
+            'messages_per_second': args.messages / render_time,
+        },
+        'speedup': email_time / render_time,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ setup(
     download_url='https://github.com/harel/strudelpy/archive/0.3.tar.gz',
     keywords=['email', 'smtp'],  # arbitrary keywords
     install_requires=['six'],
+    extras_require={'dkim': ['cryptography']},
     license='MIT',
     packages=['strudelpy', 'strudelpy.tests'],
     classifiers=[
@@ -12,38 +12,98 @@ smtp.send(email)
 
 """
 
+import io
 import os
+import re
+import sys
 import six
 import base64
-import uuid
-import ssl
-import smtplib
-import mimetypes
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
 from email.header import Header
-from email.utils import formatdate, formataddr, make_msgid
 from email.encoders import encode_base64
 from email.charset import Charset
+from strudelpy.cache import PartCache, default_part_cache
+from strudelpy.capabilities import AUTH_FALLBACK, AUTH_NONE, CapabilityCache, default_capability_cache
+from strudelpy.compact import CompactEmail, SegmentTable, default_segment_table
+from strudelpy.headers import AddressEncoder, EncodedHeader, default_address_encoder
+from strudelpy.metrics import Hooks, MetricsCollector, default_hooks
+from strudelpy.mime import guess_type
+from strudelpy.ratelimit import RateLimiter, TokenBucket
+from strudelpy.tls import TLSSessionCache, create_tls_context, default_tls_session_cache
+from strudelpy.streaming import PayloadStream, CRLF, STREAM_CHUNK_SIZE, BDAT_CHUNK_SIZE, quote_data, iter_quoted_data
+from strudelpy.streaming import iter_bdat_chunks, iter_file_chunks, is_7bit, is_7bit_file, has_long_lines
+from strudelpy.streaming import get_encoded_size, get_wire_size
+from strudelpy.generator import BOUNDARY_LENGTH
 
 __author__ = 'Harel Malka'
 __version__ = '0.4.1'
 
-# initialise the mimetypes module
-mimetypes.init()
+# smtplib, ssl, email.mime, asyncio and concurrent.futures are only imported when first used,
+# so importing strudelpy stays cheap for short lived processes. The names below are loaded
+# from their module on first access (PEP 562; imported straight away before Python 3.7)
+LAZY_ATTRIBUTES = {
+    'SMTPPool': 'strudelpy.pool',
+    'SMTPCluster': 'strudelpy.cluster',
+    'Coalescer': 'strudelpy.coalesce',
+    'Spool': 'strudelpy.spool',
+    'AsyncSMTP': 'strudelpy.aio',
+    'EmailTemplate': 'strudelpy.template',
+    'RenderedEmail': 'strudelpy.template',
+    'Dispatcher': 'strudelpy.dispatcher',
+    'MessageTooLarge': 'strudelpy.preflight',
+    'DKIMSigner': 'strudelpy.dkim',
+    'FileTransport': 'strudelpy.filetransport',
+}
+PY3_ONLY = ('AsyncSMTP', 'EmailTemplate', 'RenderedEmail', 'Dispatcher')
 
-try:
-    PROTOCOL_TLS = getattr(ssl, os.environ.get('EMAIL_TLS_VERSION', 'PROTOCOL_TLS'))
-except AttributeError:
-    PROTOCOL_TLS = getattr(ssl, 'PROTOCOL_TLS')
+
+def get_protocol_tls():
+    import ssl
+    try:
+        return getattr(ssl, os.environ.get('EMAIL_TLS_VERSION', 'PROTOCOL_TLS'))
+    except AttributeError:
+        return getattr(ssl, 'PROTOCOL_TLS')
+
+
+def __getattr__(name):
+    if name == 'PROTOCOL_TLS':
+        value = get_protocol_tls()
+    elif name in LAZY_ATTRIBUTES and not (six.PY2 and name in PY3_ONLY):
+        import importlib
+        value = getattr(importlib.import_module(LAZY_ATTRIBUTES[name]), name)
+    else:
+        raise AttributeError("module 'strudelpy' has no attribute '{0}'".format(name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES) | {'PROTOCOL_TLS'})
+
+# the usual per transaction RCPT limit enforced by SMTP servers (RFC 5321 4.5.3.1.8)
+MAX_RECIPIENTS = 100
+
+# the auth mechanisms smtplib implements, in its order of preference
+AUTH_MECHANISMS = ('CRAM-MD5', 'PLAIN', 'LOGIN')
 
 
 class InvalidConfiguration(Exception):
     pass
 
 
+def get_refused_recipients(results):
+    """
+    Reduce per recipient results to the dict of refused recipients returned by sendmail
+    :param results: {recipient: (code, response)} dict
+    :return: dict of refused recipients. Raises SMTPRecipientsRefused if all were refused
+    """
+    refused = dict((recipient, reply) for recipient, reply in results.items()
+                   if reply[0] not in (250, 251))
+    if len(refused) == len(results):
+        import smtplib
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+
 class SMTP(object):
     """
     A wrapper around SMTP accounts.
@@ -56,10 +116,27 @@ class SMTP(object):
         Email(...).send()
 
     """
+    # callbacks timing the connect, starttls, login and send stages (see strudelpy.metrics)
+    hooks = default_hooks
+    # process wide cache of TLS sessions, resumed when reconnecting. Set to None to disable
+    tls_sessions = default_tls_session_cache
+    # optional RateLimiter pacing the connections and sends (see strudelpy.ratelimit)
+    rate_limiter = None
+    # process wide cache of server extensions and working auth methods. Set to None to disable
+    capabilities = default_capability_cache
+
     def __init__(
         self, host, port, username=None, password=None, ssl=False, tls=False,
-        timeout=None, debug_level=None, tls_version=None, tls_context_handler=None
+        timeout=None, debug_level=None, tls_version=None, tls_context_handler=None,
+        max_recipients=MAX_RECIPIENTS, bdat_chunk_size=BDAT_CHUNK_SIZE, oversized_handler=None
     ):
+        """
+        :param bdat_chunk_size: size of the BDAT chunks messages are sent in when the server
+                                supports CHUNKING. 0 or None to always use DATA
+        :param oversized_handler: function receiving the MessageTooLarge error of a message
+                                  over the server's SIZE limit, which is then reported as
+                                  refused rather than raised. None to raise it
+        """
         self.host = host
         self.port = port
         self.username = username
@@ -70,6 +147,11 @@ class SMTP(object):
         self.tls_context_handler = tls_context_handler
         self.timeout = timeout
         self.debug_level = debug_level
+        self.max_recipients = max_recipients
+        self.bdat_chunk_size = bdat_chunk_size
+        self.oversized_handler = oversized_handler
+        # built on the first SSL or STARTTLS connection, and shared with clones
+        self.tls_context = None
         self.client = None
 
     def __enter__(self):
@@ -79,59 +161,501 @@ class SMTP(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+    def clone(self):
+        """
+        Return a new, unconnected SMTP object with the same configuration as this one
+        """
+        smtp = SMTP(
+            self.host, self.port, username=self.username, password=self.password, ssl=self.ssl,
+            tls=self.tls, timeout=self.timeout, debug_level=self.debug_level,
+            tls_version=self.tls_version, tls_context_handler=self.tls_context_handler,
+            max_recipients=self.max_recipients, bdat_chunk_size=self.bdat_chunk_size,
+            oversized_handler=self.oversized_handler
+        )
+        smtp.hooks = self.hooks
+        smtp.tls_sessions = self.tls_sessions
+        smtp.rate_limiter = self.rate_limiter
+        smtp.capabilities = self.capabilities
+        if self.ssl or self.tls:
+            # TLS sessions can only be resumed with the context which created them
+            smtp.tls_context = self.get_tls_context()
+        return smtp
+
+    def get_tls_context(self):
+        """
+        Return the SSLContext for SSL and STARTTLS connections, built once per configuration
+        """
+        if self.tls_context is None:
+            if self.tls:
+                self.tls_context = create_tls_context(self.tls_version, self.tls_context_handler)
+            else:
+                # the context smtplib.SMTP_SSL creates when it isn't given one
+                import ssl
+                self.tls_context = ssl._create_stdlib_context()
+        return self.tls_context
+
     def _get_client(self):
         """
         Returns the relevant SMTP client (SMTP or SMTP_SSL)
         """
+        import smtplib
         connection_args = {
             'host': self.host,
             'port': self.port,
         }
         if self.timeout:
             connection_args['timeout'] = self.timeout
-        if self.ssl:
-            client = smtplib.SMTP_SSL(**connection_args)
-        else:
-            client = smtplib.SMTP(**connection_args)
-        if self.tls:
-            if self.tls_version:
-                context = ssl.SSLContext(self.tls_version)
-                if self.tls_context_handler:
-                    self.tls_context_handler(context)
+        context = None
+        if self.ssl or self.tls:
+            context = self.get_tls_context()
+            if self.tls_sessions is not None:
+                context = self.tls_sessions.wrap(context, (self.host, self.port))
+        with self.hooks.timed('connect', host=self.host, port=self.port):
+            if self.ssl:
+                client = smtplib.SMTP_SSL(context=context, **connection_args)
             else:
-                context = ssl.create_default_context()
-            client.starttls(context=context)
-            client.ehlo_or_helo_if_needed()
+                client = smtplib.SMTP(**connection_args)
+            self.greet(client)
+        if self.tls:
+            with self.hooks.timed('starttls', host=self.host, port=self.port):
+                client.starttls(context=context)
+                self.greet(client)
+        if context is not self.tls_context:
+            # the server has replied over TLS by now, so TLS 1.3 session tickets have arrived
+            context.store(client.sock)
         if self.debug_level:
             client.set_debuglevel(self.debug_level)
         return client
 
+    def get_capability_key(self):
+        """
+        :return: the key of this server in the capability cache
+        """
+        return CapabilityCache.get_key(self.host, self.port, 'ssl' if self.ssl else 'starttls' if self.tls else 'plain')
+
+    def greet(self, client):
+        """
+        Send EHLO, or HELO if the server doesn't speak ESMTP. Servers known not to are sent HELO
+        straight away, without the EHLO they would refuse.
+        """
+        cache = self.capabilities
+        if cache is None:
+            client.ehlo_or_helo_if_needed()
+            return
+        key = self.get_capability_key()
+        entry = cache.get(key)
+        if entry is not None and entry['esmtp'] is False and client.helo_resp is None and client.ehlo_resp is None:
+            cache.count('helo_skipped')
+            client.helo()
+        else:
+            client.ehlo_or_helo_if_needed()
+        cache.record_ehlo(key, client)
+
     def login(self):
         """
         Connect to the server using the login (with credentials) or connect (without).
-        If login() fails, attempt to perform a fallback method using base64 encoded password and
-        raw SMTP commands
+        The auth mechanism which worked with the server before is used straight away, and
+        forgotten if it fails. If login() fails, attempt to perform a fallback method using
+        base64 encoded password and raw SMTP commands
         """
+        import smtplib
+        if self.rate_limiter is not None:
+            self.rate_limiter.connect()
         self.client = self._get_client()
-        if self.username and self.password:
+        if not (self.username and self.password):
+            return
+        cache = self.capabilities
+        key = self.get_capability_key()
+        entry = cache.get(key) if cache is not None else None
+        auth = entry['auth'] if entry is not None else None
+        with self.hooks.timed('login', host=self.host, port=self.port):
+            if auth not in (None, AUTH_NONE):
+                cache.count('auth_skipped')
+                try:
+                    if auth == AUTH_FALLBACK:
+                        self.fallback_login()
+                    else:
+                        self.authenticate([auth])
+                    return
+                except smtplib.SMTPException:
+                    # the server changed: negotiate again
+                    cache.update(key, auth=None)
+                    if self.client.sock is None:
+                        self.client = self._get_client()
             try:
-                self.client.login(six.u(self.username), six.u(self.password))
-            except (smtplib.SMTPException, smtplib.SMTPAuthenticationError):
+                auth = self.authenticate()
+            except smtplib.SMTPException:
                 # if login fails, try again using a manual plain login method
-                self.client.connect(host=self.host, port=self.port)
-                self.client.docmd("AUTH LOGIN", base64.b64encode(six.b(self.username)))
-                self.client.docmd(base64.b64encode(six.b(self.password)), six.b(""))
-        else:
-            self.client.connect()
+                auth = self.fallback_login()
+            # a server which takes no authentication is asked again by every session, in case
+            # its policy changes
+            if cache is not None and auth not in (None, AUTH_NONE):
+                cache.update(key, auth=auth)
+
+    def authenticate(self, mechanisms=None):
+        """
+        Authenticate with the first of the mechanisms the server accepts, as smtplib's login()
+        does, but reporting which one worked
+        :param mechanisms: the mechanisms to try, by default those smtplib supports and the
+                           server advertises
+        :return: the mechanism which worked
+        """
+        import smtplib
+        client = self.client
+        username, password = six.u(self.username), six.u(self.password)
+        if not hasattr(client, 'auth'):
+            # Python 2: smtplib picks the mechanism itself
+            client.login(username, password)
+            return None
+        if mechanisms is None:
+            if not client.has_extn('auth'):
+                raise smtplib.SMTPNotSupportedError('SMTP AUTH extension not supported by server.')
+            advertised = client.esmtp_features['auth'].upper().split()
+            mechanisms = [mechanism for mechanism in AUTH_MECHANISMS if mechanism in advertised]
+            if not mechanisms:
+                raise smtplib.SMTPException('No suitable authentication method found.')
+        client.user, client.password = username, password
+        error = None
+        for mechanism in mechanisms:
+            try:
+                client.auth(mechanism, getattr(client, 'auth_' + mechanism.lower().replace('-', '_')))
+                return mechanism
+            except smtplib.SMTPAuthenticationError as e:
+                error = e
+        raise error
+
+    def fallback_login(self):
+        """
+        Authenticate with raw AUTH LOGIN commands, for servers which don't advertise AUTH
+        or reject smtplib's attempts. The connection is only reopened if it was dropped.
+        :return: AUTH_FALLBACK if the server accepted the login, AUTH_NONE if it does not
+                 take authentication at all
+        :raises SMTPAuthenticationError: if the server refused the login
+        """
+        import smtplib
+        if self.capabilities is not None:
+            self.capabilities.count('fallbacks')
+        if self.client.sock is None:
+            self.client = self._get_client()
+        client = self.client
+        code, response = client.docmd('AUTH LOGIN', base64.b64encode(six.b(self.username)).decode('ascii'))
+        if code == 334:
+            code, response = client.docmd(base64.b64encode(six.b(self.password)).decode('ascii'))
+        if code in (235, 503):
+            return AUTH_FALLBACK
+        if code in (500, 502) and not client.has_extn('auth'):
+            return AUTH_NONE
+        raise smtplib.SMTPAuthenticationError(code, response)
 
     def close(self):
         self.client.quit()
 
     def send(self, email):
         """
-        Send an Email
+        Send an Email.
+        Emails with more recipients than max_recipients are split into several transactions.
+        Emails over the server's SIZE limit are not serialised: see check_size()
+        :return: dict of refused recipients, as returned by smtplib's sendmail
+        """
+        recipients = email.get_envelope_recipients()
+        refused = self.preflight(email, recipients)
+        if refused is not None:
+            return refused
+        payload, mail_options = self.get_payload(email)
+        return self.send_compiled(email.sender, recipients, payload, mail_options)
+
+    def send_compiled(self, sender, recipients, payload, mail_options=()):
+        """
+        Send an already serialised payload, with the same semantics as send()
+        :param sender: envelope sender address
+        :param recipients: list of envelope recipient addresses
+        :param payload: the message as string or bytes
+        :param mail_options: extra ESMTP options for the MAIL command
+        :return: dict of refused recipients, as returned by smtplib's sendmail
         """
-        return self.client.sendmail(email.sender, email.recipients, email.get_payload())
+        refused = self.check_size(None, recipients, len(payload))
+        if refused is not None:
+            return refused
+        with self.hooks.timed('send', host=self.host, port=self.port, recipients=len(recipients),
+                              bytes=len(payload)):
+            self.client.ehlo_or_helo_if_needed()
+            if not self.uses_bdat() and (not self.max_recipients or len(recipients) <= self.max_recipients):
+                return self.rate_limited(recipients, self._sendmail, sender, recipients, payload, mail_options)
+            return get_refused_recipients(self.rate_limited(recipients, self.send_envelope, sender, recipients,
+                                                            payload, mail_options))
+
+    def _sendmail(self, sender, recipients, payload, mail_options=()):
+        """
+        smtplib's sendmail, which switches the session to UTF-8 commands for SMTPUTF8 and
+        never switches back: restore the encoding once the transaction is over
+        """
+        client = self.client
+        encoding = client.command_encoding
+        try:
+            return client.sendmail(sender, recipients, payload, mail_options)
+        finally:
+            client.command_encoding = encoding
+
+    def send_stream(self, email, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Send an Email without ever holding it in memory: attachments are encoded from disk
+        and written to the socket chunk by chunk.
+        :param chunk_size: number of attachment bytes read and encoded at a time
+        :return: dict of refused recipients, as send() does
+        """
+        recipients = email.get_envelope_recipients()
+        refused = self.preflight(email, recipients)
+        if refused is not None:
+            return refused
+        eight_bit, smtputf8, mail_options = self.get_payload_options(email)
+        stream = email.get_payload_stream(chunk_size, eight_bit=eight_bit, smtputf8=smtputf8)
+        with self.hooks.timed('send', host=self.host, port=self.port, recipients=len(recipients)):
+            return get_refused_recipients(self.rate_limited(
+                recipients, self.send_envelope, email.sender, recipients, stream, mail_options
+            ))
+
+    def send_many(self, emails):
+        """
+        Send several Emails over the current connection. Refusals do not raise: every
+        recipient of every email gets a result instead.
+        :param emails: an iterable of Email objects
+        :return: a list with a {recipient: (code, response)} dict per email, in order
+        """
+        results = []
+        for email in emails:
+            recipients = email.get_envelope_recipients()
+            refused = self.preflight(email, recipients)
+            if refused is not None:
+                results.append(refused)
+                continue
+            payload, mail_options = self.get_payload(email)
+            with self.hooks.timed('send', host=self.host, port=self.port, recipients=len(recipients),
+                                  bytes=len(payload)):
+                results.append(self.rate_limited(recipients, self.send_envelope, email.sender, recipients,
+                                                 payload, mail_options))
+        return results
+
+    def rate_limited(self, recipients, send, *args):
+        """
+        Call send(*args) within the rate limiter, if one is set: wait for the tokens of the
+        send, then report its outcome so the limits adapt to it
+        :param recipients: the recipients of the send
+        :return: the return value of send
+        """
+        limiter = self.rate_limiter
+        if limiter is None:
+            return send(*args)
+        limiter.acquire(len(recipients))
+        try:
+            results = send(*args)
+        except Exception as error:
+            limiter.release(error=error)
+            raise
+        limiter.release(results)
+        return results
+
+    def get_payload_options(self, email):
+        """
+        Choose how to serialise an Email for the current session: text bodies are sent as 8bit
+        when the server supports 8BITMIME, and non ascii headers as raw UTF-8 when it supports
+        SMTPUTF8.
+        :return: (eight_bit, smtputf8, list of ESMTP options for the MAIL command)
+        """
+        client = self.client
+        client.ehlo_or_helo_if_needed()
+        eight_bit = bool(client.does_esmtp and client.has_extn('8bitmime'))
+        smtputf8 = bool(client.does_esmtp and client.has_extn('smtputf8') and email.has_non_ascii_headers())
+        mail_options = []
+        if eight_bit:
+            mail_options.append('BODY=8BITMIME')
+        if smtputf8:
+            mail_options.append('SMTPUTF8')
+        return eight_bit, smtputf8, mail_options
+
+    def get_payload(self, email):
+        """
+        Serialise an Email for the current session (see get_payload_options)
+        :return: (payload as bytes, list of ESMTP options for the MAIL command)
+        """
+        eight_bit, smtputf8, mail_options = self.get_payload_options(email)
+        return email.get_payload_bytes(eight_bit=eight_bit, smtputf8=smtputf8), mail_options
+
+    def get_size_limit(self):
+        """
+        :return: the maximum message size the server advertises with SIZE, or None
+        """
+        client = self.client
+        client.ehlo_or_helo_if_needed()
+        size = client.esmtp_features.get('size', '').strip() if client.does_esmtp else ''
+        return int(size) if size.isdigit() and int(size) else None
+
+    def preflight(self, email, recipients):
+        """
+        Check the estimated size of an Email against the server's SIZE limit, before it is
+        serialised
+        :return: None if the email can be sent, otherwise the results reported for it (see
+                 check_size)
+        """
+        limit = self.get_size_limit()
+        if limit is None or not hasattr(email, 'estimate_size'):
+            return None
+        eight_bit, smtputf8, _ = self.get_payload_options(email)
+        return self.check_size(email, recipients, email.estimate_size(eight_bit=eight_bit, smtputf8=smtputf8),
+                               limit)
+
+    def check_size(self, email, recipients, size, limit=None):
+        """
+        Compare a message size with the server's SIZE limit. A message over the limit raises
+        MessageTooLarge, or if an oversized_handler is set, is passed to it and reported as
+        refused for all its recipients with the 552 reply of the error.
+        :param email: the Email, or None for an already serialised payload
+        :param limit: the server's limit, if already known
+        :return: None if the message can be sent, otherwise {recipient: (code, response)}
+        """
+        limit = limit or self.get_size_limit()
+        if limit is None or size <= limit:
+            return None
+        from strudelpy.preflight import MessageTooLarge
+        error = MessageTooLarge(size, limit, email)
+        if self.oversized_handler is None:
+            raise error
+        self.oversized_handler(error)
+        return dict((recipient, (error.smtp_code, error.smtp_error)) for recipient in recipients)
+
+    def uses_bdat(self):
+        """
+        :return: True if messages are sent with BDAT rather than DATA in the current session
+        """
+        client = self.client
+        return bool(self.bdat_chunk_size and client.does_esmtp and client.has_extn('chunking'))
+
+    def send_envelope(self, sender, recipients, payload, mail_options=()):
+        """
+        Send a payload to a list of recipients, using as many transactions as required to keep
+        each one within max_recipients. Commands are pipelined if the server supports it.
+        :param sender: envelope sender address
+        :param recipients: list of envelope recipient addresses
+        :param payload: the message as string, bytes or PayloadStream
+        :param mail_options: extra ESMTP options for the MAIL command
+        :return: {recipient: (code, response)} for every recipient
+        """
+        if isinstance(payload, six.text_type):
+            payload = payload.encode('utf-8')
+        self.client.ehlo_or_helo_if_needed()
+        chunk_size = self.max_recipients or len(recipients) or 1
+        results = {}
+        for i in range(0, len(recipients), chunk_size):
+            results.update(self._send_transaction(sender, recipients[i:i + chunk_size],
+                                                  payload, mail_options))
+        return results
+
+    def _send_transaction(self, sender, recipients, payload, mail_options=()):
+        """
+        Run a single MAIL/RCPT/DATA transaction, or MAIL/RCPT/BDAT with CHUNKING.
+        With PIPELINING (RFC 2920) the MAIL, all the RCPTs and DATA go out in one write, so
+        the envelope costs a single round trip regardless of the number of recipients.
+        :return: {recipient: (code, response)} for the recipients of this transaction
+        """
+        client = self.client
+        options = list(mail_options)
+        if client.does_esmtp and client.has_extn('size'):
+            options.append('SIZE=%d' % (len(payload) if isinstance(payload, bytes) else payload.get_size()))
+        if 'SMTPUTF8' not in options:
+            return self._run_transaction(client, sender, recipients, payload, options)
+        # UTF-8 addresses for this transaction only: the session goes on with ascii commands
+        encoding = client.command_encoding
+        client.command_encoding = 'utf-8'
+        try:
+            return self._run_transaction(client, sender, recipients, payload, options)
+        finally:
+            client.command_encoding = encoding
+
+    def _run_transaction(self, client, sender, recipients, payload, options):
+        import smtplib
+        pipelining = client.does_esmtp and client.has_extn('pipelining')
+        bdat = self.uses_bdat()
+        if pipelining:
+            commands = ['MAIL FROM:%s%s' % (smtplib.quoteaddr(sender), ''.join(' ' + o for o in options))]
+            commands.extend('RCPT TO:%s' % smtplib.quoteaddr(r) for r in recipients)
+            if not bdat:
+                commands.append('DATA')
+            client.send(''.join(command + '\r\n' for command in commands))
+            mail_reply = client.getreply()
+            rcpt_replies = [client.getreply() for _ in recipients]
+            data_reply = None if bdat else client.getreply()
+        else:
+            mail_reply = client.mail(sender, options)
+            if mail_reply[0] != 250:
+                rcpt_replies = [mail_reply] * len(recipients)
+            else:
+                rcpt_replies = [client.rcpt(recipient) for recipient in recipients]
+            data_reply = None
+        if mail_reply[0] != 250:
+            results = dict((recipient, mail_reply) for recipient in recipients)
+        else:
+            results = dict(zip(recipients, rcpt_replies))
+        accepted = [r for r in recipients if results[r][0] in (250, 251)]
+        if bdat:
+            if accepted:
+                data_reply = self.send_bdat(payload, pipelining)
+        elif not pipelining and accepted:
+            client.putcmd('data')
+            data_reply = client.getreply()
+        if not bdat and data_reply is not None and data_reply[0] == 354:
+            if not accepted:
+                # a pipelined DATA may be accepted even though no recipient was: end it empty
+                client.send(b'.' + CRLF)
+            elif isinstance(payload, bytes):
+                client.send(quote_data(payload))
+            else:
+                for chunk in iter_quoted_data(payload):
+                    client.send(chunk)
+            data_reply = client.getreply()
+        if accepted:
+            for recipient in accepted:
+                results[recipient] = data_reply
+        if data_reply is None or data_reply[0] != 250:
+            if data_reply is not None and data_reply[0] == 421:
+                client.close()
+            else:
+                client.rset()
+        return results
+
+    def send_bdat(self, payload, pipelining=False):
+        """
+        Send the message as BDAT chunks of bdat_chunk_size bytes (RFC 3030). The payload is
+        written as it is: there is no dot stuffing pass over it.
+        With PIPELINING all the chunks are written before their replies are read, otherwise
+        each reply is waited for and the first failure stops the transmission.
+        :param payload: the message as bytes or PayloadStream
+        :return: the reply to the failed or the last BDAT command
+        """
+        client = self.client
+        pending = []
+
+        def send_chunk(chunk, last):
+            client.send(('BDAT %d%s\r\n' % (len(chunk), ' LAST' if last else '')).encode('ascii'))
+            client.send(chunk)
+            if pipelining:
+                pending.append(True)
+                return None
+            return client.getreply()
+
+        previous = None
+        reply = None
+        for chunk in iter_bdat_chunks(payload, self.bdat_chunk_size):
+            if previous is not None:
+                reply = send_chunk(previous, False)
+                if reply is not None and reply[0] != 250:
+                    return reply
+            previous = chunk
+        reply = send_chunk(previous if previous is not None else b'', True)
+        for _ in pending:
+            # keep the first failure, or else the reply to the last chunk
+            chunk_reply = client.getreply()
+            if reply is None or reply[0] == 250:
+                reply = chunk_reply
+        return reply
 
 
 class Email(object):
@@ -140,6 +664,18 @@ class Email(object):
     The email can contain plain text and/or html, multiple recipients, cc and bcc.
     Attachments can be added as well as embedded images
     """
+    # process wide cache of encoded attachments and embedded images. Set to None to disable
+    part_cache = default_part_cache
+    # callbacks timing the compile and serialise stages (see strudelpy.metrics)
+    hooks = default_hooks
+    # memo of encoded addresses shared by the address headers of all emails
+    address_encoder = default_address_encoder
+    # optional DKIMSigner signing every serialised payload (see strudelpy.dkim)
+    dkim_signer = None
+    # length of a generated Message-ID, measured once for estimate_size (make_msgid looks up
+    # the host name)
+    message_id_size = None
+
     def __init__(self, sender=None, recipients=[], cc=[], bcc=[],
                  subject=None, text=None, html=None, charset=None,
                  attachments=[], embedded=[], headers=[]):
@@ -155,32 +691,391 @@ class Email(object):
         self.charset = charset or 'utf-8'
         self.headers = headers
         self.compiled = False
+        self.message = None
+        # 8bit bodies and raw UTF-8 headers, used when the server supports 8BITMIME / SMTPUTF8
+        self.eight_bit = False
+        self.smtputf8 = False
+        # the state the message was compiled from, and its attachment parts by (kind, path)
+        self.compiled_state = None
+        self.compiled_parts = {}
+        # ((eight_bit, smtputf8), size) of the payload last serialised from the compiled message
+        self.compiled_size = None
+
+    def get_envelope_recipients(self):
+        """
+        Return the plain addresses of all the recipients (to, cc and bcc) for the SMTP envelope
+        :return: list of unique email addresses, in order
+        """
+        addresses = []
+        seen = set()
+        for field in (self.recipients, self.cc, self.bcc):
+            if not field:
+                continue
+            if type(field) not in (list, tuple):
+                field = [field]
+            for address in field:
+                if type(address) in (tuple, list):
+                    address = address[1]
+                if address not in seen:
+                    seen.add(address)
+                    addresses.append(address)
+        return addresses
 
-    def compile_message(self):
+    def compile_message(self, eight_bit=False, smtputf8=False):
         """
-        Compile this message with all its parts
+        Compile this message with all its parts.
+        A multipart message compiled before is updated in place: the headers are regenerated,
+        but the bodies and attachment parts are only rebuilt if they changed since.
+        :param eight_bit: send text bodies as 8bit rather than base64 (requires 8BITMIME)
+        :param smtputf8: write non ascii headers as raw UTF-8 (requires SMTPUTF8)
         :return: the compiled Message object
         """
-        message = self.get_root_message()
-        if self.attachments:
-            # add the attachments as parts of the Multi part message
-            for attachment in self.attachments:
-                message.attach(self.get_file_attachment(attachment))
-        if self.embedded:
-            for embedded in self.embedded:
-                message.attach(self.get_embedded_image(embedded))
+        changes = self.get_changes() if self.compiled else None
+        if changes is not None and eight_bit != self.eight_bit:
+            changes.add('body')
+        self.eight_bit = eight_bit
+        self.smtputf8 = smtputf8
+        self.compiled_size = None
+        from strudelpy.generator import memoize
+        with self.hooks.timed('compile'):
+            if changes is None or 'structure' in changes or not self.message.is_multipart():
+                message = self.get_root_message()
+                self.compiled_parts = {}
+                if message.is_multipart():
+                    memoize(message.get_payload(0))
+                    self.update_parts(message)
+            else:
+                message = self.message
+                if 'body' in changes:
+                    message.get_payload()[0] = memoize(self.get_body_part())
+                if 'parts' in changes:
+                    self.update_parts(message)
+                self.set_headers(message)
         self.message = message
+        self.compiled_state = self.get_state()
         self.compiled = True
         return self.message
 
+    def compact(self, segment_table=default_segment_table, release=True):
+        """
+        Return this email serialised into a CompactEmail, which takes a fraction of the memory
+        and can be sent in its place. Further changes to this email don't affect it.
+        :param segment_table: SegmentTable attachment parts are shared through, or None
+        :param release: drop the compiled message tree of this email afterwards
+        :return: CompactEmail
+        """
+        compact = CompactEmail.from_email(self, segment_table)
+        if release:
+            self.release()
+        return compact
+
+    def release(self):
+        """
+        Drop the compiled message tree. It's rebuilt if the email is serialised again.
+        """
+        self.message = None
+        self.compiled = False
+        self.compiled_state = None
+        self.compiled_parts = {}
+        self.compiled_size = None
+
+    def get_state(self):
+        """
+        Return the values the message is compiled from, grouped by the part of the message
+        they end up in
+        """
+        def freeze(value):
+            return tuple(value) if type(value) in (list, tuple) else value
+        return {
+            'structure': self.is_multipart(),
+            'headers': (self.sender, freeze(self.recipients), freeze(self.cc), freeze(self.bcc),
+                        self.subject, self.charset),
+            'body': (self.text, self.html, self.charset),
+            'parts': (freeze(self.attachments), freeze(self.embedded)),
+        }
+
+    def get_changes(self):
+        """
+        Return what changed since the message was compiled, whether by assignment or by
+        modifying the recipient and attachment lists in place
+        :return: set of 'structure', 'headers', 'body' and 'parts'
+        """
+        if self.compiled_state is None:
+            return set(['structure'])
+        state = self.get_state()
+        return set(key for key, value in state.items() if value != self.compiled_state[key])
+
+    def update_parts(self, message):
+        """
+        Set the attachment and embedded image parts of a multipart message, reusing the parts
+        of files which are still attached and haven't changed on disk
+        """
+        from strudelpy.generator import memoize
+        parts = {}
+        payload = [message.get_payload(0)]
+        for kind, paths, get_part in (('attachment', self.attachments, self.get_file_attachment),
+                                      ('embedded', self.embedded, self.get_embedded_image)):
+            for path in paths or []:
+                stat = os.stat(path)
+                version = (stat.st_mtime, stat.st_size)
+                previous = parts.get((kind, path)) or self.compiled_parts.get((kind, path))
+                if previous is None or previous[0] != version:
+                    previous = (version, memoize(get_part(path)))
+                parts[(kind, path)] = previous
+                payload.append(previous[1])
+        self.compiled_parts = parts
+        message.set_payload(payload)
+
     def get_payload(self):
         """
-        Return the final payload of this email. Its compiled if not previously done so.
+        Return the final payload of this email. Its compiled if not previously done so, and
+        recompiled if it changed since.
         :return: payload as string
         """
-        if not self.compiled:
+        if not self.compiled or self.eight_bit or self.smtputf8 or self.get_changes():
             self.compile_message()
-        return self.message.as_string()
+        with self.hooks.timed('serialise'):
+            if six.PY2:
+                payload = self.message.as_string()
+            else:
+                from strudelpy.generator import MemoGenerator
+                output = io.StringIO()
+                MemoGenerator(output, mangle_from_=False, maxheaderlen=0).flatten(self.message)
+                payload = output.getvalue()
+        return self.sign(payload)
+
+    def get_payload_bytes(self, eight_bit=False, smtputf8=False):
+        """
+        Return the final payload of this email as bytes with CRLF line endings, ready for the
+        wire. Its compiled if not previously done so with the same options.
+        :param eight_bit: send text bodies as 8bit rather than base64 (requires 8BITMIME)
+        :param smtputf8: write non ascii headers as raw UTF-8 (requires SMTPUTF8)
+        :return: payload as bytes
+        """
+        if six.PY2:
+            return self.get_payload()
+        if not self.compiled or (self.eight_bit, self.smtputf8) != (eight_bit, smtputf8) or self.get_changes():
+            self.compile_message(eight_bit=eight_bit, smtputf8=smtputf8)
+        from email.policy import SMTPUTF8, compat32
+        from strudelpy.generator import MemoBytesGenerator
+        policy = SMTPUTF8.clone(max_line_length=0) if smtputf8 else compat32.clone(linesep='\r\n')
+        payload = io.BytesIO()
+        with self.hooks.timed('serialise'):
+            MemoBytesGenerator(payload, mangle_from_=False, maxheaderlen=0, policy=policy).flatten(self.message)
+        payload = self.sign(payload.getvalue())
+        self.compiled_size = ((eight_bit, smtputf8), len(payload))
+        return payload
+
+    def sign(self, payload):
+        """
+        Add a DKIM-Signature header to a serialised payload if a dkim_signer is set
+        :param payload: the message as string or bytes
+        :return: the signed payload
+        """
+        if self.dkim_signer is None:
+            return payload
+        with self.hooks.timed('sign'):
+            return self.dkim_signer.sign(payload)
+
+    def has_non_ascii_headers(self):
+        """
+        :return: True if the sender, recipients or subject contain non ascii characters
+        """
+        values = [self.sender, self.subject]
+        for field in (self.recipients, self.cc, self.bcc):
+            if field:
+                values.extend(field if type(field) in (list, tuple) else [field])
+        for value in values:
+            for item in (value if type(value) in (list, tuple) else [value]):
+                if isinstance(item, six.text_type) and any(ord(char) > 127 for char in item):
+                    return True
+        return False
+
+    def get_payload_stream(self, chunk_size=STREAM_CHUNK_SIZE, eight_bit=False, smtputf8=False):
+        """
+        Return the final payload of this email as a re-iterable stream of byte chunks.
+        Attachments and embedded images are not loaded: they are read and encoded from disk
+        chunk by chunk whenever the stream is iterated, so memory use does not depend on
+        their size.
+        :param chunk_size: number of file bytes read and encoded at a time
+        :param eight_bit: send text bodies as 8bit rather than base64 (requires 8BITMIME)
+        :param smtputf8: write non ascii headers as raw UTF-8 (requires SMTPUTF8)
+        :return: PayloadStream
+        """
+        segments = self.get_stream_segments(eight_bit=eight_bit, smtputf8=smtputf8)
+        if self.dkim_signer is not None:
+            # the body is hashed by reading the stream once more
+            with self.hooks.timed('sign'):
+                segments.insert(0, self.dkim_signer.sign_stream(PayloadStream(segments, chunk_size)))
+        return PayloadStream(segments, chunk_size)
+
+    def get_stream_segments(self, eight_bit=False, smtputf8=False):
+        """
+        Return the message with placeholders for attachments and embedded images, split into
+        bytes segments and the (path, encoding) of the files in between
+        :param eight_bit: 8bit text bodies (see get_payload_bytes)
+        :param smtputf8: raw UTF-8 headers (see get_payload_bytes)
+        """
+        # the flags of the compiled message are only borrowed while the skeleton is built
+        flags = (self.eight_bit, self.smtputf8)
+        self.eight_bit, self.smtputf8 = eight_bit, smtputf8
+        try:
+            message = self.get_root_message()
+            streamed = {}
+            for attachment in self.attachments or []:
+                message.attach(self.get_streamed_part(attachment, streamed))
+            for embedded in self.embedded or []:
+                message.attach(self.get_streamed_part(embedded, streamed, embedded=True))
+        finally:
+            self.eight_bit, self.smtputf8 = flags
+        if six.PY2:
+            skeleton = message.as_string()
+        else:
+            # as get_payload_bytes does: as_string() would base64 encode 8bit bodies again
+            from email.generator import BytesGenerator
+            from email.policy import SMTPUTF8, compat32
+            policy = SMTPUTF8.clone(max_line_length=0, linesep='\n') if smtputf8 else compat32
+            output = io.BytesIO()
+            BytesGenerator(output, mangle_from_=False, maxheaderlen=0, policy=policy).flatten(message)
+            skeleton = output.getvalue()
+        streamed = dict((placeholder.encode('ascii'), segment) for placeholder, segment in streamed.items())
+        if streamed:
+            pieces = re.split(b'(' + b'|'.join(streamed) + b')', skeleton)
+        else:
+            pieces = [skeleton]
+        return [streamed.get(piece) or piece for piece in pieces if piece]
+
+    def estimate_size(self, eight_bit=False, smtputf8=False):
+        """
+        Return the size of this email on the wire. An email serialised with the same options
+        and unchanged since has the size of that payload. Otherwise the size is computed from
+        the headers and bodies and from the size of the files on disk, without building the
+        message or encoding the files. The estimate is within a few bytes of the payload, and
+        send_compiled() checks the exact size again.
+        :param eight_bit: estimate for 8bit text bodies (see get_payload_bytes)
+        :param smtputf8: estimate for raw UTF-8 headers (see get_payload_bytes)
+        :return: size in bytes
+        """
+        if self.compiled_size is not None and self.compiled_size[0] == (eight_bit, smtputf8) \
+                and not self.get_changes():
+            return self.compiled_size[1]
+        flags = (self.eight_bit, self.smtputf8)
+        self.eight_bit, self.smtputf8 = eight_bit, smtputf8
+        try:
+            headers, content = self.get_outline()
+            size = self.get_outline_size(headers + self.get_header_outline(), content)
+        finally:
+            self.eight_bit, self.smtputf8 = flags
+        if self.dkim_signer is not None:
+            size += self.dkim_signer.estimate_size()
+        return size
+
+    def get_outline(self):
+        """
+        Return the MIME structure get_root_message() builds, without building it
+        :return: (headers, content): the (name, value) MIME headers of the message, and the
+                 size of its encoded body or the list of the (headers, content) of its parts
+        """
+        def multipart(subtype, parts):
+            return [('Content-Type', 'multipart/{0}; boundary="{1}"'.format(subtype, '=' * BOUNDARY_LENGTH)),
+                    ('MIME-Version', '1.0')], parts
+        if self.is_multipart():
+            alternative = [self.get_text_outline(self.text or self.html, 'plain' if self.text else 'html')]
+            alternative.append(multipart('related', [self.get_text_outline(self.html, 'html')] if self.html else []))
+            parts = [multipart('alternative', alternative)]
+            parts.extend(self.get_file_outline(path) for path in self.attachments or [])
+            parts.extend(self.get_file_outline(path, embedded=True) for path in self.embedded or [])
+            return multipart('mixed', parts)
+        if self.text or self.html:
+            return self.get_text_outline(self.text or self.html, 'plain' if self.text else 'html')
+        return [('Content-Type', 'text/plain; charset="us-ascii"'), ('MIME-Version', '1.0'),
+                ('Content-Transfer-Encoding', '7bit')], 0
+
+    def get_text_outline(self, body, format):
+        """
+        :return: (headers, encoded size) of a text body, as get_email_part() builds it
+        """
+        from email.charset import BASE64, QP
+        from email import quoprimime
+        charset = self.get_charset(body)
+        data = body.encode(self.charset)
+        if charset.body_encoding == BASE64:
+            encoding, size = 'base64', get_encoded_size(len(data))
+        elif charset.body_encoding == QP:
+            encoding = 'quoted-printable'
+            size = get_wire_size(quoprimime.body_encode(data.decode('latin-1')).encode('latin-1'))
+        else:
+            encoding, size = '7bit' if is_7bit(data) else '8bit', get_wire_size(data)
+        return [('Content-Type', 'text/{0}; charset="{1}"'.format(format, charset.get_output_charset())),
+                ('MIME-Version', '1.0'), ('Content-Transfer-Encoding', encoding)], size
+
+    def get_file_outline(self, path, embedded=False):
+        """
+        :return: (headers, encoded size) of an attachment or embedded image, from the size of
+                 the file on disk
+        """
+        mimetype = guess_type(path) or 'text/plain'
+        encoding = self.get_file_encoding(path, embedded)
+        path_basename = os.path.basename(path)
+        headers = [('Content-Type', mimetype), ('MIME-Version', '1.0')]
+        if encoding == 'base64':
+            headers.append(('Content-Transfer-Encoding', 'base64'))
+        if embedded:
+            if mimetype.startswith('image'):
+                # MIMEImage encodes the image, and build_embedded_image encodes it once more
+                headers.append(('Content-Transfer-Encoding', 'base64'))
+            cid_value = path_basename.split('.')[0]
+            headers.extend([('Content-ID', '<{0}>'.format(cid_value)), ('X-Attachment-Id', '<{0}>'.format(cid_value))])
+        headers.append(('Content-Disposition', 'attachment; filename="%s"' % path_basename))
+        if encoding is None:
+            # 7bit text goes out with CRLF line endings
+            return headers, sum(get_wire_size(chunk) for chunk in iter_file_chunks(path))
+        return headers, get_encoded_size(os.stat(path).st_size, encoding)
+
+    def get_header_outline(self):
+        """
+        :return: the (name, value) headers set_headers() sets
+        """
+        from email.utils import formatdate
+        headers = [('From', self.format_email_address(email_type='from', emails=[self.sender]))]
+        for name, emails in (('To', self.recipients), ('Cc', self.cc), ('Bcc', self.bcc)):
+            if emails:
+                headers.append((name, self.format_email_address(email_type=name.lower(), emails=emails)))
+        headers = [(name, self.get_header_value(value)) for name, value in headers]
+        headers.append(('Subject', self.get_header_value(self.get_header('subject', self.subject))))
+        if Email.message_id_size is None:
+            import uuid
+            from email.utils import make_msgid
+            Email.message_id_size = len(make_msgid(str(uuid.uuid4())))
+        headers.extend([('Date', formatdate(localtime=True)), ('Message-ID', '-' * Email.message_id_size),
+                        ('X-Mailer', 'Strudelpy Python Client')])
+        return headers
+
+    def get_outline_size(self, headers, content):
+        """
+        :return: the size on the wire of a part described by get_outline()
+        """
+        size = len(CRLF)
+        for name, value in headers:
+            if isinstance(value, Header):
+                value = value.encode(maxlinelen=0)
+            # every (folded) line ends with a CRLF
+            size += len(name) + 2 + len(value.encode('utf-8')) + len(CRLF) * (value.count('\n') + 1)
+        if not isinstance(content, list):
+            return size + content
+        # --boundary CRLF, each part, CRLF --boundary CRLF between parts, CRLF --boundary-- CRLF
+        delimiter = 2 + BOUNDARY_LENGTH + len(CRLF)
+        size += delimiter + sum(self.get_outline_size(*part) for part in content)
+        return size + (len(CRLF) + delimiter) * max(len(content) - 1, 0) + len(CRLF) + delimiter + 2
+
+    def get_file_encoding(self, path, embedded=False):
+        """
+        :return: the transfer encoding of an attached file: 'base64', or None for 7bit text
+                 files, which are included as they are
+        """
+        if embedded or not (guess_type(path) or 'text/plain').startswith('text/') or not is_7bit_file(path):
+            return 'base64'
+        return None
 
     def is_valid_message(self):
         """
@@ -200,40 +1095,68 @@ class Email(object):
         Multi Part email. All the initial fields are set on the message.
         :return: email.Message object
         """
-
-        if (self.text and self.html) or self.attachments or self.embedded:
-            self.message = MIMEMultipart('mixed')
-            message_alt = MIMEMultipart('alternative', None)
-            message_rel = MIMEMultipart('related')
-            if self.text:
-                message_alt.attach(self.get_email_part(self.text, 'plain'))
-            elif self.html:
-                message_alt.attach(self.get_email_part(self.html, 'html'))
-            if self.html:
-                message_rel.attach(self.get_email_part(self.html, 'html'))
-            message_alt.attach(message_rel)
-            self.message.attach(message_alt)
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        if self.is_multipart():
+            message = MIMEMultipart('mixed')
+            message.attach(self.get_body_part())
         elif self.text or self.html:
             if self.text:
-                self.message = MIMEText(self.text.encode(self.charset), 'plain', self.charset)
+                message = MIMEText(self.text.encode(self.charset), 'plain', self.get_charset(self.text))
             else:
-                self.message = MIMEText(self.html.encode(self.charset), 'html', self.charset)
+                message = MIMEText(self.html.encode(self.charset), 'html', self.get_charset(self.html))
         else:
-            self.message = MIMEText('', 'plain', 'us-ascii')
-        self.message['From'] = self.format_email_address(email_type='from', emails=[self.sender])
+            message = MIMEText('', 'plain', 'us-ascii')
+        self.set_headers(message)
+        return message
+
+    def is_multipart(self):
+        """
+        :return: True if this email is compiled to a multipart message
+        """
+        return bool((self.text and self.html) or self.attachments or self.embedded)
+
+    def get_body_part(self):
+        """
+        Return the multipart/alternative part holding the text and html bodies of a multipart
+        message
+        :return: MIMEMultipart object
+        """
+        from email.mime.multipart import MIMEMultipart
+        message_alt = MIMEMultipart('alternative', None)
+        message_rel = MIMEMultipart('related')
+        if self.text:
+            message_alt.attach(self.get_email_part(self.text, 'plain'))
+        elif self.html:
+            message_alt.attach(self.get_email_part(self.html, 'html'))
+        if self.html:
+            message_rel.attach(self.get_email_part(self.html, 'html'))
+        message_alt.attach(message_rel)
+        return message_alt
+
+    def set_headers(self, message):
+        """
+        Set the address, subject, date and id headers on the top level message, replacing
+        previous values
+        :param message: email.Message object
+        """
+        import uuid
+        from email.utils import formatdate, make_msgid
+        for name in ('From', 'To', 'Cc', 'Bcc', 'Subject', 'Date', 'Message-ID', 'X-Mailer'):
+            del message[name]
+        message['From'] = self.get_header_value(self.format_email_address(email_type='from', emails=[self.sender]))
         if self.recipients:
-            self.message['To'] = self.format_email_address(email_type='to', emails=self.recipients)
+            message['To'] = self.get_header_value(self.format_email_address(email_type='to', emails=self.recipients))
 
         if self.cc:
-            self.message['Cc'] = self.format_email_address(email_type='cc', emails=self.cc)
+            message['Cc'] = self.get_header_value(self.format_email_address(email_type='cc', emails=self.cc))
         if self.bcc:
-            self.message['Bcc'] = self.format_email_address(email_type='bcc', emails=self.bcc)
+            message['Bcc'] = self.get_header_value(self.format_email_address(email_type='bcc', emails=self.bcc))
 
-        self.message['Subject'] = self.get_header('subject', self.subject)
-        self.message['Date'] = formatdate(localtime=True)  # TODO check formatdate
-        self.message['Message-ID'] = make_msgid(str(uuid.uuid4()))
-        self.message['X-Mailer'] = 'Strudelpy Python Client'
-        return self.message
+        message['Subject'] = self.get_header_value(self.get_header('subject', self.subject))
+        message['Date'] = formatdate(localtime=True)  # TODO check formatdate
+        message['Message-ID'] = make_msgid(str(uuid.uuid4()))
+        message['X-Mailer'] = 'Strudelpy Python Client'
 
     def get_header(self, name, value=None):
         """
@@ -246,38 +1169,59 @@ class Email(object):
             _header.append(value)
         return _header
 
+    def get_header_value(self, header):
+        """
+        Return the value to set on the message for a Header: the Header itself, which is
+        written as RFC 2047 encoded words, or its plain text when compiling for SMTPUTF8.
+        :param header: Header instance
+        """
+        if self.smtputf8:
+            if isinstance(header, EncodedHeader):
+                return header.fold_utf8()
+            return six.text_type(header)
+        return header
+
+    def get_charset(self, body=None):
+        """
+        Return the Charset used for a text body. When compiling for 8BITMIME, bodies are not
+        transfer encoded, unless they have lines longer than SMTP allows: those are always
+        quoted-printable or base64 encoded.
+        :param body: the body text
+        :return: Charset instance
+        """
+        from email.charset import QP
+        charset = Charset(self.charset)
+        long_lines = body is not None and has_long_lines(body.encode(self.charset))
+        if self.eight_bit and charset.output_charset in ('utf-8', 'iso-8859-1', 'us-ascii') and not long_lines:
+            charset.body_encoding = None
+        elif long_lines and charset.body_encoding is None:
+            charset.body_encoding = QP
+        return charset
+
     def format_email_address(self, email_type, emails=None):
         """
         returns email headers with email information.
         :param email_type: One of: from|to|cc|bcc
         :param emails: A list of email address or list/tuple of (name, email) pairs.
-        :return: the email header
+        :return: the email header, an EncodedHeader
         """
         emails = emails or self.recipients or []
-        header = self.get_header(email_type)
-        for i, address in enumerate(emails):
-            if i > 0:  # ensure emails are separated by commas
-                header.append(',', 'us-ascii')
-            if isinstance(address, six.string_types):
-                # address is a string. use as is. Attempt it as ascii first and
-                # if fails, send in the default charset
-                try:
-                    header.append(address, charset='us-ascii')
-                except UnicodeError:
-                    header.append(address, charset=self.charset)
-            elif type(address) in (tuple, list):
-                # address is a list or tuple (name, email): format it
-                _name, _address = address
-                try:
-                    _name.encode('us-ascii')
-                    formatted_address = formataddr(address)
-                    header.append(formatted_address, charset='us-ascii')
-                except UnicodeError:  # this is not an ascii name - append it separately
-                    header.append(_name)
-                    header.append('<{0}>'.format(_address), charset='us-ascii')
-        return header
+        if isinstance(emails, six.string_types):
+            emails = [emails]
+        return self.address_encoder.encode(emails, header_name=email_type, charset=self.charset)
 
     def get_embedded_image(self, path):
+        """
+        Return a base64 encoded MIME part with the image under path, with the Content-ID
+        used to reference it from the html body. Cached in part_cache.
+        :param path: Absolute path to the image
+        :return: email.message.Message object
+        """
+        if self.part_cache is not None:
+            return self.part_cache.get_part(path, 'embedded', self.build_embedded_image)
+        return self.build_embedded_image(path)
+
+    def build_embedded_image(self, path):
         email_part = self.get_file_mimetype(path)
         encode_base64(email_part)
         path_basename = os.path.basename(path)
@@ -287,10 +1231,48 @@ class Email(object):
         email_part.add_header('Content-Disposition', 'attachment; filename="%s"' % path_basename)
         return email_part
 
+    def get_streamed_part(self, path, streamed, embedded=False):
+        """
+        Return a MIMEBase email part with the headers of an attachment (or embedded image)
+        and a placeholder instead of the file content.
+        :param path: Absolute path to the file
+        :param streamed: dict the placeholder is registered in, mapped to (path, encoding)
+        :param embedded: True for embedded images
+        :return: MIMEBase object
+        """
+        import uuid
+        from email.mime.base import MIMEBase
+        asserted_mimetype = guess_type(path) or 'text/plain'
+        email_part = MIMEBase(*asserted_mimetype.split('/'))
+        placeholder = 'strudelpy-stream-{0}'.format(uuid.uuid4().hex)
+        email_part.set_payload(placeholder)
+        # as build_file_attachment does, only 7bit text is included as it is
+        encoding = self.get_file_encoding(path, embedded)
+        if encoding == 'base64':
+            email_part['Content-Transfer-Encoding'] = 'base64'
+        streamed[placeholder] = (path, encoding)
+        path_basename = os.path.basename(path)
+        if embedded:
+            cid_value = path_basename.split('.')[0]
+            email_part.add_header('Content-ID', '<{0}>'.format(cid_value))
+            email_part.add_header('X-Attachment-Id', '<{0}>'.format(cid_value))
+        email_part.add_header('Content-Disposition', 'attachment; filename="%s"' % path_basename)
+        return email_part
+
     def get_file_attachment(self, path):
+        """
+        Return a MIME email part with the file under path as payload. Cached in part_cache.
+        :param path: Absolute path to the file being attached
+        :return: email.message.Message object
+        """
+        if self.part_cache is not None:
+            return self.part_cache.get_part(path, 'attachment', self.build_file_attachment)
+        return self.build_file_attachment(path)
+
+    def build_file_attachment(self, path):
         """
         Return a MIMEBase email part with the file under path as payload.
-        If the file is not textual, it is encoded as base64
+        If the file is not 7bit text, it is encoded as base64
         :param path: Absolute path to the file being attached
         :return: MIMEBase object
         """
@@ -299,8 +1281,8 @@ class Email(object):
         if not email_part.get_payload():
             with open(path, 'rb') as attached_file:
                 email_part.set_payload(attached_file.read())
-        # no need to base64 plain text
-        if email_part.get_content_maintype() != "text":
+        # no need to base64 plain text, as long as it is ascii with lines within the SMTP limit
+        if email_part.get_content_maintype() != "text" or not is_7bit(email_part.get_payload()):
             encode_base64(email_part)
         email_part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
         return email_part
@@ -314,8 +1296,10 @@ class Email(object):
         :return: MIMEBase object with the mime type
         """
         # todo look into guess_type
+        from email.mime.base import MIMEBase
+        from email.mime.image import MIMEImage
         fallback = fallback or ['text', 'plain']
-        asserted_mimetype = mimetypes.guess_type(path, False)[0]
+        asserted_mimetype = guess_type(path)
         if asserted_mimetype is None:
             mimetype = MIMEBase(*fallback)
         elif asserted_mimetype.startswith('image'):
@@ -333,8 +1317,9 @@ class Email(object):
         :param format: html or plain
         :return:MIMEText instance
         """
-        charset = Charset(self.charset)
-        email_part = MIMEText(body, format, self.charset)
+        from email.mime.text import MIMEText
+        charset = self.get_charset(body)
+        email_part = MIMEText(body, format, charset)
         email_part.set_charset(charset)
         return email_part
 
@@ -367,3 +1352,10 @@ class Email(object):
         :param image: string path to the image
         """
         self.embedded.append(image)
+
+
+if sys.version_info < (3, 7):
+    for name in LAZY_ATTRIBUTES:
+        if six.PY3 or name not in PY3_ONLY:
+            __getattr__(name)
+    PROTOCOL_TLS = get_protocol_tls()
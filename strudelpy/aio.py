@@ -0,0 +1,347 @@
+"""
+An asyncio SMTP transport which speaks SMTP directly over asyncio streams.
+
+async with AsyncSMTP(host='smtp.example.com', port=465, username='me', password='secret',
+                     ssl=True, max_connections=10) as smtp:
+    await smtp.send(email)
+
+Sends running concurrently are spread over up to `max_connections` sessions.
+Requires Python 3.5+, and 3.11+ for STARTTLS (tls=True).
+"""
+
+import asyncio
+import base64
+import hmac
+import smtplib
+import socket
+
+from strudelpy import MAX_RECIPIENTS, CRLF, quote_data, create_tls_context, get_refused_recipients
+
+__all__ = ['AsyncSMTP']
+
+
+class AsyncSMTPConnection(object):
+    """
+    A single SMTP session over an asyncio stream pair
+    """
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+
+    def has_extn(self, name):
+        return name.lower() in self.esmtp_features
+
+    async def _wait(self, awaitable):
+        if self.smtp.timeout:
+            return await asyncio.wait_for(awaitable, self.smtp.timeout)
+        return await awaitable
+
+    async def connect(self):
+        context = self.smtp.get_tls_context() if self.smtp.ssl else None
+        self.reader, self.writer = await self._wait(asyncio.open_connection(
+            self.smtp.host, self.smtp.port, ssl=context,
+            server_hostname=self.smtp.host if context else None
+        ))
+        try:
+            code, message = await self.getreply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await self.ehlo()
+            if self.smtp.tls:
+                await self.starttls()
+        except BaseException:
+            self.close()
+            raise
+
+    async def getreply(self):
+        """
+        Read a (possibly multiline) reply from the server
+        :return: (code, message) tuple, as smtplib does
+        """
+        lines = []
+        while True:
+            line = await self._wait(self.reader.readline())
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def write(self, data):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        self.writer.write(data)
+        await self._wait(self.writer.drain())
+
+    async def docmd(self, command):
+        await self.write(command + '\r\n')
+        return await self.getreply()
+
+    async def ehlo(self):
+        code, message = await self.docmd('EHLO %s' % self.smtp.local_hostname)
+        self.esmtp_features = {}
+        if code != 250:
+            self.does_esmtp = False
+            code, message = await self.docmd('HELO %s' % self.smtp.local_hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            return code, message
+        self.does_esmtp = True
+        for line in message.decode('latin-1').split('\n')[1:]:
+            feature, _, params = line.partition(' ')
+            self.esmtp_features[feature.lower()] = params.strip()
+        return code, message
+
+    async def starttls(self):
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        code, message = await self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        context = self.smtp.get_tls_context()
+        await self._wait(self.writer.start_tls(context, server_hostname=self.smtp.host))
+        await self.ehlo()
+
+    async def login(self, username, password):
+        """
+        Authenticate with AUTH PLAIN, CRAM-MD5 or LOGIN, in that order of preference. When the
+        server does not advertise AUTH, AUTH LOGIN is attempted as SMTP.fallback_login does:
+        a server which doesn't know the command takes no authentication.
+        :raises SMTPAuthenticationError: if the server refused the login
+        """
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        user, secret = username.encode('utf-8'), password.encode('utf-8')
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(b'\0' + user + b'\0' + secret).decode('ascii')
+            code, message = await self.docmd('AUTH PLAIN ' + token)
+        elif 'CRAM-MD5' in mechanisms:
+            code, message = await self.docmd('AUTH CRAM-MD5')
+            if code == 334:
+                challenge = base64.b64decode(message)
+                digest = hmac.HMAC(secret, challenge, 'md5').hexdigest()
+                code, message = await self.docmd(
+                    base64.b64encode(user + b' ' + digest.encode('ascii')).decode('ascii'))
+        else:
+            code, message = await self.docmd('AUTH LOGIN ' + base64.b64encode(user).decode('ascii'))
+            if code == 334:
+                code, message = await self.docmd(base64.b64encode(secret).decode('ascii'))
+            if code in (500, 502) and not mechanisms:
+                return code, message
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+        return code, message
+
+    async def send_transaction(self, sender, recipients, payload, mail_options=()):
+        """
+        Run a single MAIL/RCPT/DATA transaction, pipelined if the server supports it.
+        :return: {recipient: (code, response)} for every recipient
+        """
+        options = list(mail_options)
+        if self.does_esmtp and self.has_extn('size'):
+            options.append('SIZE=%d' % len(payload))
+        commands = ['MAIL FROM:%s%s' % (smtplib.quoteaddr(sender), ''.join(' ' + o for o in options))]
+        commands.extend('RCPT TO:%s' % smtplib.quoteaddr(r) for r in recipients)
+        if self.does_esmtp and self.has_extn('pipelining'):
+            await self.write(''.join(command + '\r\n' for command in commands + ['DATA']))
+            mail_reply = await self.getreply()
+            rcpt_replies = [await self.getreply() for _ in recipients]
+            data_reply = await self.getreply()
+        else:
+            mail_reply = await self.docmd(commands[0])
+            rcpt_replies = []
+            if mail_reply[0] == 250:
+                for command in commands[1:]:
+                    rcpt_replies.append(await self.docmd(command))
+            data_reply = None
+        if mail_reply[0] != 250:
+            results = dict((recipient, mail_reply) for recipient in recipients)
+        else:
+            results = dict(zip(recipients, rcpt_replies))
+        accepted = [r for r in recipients if results[r][0] in (250, 251)]
+        if data_reply is None and accepted:
+            data_reply = await self.docmd('DATA')
+        if data_reply is not None and data_reply[0] == 354:
+            await self.write(quote_data(payload) if accepted else b'.' + CRLF)
+            data_reply = await self.getreply()
+        for recipient in accepted:
+            results[recipient] = data_reply
+        if data_reply is None or data_reply[0] != 250:
+            if data_reply is not None and data_reply[0] == 421:
+                self.close()
+            else:
+                await self.docmd('RSET')
+        return results
+
+    async def quit(self):
+        try:
+            await self.docmd('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class AsyncSMTP(object):
+    """
+    The asyncio counterpart of SMTP. It accepts the same configuration and compiles messages
+    with Email.get_payload, but keeps up to `max_connections` sessions open so concurrent
+    sends on one event loop do not queue behind each other.
+
+    async with AsyncSMTP(...) as smtp:
+        await asyncio.gather(*[smtp.send(email) for email in emails])
+    """
+    def __init__(
+        self, host, port, username=None, password=None, ssl=False, tls=False,
+        timeout=None, tls_version=None, tls_context_handler=None,
+        max_recipients=MAX_RECIPIENTS, max_connections=10, local_hostname=None
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        self.tls = tls
+        self.tls_version = tls_version
+        self.tls_context_handler = tls_context_handler
+        self.timeout = timeout
+        self.max_recipients = max_recipients
+        self.max_connections = max_connections
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.tls_context = None
+        self._idle = []
+        self._open = 0
+        self._condition = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def get_tls_context(self):
+        """
+        Return the SSLContext for SSL and STARTTLS connections, built once and shared by all
+        the connections
+        """
+        if self.tls_context is None:
+            self.tls_context = create_tls_context(self.tls_version, self.tls_context_handler)
+        return self.tls_context
+
+    def _get_condition(self):
+        # created lazily so it binds to the running loop rather than the constructing one
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _connect(self):
+        connection = AsyncSMTPConnection(self)
+        await connection.connect()
+        try:
+            if self.username and self.password:
+                await connection.login(self.username, self.password)
+        except Exception:
+            await connection.quit()
+            raise
+        return connection
+
+    async def login(self):
+        """
+        Open and authenticate the first connection, so configuration errors surface early
+        """
+        connection = await self.acquire()
+        await self.release(connection)
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            while not self._idle and self._open >= self.max_connections:
+                await condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        try:
+            return await self._connect()
+        except BaseException:
+            async with condition:
+                self._open -= 1
+                condition.notify()
+            raise
+
+    async def release(self, connection):
+        condition = self._get_condition()
+        async with condition:
+            if connection.writer is None:
+                self._open -= 1
+            else:
+                self._idle.append(connection)
+            condition.notify()
+
+    async def send_envelope(self, sender, recipients, payload, mail_options=()):
+        """
+        Send a payload to a list of recipients over one of the connections, splitting the
+        recipients in transactions of at most max_recipients.
+        :return: {recipient: (code, response)} for every recipient
+        """
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        connection = await self.acquire()
+        try:
+            chunk_size = self.max_recipients or len(recipients) or 1
+            results = {}
+            for i in range(0, len(recipients), chunk_size):
+                results.update(await connection.send_transaction(
+                    sender, recipients[i:i + chunk_size], payload, mail_options))
+        except BaseException:
+            # a transaction interrupted half way (including by cancellation) leaves the
+            # session in an unknown state: it is never reused
+            connection.close()
+            raise
+        finally:
+            await self.release(connection)
+        return results
+
+    async def send(self, email):
+        """
+        Send an Email
+        :return: dict of refused recipients, as SMTP.send does
+        """
+        results = await self.send_envelope(email.sender, email.get_envelope_recipients(),
+                                           email.get_payload())
+        return get_refused_recipients(results)
+
+    async def send_many(self, emails):
+        """
+        Send several Emails concurrently.
+        :return: a list with a {recipient: (code, response)} dict per email, in order
+        """
+        return await asyncio.gather(*[
+            self.send_envelope(email.sender, email.get_envelope_recipients(), email.get_payload())
+            for email in emails
+        ])
+
+    async def close(self):
+        """
+        Close all idle connections
+        """
+        condition = self._get_condition()
+        async with condition:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            condition.notify_all()
+        await asyncio.gather(*[connection.quit() for connection in idle])
@@ -0,0 +1,134 @@
+"""
+A process wide cache of encoded attachment and embedded image parts, so a file sent with
+many emails is only read, typed and encoded once.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from strudelpy.streaming import iter_file_chunks
+
+__all__ = ['PartCache', 'default_part_cache']
+
+
+class CachedPart(object):
+    """
+    The headers and encoded payload of a leaf MIME part
+    """
+    def __init__(self, headers, payload):
+        self.headers = headers
+        self.payload = payload
+        self.size = len(payload) + sum(len(name) + len(value) for name, value in headers)
+
+    def get_part(self):
+        """
+        Build a new part around the cached payload. The payload string is shared, not copied.
+        :return: email.message.Message object
+        """
+        from email.message import Message
+        part = Message()
+        for name, value in self.headers:
+            part[name] = value
+        part.set_payload(self.payload)
+        return part
+
+
+class PartCache(object):
+    """
+    An LRU cache of encoded MIME parts bounded by the total size of the cached payloads.
+    Entries are keyed by the file path, modification time and size, or by a hash of the file
+    content when key_by_content is set (which still reads the file, but skips typing and
+    encoding it, and shares entries between copies of a file at different paths).
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, key_by_content=False):
+        """
+        :param max_bytes: maximum total size of cached parts
+        :param key_by_content: key entries by a SHA-1 of the file content instead of its stat
+        """
+        self.max_bytes = max_bytes
+        self.key_by_content = key_by_content
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'bytes': 0,
+            'entries': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_key(self, path, kind):
+        """
+        :param path: path to the file
+        :param kind: the kind of part built from the file, e.g. 'attachment' or 'embedded'
+        :return: hashable key for the part built from this file
+        """
+        if self.key_by_content:
+            import hashlib
+            digest = hashlib.sha1()
+            for chunk in iter_file_chunks(path):
+                digest.update(chunk)
+            return kind, os.path.basename(path), digest.hexdigest()
+        stat = os.stat(path)
+        return kind, path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """
+        :return: the CachedPart stored under key, or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return entry
+
+    def set(self, key, entry):
+        """
+        Store a CachedPart, evicting the least recently used entries to stay within max_bytes.
+        Parts larger than max_bytes are not cached.
+        """
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.stats['bytes'] -= previous.size
+            self._entries[key] = entry
+            self.stats['bytes'] += entry.size
+            while self.stats['bytes'] > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.stats['bytes'] -= evicted.size
+                self.stats['evictions'] += 1
+            self.stats['entries'] = len(self._entries)
+
+    def get_part(self, path, kind, builder):
+        """
+        Return the part for a file from the cache, building and caching it on a miss.
+        :param path: path to the file
+        :param kind: the kind of part, so different parts built from one file don't collide
+        :param builder: function receiving the path and returning the encoded MIME part
+        :return: email.message.Message object
+        """
+        key = self.get_key(path, kind)
+        entry = self.get(key)
+        if entry is not None:
+            return entry.get_part()
+        part = builder(path)
+        self.set(key, CachedPart(part.items(), part.get_payload()))
+        return part
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats['bytes'] = 0
+            self.stats['entries'] = 0
+
+
+default_part_cache = PartCache()
@@ -0,0 +1,129 @@
+"""
+A process wide cache of what each SMTP server supports, so later sessions with a server skip
+the negotiation steps whose outcome is already known: the EHLO a server refuses, and the
+auth mechanisms it refuses.
+"""
+
+import json
+import os
+import threading
+import time
+
+__all__ = ['CapabilityCache', 'default_capability_cache']
+
+# auth values which are not SASL mechanisms: the raw AUTH LOGIN fallback of SMTP.login, and
+# servers which don't take authentication at all
+AUTH_FALLBACK = 'fallback'
+AUTH_NONE = 'none'
+
+
+class CapabilityCache(object):
+    """
+    Remembers, by host, port and TLS mode, whether a server speaks ESMTP and the
+    authentication which worked with it. Extensions are not kept: every session greets the
+    server, and reads them from its reply.
+    Entries expire after max_age seconds. With a path, entries are also saved to a JSON file,
+    shared by processes and restarts.
+    """
+    def __init__(self, path=None, max_age=24 * 3600, clock=time.time):
+        """
+        :param path: JSON file to load the entries from and save them to, or None
+        :param max_age: seconds an entry is trusted for
+        :param clock: function returning the current time in seconds
+        """
+        self.path = path
+        self.max_age = max_age
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'fallbacks': 0,
+            'helo_skipped': 0,
+            'auth_skipped': 0,
+        }
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(host, port, mode):
+        """
+        :param mode: 'ssl', 'starttls' or 'plain'
+        """
+        return '{0}:{1}:{2}'.format(host, port, mode)
+
+    def get(self, key):
+        """
+        :return: copy of the entry for key ({'esmtp', 'auth', 'updated'}),
+                 or None if there is none or it expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry['updated'] > self.max_age:
+                del self._entries[key]
+                entry = None
+            self.stats['hits' if entry is not None else 'misses'] += 1
+            return dict(entry) if entry is not None else None
+
+    def update(self, key, **values):
+        """
+        Record what was learned about a server. Saved to disk if anything changed
+        """
+        with self._lock:
+            entry = self._entries.get(key) or {'esmtp': None, 'auth': None}
+            changed = any(entry.get(name) != value for name, value in values.items())
+            entry.update(values)
+            entry['updated'] = self.clock()
+            self._entries[key] = entry
+        if changed and self.path:
+            self.save()
+
+    def record_ehlo(self, key, client):
+        """
+        Record whether the server greeted by an smtplib client speaks ESMTP
+        """
+        self.update(key, esmtp=bool(client.does_esmtp))
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.path:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            self.save()
+
+    def load(self):
+        with open(self.path) as cache_file:
+            try:
+                entries = json.load(cache_file)
+            except ValueError:
+                # a corrupt file is only a cold cache
+                entries = {}
+        with self._lock:
+            self._entries.update(entries)
+
+    def save(self):
+        """
+        Write the entries to path, atomically
+        """
+        with self._lock:
+            data = json.dumps(self._entries, sort_keys=True)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(self.path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as cache_file:
+            cache_file.write(data)
+        os.rename(tmp_path, self.path)
+
+
+default_capability_cache = CapabilityCache()
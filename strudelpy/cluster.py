@@ -0,0 +1,274 @@
+"""
+Load balancing and failover across several SMTP relays.
+
+cluster = SMTPCluster([SMTP('relay1.example.com', 587, 'me', 'secret', tls=True),
+                       (SMTP('relay2.example.com', 587, 'me', 'secret', tls=True), 2)],
+                      strategy='least_outstanding')
+with cluster:
+    cluster.send(email)
+
+Every relay has its own SMTPPool. Sends go to the relay with the least outstanding work (its
+sends in flight times its average latency, relative to its weight) or by weighted round robin.
+Relays whose latency or error rate degrade are taken out of rotation, and a transaction which
+fails with a connection error or a temporary failure is retried on another relay.
+"""
+
+import smtplib
+import threading
+import time
+
+from strudelpy.pool import SMTPPool, is_connection_error
+
+__all__ = ['SMTPCluster', 'Relay']
+
+_now = getattr(time, 'monotonic', time.time)
+
+STRATEGIES = ('least_outstanding', 'weighted')
+
+
+def is_retryable(error):
+    """
+    :return: True if a send which raised error may succeed on another relay: the connection
+             failed, or the relay answered with a temporary (4xx) failure
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return bool(error.recipients) and all(400 <= reply[0] < 500 for reply in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return is_connection_error(error)
+
+
+class Relay(object):
+    """
+    One relay of a cluster: its connection pool, weight and health
+    """
+    def __init__(self, smtp, weight=1, **pool_options):
+        """
+        :param smtp: SMTP instance describing the relay
+        :param weight: share of the sends this relay gets relative to the others
+        :param pool_options: SMTPPool options (size, max_messages, idle_timeout...)
+        """
+        if weight <= 0:
+            raise ValueError('Relay weight must be positive')
+        self.smtp = smtp
+        self.name = '{0}:{1}'.format(smtp.host, smtp.port)
+        self.weight = weight
+        self.pool = SMTPPool(smtp, **pool_options)
+        self.outstanding = 0
+        # exponentially weighted moving averages of the send latency and of failures (0 or 1)
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        # weighted round robin state
+        self.current_weight = 0
+        self.ejected_until = None
+        self.ejections = 0
+        self.probing = False
+        self.stats = {
+            'sends': 0,
+            'failures': 0,
+            'ejections': 0,
+            'probes': 0,
+        }
+
+    @property
+    def healthy(self):
+        return self.ejected_until is None
+
+    def get_state(self, now):
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'ejected_for': max(0, self.ejected_until - now) if self.ejected_until is not None else 0,
+            'stats': dict(self.stats),
+        }
+
+
+class SMTPCluster(object):
+    """
+    Spread sends over several SMTP relays, with health tracking and failover.
+
+    A relay is ejected when the moving average of its error rate exceeds max_error_rate, or
+    its latency exceeds max_latency. Once its ejection time is over, a connection is opened
+    and checked with NOOP (a probe): if it succeeds the relay is back in rotation, otherwise it
+    is ejected again for twice as long (up to max_ejection_time).
+    """
+    def __init__(self, relays, strategy='least_outstanding', max_attempts=2, ewma_alpha=0.3,
+                 max_error_rate=0.5, max_latency=None, min_samples=5, ejection_time=30,
+                 max_ejection_time=300, clock=_now, **pool_options):
+        """
+        :param relays: list of SMTP instances, or (SMTP, weight) pairs
+        :param strategy: 'least_outstanding' or 'weighted' (smooth weighted round robin)
+        :param max_attempts: number of relays a send is tried on
+        :param ewma_alpha: weight of the latest send in the latency and error rate averages
+        :param max_error_rate: eject relays whose error rate average exceeds this
+        :param max_latency: eject relays whose latency average exceeds this many seconds
+        :param min_samples: sends a relay must have made before it can be ejected
+        :param ejection_time: seconds a relay is first ejected for
+        :param max_ejection_time: longest ejection of a relay which keeps failing its probes
+        :param pool_options: options of the SMTPPool of every relay (size, max_messages...)
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy {0}, use one of {1}'.format(strategy, ', '.join(STRATEGIES)))
+        if not relays:
+            raise ValueError('A cluster needs at least one relay')
+        self.relays = []
+        for relay in relays:
+            smtp, weight = relay if isinstance(relay, (tuple, list)) else (relay, 1)
+            self.relays.append(Relay(smtp, weight, **pool_options))
+        self.strategy = strategy
+        self.max_attempts = max_attempts
+        self.ewma_alpha = ewma_alpha
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.min_samples = min_samples
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def choose(self, exclude=()):
+        """
+        Pick the relay for the next attempt of a send
+        :param exclude: relays already tried for this send
+        :return: a Relay, or None if every relay was tried
+        """
+        now = self.clock()
+        with self._lock:
+            candidates = [r for r in self.relays if r not in exclude]
+            if not candidates:
+                return None
+            healthy = [r for r in candidates if r.healthy]
+            due = [r for r in candidates if not r.healthy and not r.probing and r.ejected_until <= now]
+            for relay in due:
+                relay.probing = True
+        for relay in due:
+            if self.probe(relay):
+                healthy.append(relay)
+        with self._lock:
+            if not healthy:
+                # every relay left is ejected: try the one due back soonest rather than failing
+                return min(candidates, key=lambda r: r.ejected_until)
+            if self.strategy == 'weighted':
+                total = sum(r.weight for r in healthy)
+                for relay in healthy:
+                    relay.current_weight += relay.weight
+                relay = max(healthy, key=lambda r: r.current_weight)
+                relay.current_weight -= total
+                return relay
+            # the least outstanding work: sends in flight times their expected latency. Relays
+            # without a latency sample yet score 0, so they get one
+            return min(healthy, key=lambda r: ((r.outstanding + 1.0) * (r.latency or 0) / r.weight,
+                                               (r.outstanding + 1.0) / r.weight))
+
+    def probe(self, relay):
+        """
+        Check an ejected relay with a fresh connection and a NOOP, putting it back in rotation
+        if it answers
+        :return: True if the relay is healthy again
+        """
+        relay.stats['probes'] += 1
+        try:
+            connection = relay.pool.acquire()
+        except Exception:
+            healthy = False
+        else:
+            healthy = connection.is_alive()
+            if healthy:
+                relay.pool.release(connection)
+            else:
+                relay.pool.discard(connection)
+        with self._lock:
+            relay.probing = False
+            if healthy:
+                relay.ejected_until = None
+                relay.error_rate = 0.0
+                relay.latency = None
+                relay.samples = 0
+            else:
+                self.eject(relay)
+        return healthy
+
+    def eject(self, relay):
+        """
+        Take a relay out of rotation, for longer every time it is ejected again without having
+        recovered in between. Called with the lock held
+        """
+        relay.ejections += 1
+        relay.stats['ejections'] += 1
+        duration = min(self.max_ejection_time, self.ejection_time * 2 ** (relay.ejections - 1))
+        relay.ejected_until = self.clock() + duration
+
+    def record(self, relay, seconds, failed):
+        """
+        Update the health of a relay with the outcome of a send
+        """
+        alpha = self.ewma_alpha
+        with self._lock:
+            relay.outstanding -= 1
+            relay.samples += 1
+            relay.stats['sends'] += 1
+            relay.error_rate = alpha * (1.0 if failed else 0.0) + (1 - alpha) * relay.error_rate
+            if failed:
+                relay.stats['failures'] += 1
+            else:
+                relay.latency = seconds if relay.latency is None else alpha * seconds + (1 - alpha) * relay.latency
+            if not relay.healthy or relay.samples < self.min_samples:
+                return
+            if relay.error_rate > self.max_error_rate or \
+                    (self.max_latency is not None and relay.latency is not None and relay.latency > self.max_latency):
+                self.eject(relay)
+            elif not failed:
+                relay.ejections = 0
+
+    def send(self, email):
+        """
+        Send an Email through the cluster. A send failing with a connection error or a
+        temporary failure is retried on another relay, up to max_attempts relays.
+        :return: the refused recipients dict returned by SMTP.send
+        """
+        tried = []
+        error = None
+        while len(tried) < self.max_attempts:
+            relay = self.choose(tried)
+            if relay is None:
+                break
+            tried.append(relay)
+            with self._lock:
+                relay.outstanding += 1
+            start = self.clock()
+            try:
+                refused = relay.pool.send(email)
+            except Exception as e:
+                retryable = is_retryable(e)
+                # a permanent refusal is about the message, not the relay
+                self.record(relay, self.clock() - start, failed=retryable)
+                if not retryable:
+                    raise
+                error = e
+                continue
+            self.record(relay, self.clock() - start, failed=False)
+            return refused
+        raise error or smtplib.SMTPException('No relay available')
+
+    def get_state(self):
+        """
+        :return: list with the health, load and counters of every relay
+        """
+        now = self.clock()
+        with self._lock:
+            return [relay.get_state(now) for relay in self.relays]
+
+    def close(self):
+        for relay in self.relays:
+            relay.pool.close()
@@ -0,0 +1,201 @@
+"""
+Coalescing of emails which only differ by their recipients into multi-recipient transactions.
+
+coalescer = Coalescer(max_recipients=100)
+with smtp:
+    results = coalescer.send(smtp, emails)
+
+Notifications sent as one Email per user compile to the same message but for their To, Cc,
+Date and Message-ID headers. Such emails are merged: the message is transferred once per
+transaction, to up to max_recipients recipients of one domain, instead of once per email.
+Every email still gets a result per recipient, as SMTP.send_many() returns.
+"""
+
+import re
+
+__all__ = ['Coalescer', 'VARYING_HEADERS']
+
+# headers which may differ between the emails merged into one transaction
+VARYING_HEADERS = (b'to', b'cc', b'bcc', b'date', b'message-id', b'dkim-signature')
+# the headers naming the recipients: rewritten when they differ between merged emails
+RECIPIENT_HEADERS = (b'to', b'cc', b'bcc')
+
+FIELD_END = re.compile(b'\r?\n(?![ \t])')
+HEADER_END = re.compile(b'\r?\n\r?\n')
+BOUNDARY = re.compile(b'^content-type:(?:[^\r\n]|\r?\n[ \t])*?boundary="?([^"\\s;]+)', re.I | re.M)
+
+
+def split_message(payload):
+    """
+    :return: (list of (lowercase name, field) of the header section, the rest of the message
+             from the empty line ending the headers)
+    """
+    match = HEADER_END.search(payload)
+    end = match.start() if match else len(payload)
+    fields = [(field.split(b':', 1)[0].strip().lower(), field) for field in FIELD_END.split(payload[:end])]
+    return fields, payload[end:]
+
+
+def normalise_boundaries(data):
+    """
+    Replace the MIME boundaries of a message by their rank, so messages which only differ by
+    their (random) boundaries compare equal
+    """
+    boundaries = []
+    for boundary in BOUNDARY.findall(data):
+        if boundary not in boundaries:
+            boundaries.append(boundary)
+    for index, boundary in enumerate(boundaries):
+        data = data.replace(boundary, b'\0boundary' + str(index).encode('ascii'))
+    return data
+
+
+def get_domain(address):
+    return address.rpartition('@')[2].lower()
+
+
+class Group(object):
+    """
+    Emails sharing a message: the payload of the first one, and the recipients of all of them
+    """
+    def __init__(self, email, sender, payload, mail_options, fields, rest):
+        self.email = email
+        self.sender = sender
+        self.payload = payload
+        self.mail_options = mail_options
+        self.fields = fields
+        self.rest = rest
+        self.recipient_fields = self.get_recipient_fields(fields)
+        self.mixed = False
+        self.members = []
+        self.recipients = []
+        # the bytes the emails of the group would take sent one by one
+        self.size = 0
+
+    @staticmethod
+    def get_recipient_fields(fields):
+        return [field for name, field in fields if name in RECIPIENT_HEADERS]
+
+    def add(self, index, recipients, payload, fields):
+        self.members.append(index)
+        self.size += len(payload)
+        seen = set(self.recipients)
+        self.recipients.extend(r for r in recipients if r not in seen and not seen.add(r))
+        if not self.mixed and self.get_recipient_fields(fields) != self.recipient_fields:
+            self.mixed = True
+
+
+class Coalescer(object):
+    """
+    Merges emails whose messages are identical but for their recipient, date and id headers
+    into as few transactions as possible.
+    """
+    def __init__(self, max_recipients=100, group_by_domain=True, undisclosed='undisclosed-recipients:;'):
+        """
+        :param max_recipients: maximum number of recipients of a transaction
+        :param group_by_domain: only put recipients of the same domain in a transaction
+        :param undisclosed: value of the To header of merged emails whose recipient headers
+                            differ, so no recipient sees the others' addresses. Their Cc and Bcc
+                            headers are dropped
+        """
+        self.max_recipients = max_recipients
+        self.group_by_domain = group_by_domain
+        self.undisclosed = undisclosed
+        self.stats = {
+            'messages': 0,
+            'transactions': 0,
+            'bytes_sent': 0,
+            'bytes_saved': 0,
+        }
+
+    def group(self, emails, get_payload):
+        """
+        Group emails by their message, without the headers which may differ and whatever
+        their MIME boundaries
+        :param emails: list of Email objects
+        :param get_payload: function returning (payload bytes, mail options) for an email
+        :return: list of Group, in the order of their first email
+        """
+        groups = {}
+        ordered = []
+        for index, email in enumerate(emails):
+            payload, mail_options = get_payload(email)
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            fields, rest = split_message(payload)
+            key = (email.sender, tuple(mail_options), normalise_boundaries(
+                b'\r\n'.join(field for name, field in fields if name not in VARYING_HEADERS) + rest))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = Group(email, email.sender, payload, mail_options, fields, rest)
+                ordered.append(group)
+            group.add(index, email.get_envelope_recipients(), payload, fields)
+            self.stats['messages'] += 1
+        return ordered
+
+    def get_payload(self, group):
+        """
+        :return: the message sent to the recipients of a group: the message of its first email,
+                 with an undisclosed recipients To header if the emails had different ones
+        """
+        if not group.mixed:
+            return group.payload
+        fields = []
+        undisclosed = b'To: ' + self.undisclosed.encode('ascii')
+        for name, field in group.fields:
+            if name in RECIPIENT_HEADERS:
+                # in place of the first recipient header
+                if undisclosed not in fields:
+                    fields.append(undisclosed)
+            elif name != b'dkim-signature':
+                fields.append(field)
+        payload = b'\r\n'.join(fields) + group.rest
+        # the signature of the first email covered its own recipient headers
+        sign = getattr(group.email, 'sign', None)
+        return sign(payload) if sign is not None else payload
+
+    def get_transactions(self, recipients):
+        """
+        Split recipients into transactions of up to max_recipients, each of a single domain
+        when group_by_domain is set
+        :return: list of recipient lists
+        """
+        batches = [recipients]
+        if self.group_by_domain:
+            domains = {}
+            batches = []
+            for recipient in recipients:
+                batch = domains.get(get_domain(recipient))
+                if batch is None:
+                    batch = domains[get_domain(recipient)] = []
+                    batches.append(batch)
+                batch.append(recipient)
+        size = self.max_recipients or max(len(recipients), 1)
+        return [batch[i:i + size] for batch in batches for i in range(0, len(batch), size)]
+
+    def send(self, smtp, emails):
+        """
+        Send emails through a connected SMTP, merged into as few transactions as possible
+        :param smtp: SMTP instance, logged in
+        :param emails: an iterable of Email objects
+        :return: a list with a {recipient: (code, response)} dict per email, in order
+        """
+        emails = list(emails)
+        results = [None] * len(emails)
+        for group in self.group(emails, smtp.get_payload):
+            payload = self.get_payload(group)
+            replies = smtp.check_size(group.email, group.recipients, len(payload))
+            transactions = self.get_transactions(group.recipients) if replies is None else []
+            replies = replies or {}
+            for recipients in transactions:
+                with smtp.hooks.timed('send', host=smtp.host, port=smtp.port, recipients=len(recipients),
+                                      bytes=len(payload)):
+                    replies.update(smtp.rate_limited(recipients, smtp.send_envelope, group.sender, recipients,
+                                                     payload, group.mail_options))
+            self.stats['transactions'] += len(transactions)
+            self.stats['bytes_sent'] += len(payload) * len(transactions)
+            self.stats['bytes_saved'] += group.size - len(payload) * len(transactions)
+            for index in group.members:
+                results[index] = dict((recipient, replies[recipient])
+                                      for recipient in emails[index].get_envelope_recipients())
+        return results
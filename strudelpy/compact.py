@@ -0,0 +1,158 @@
+"""
+A memory-lean, already serialised form of an Email for keeping large backlogs in memory.
+
+queue = [email.compact() for email in emails]
+...
+smtp.send(queue.pop())
+
+A CompactEmail holds its envelope and its payload as a tuple of byte segments, and nothing
+else: no MIME tree, no per-object __dict__. Large segments (attachment and embedded image
+parts) are interned in a SegmentTable, so a file attached to many queued emails is kept once.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+from strudelpy.streaming import PayloadStream
+
+__all__ = ['CompactEmail', 'SegmentTable', 'default_segment_table']
+
+_intern = getattr(sys, 'intern', None) or intern  # noqa: F821
+
+
+class SegmentTable(object):
+    """
+    Interns payload segments so equal segments share one bytes object. Bounded LRU: segments
+    evicted from the table stay alive as long as an email references them, they are just no
+    longer shared with emails compacted afterwards.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, min_size=1024):
+        """
+        :param max_bytes: maximum total size of the interned segments
+        :param min_size: segments smaller than this are not worth interning
+        """
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes': 0,
+        }
+
+    def __len__(self):
+        return len(self._segments)
+
+    def intern(self, segment):
+        """
+        :return: the interned bytes object equal to segment
+        """
+        if len(segment) < self.min_size or len(segment) > self.max_bytes:
+            return segment
+        with self._lock:
+            interned = self._segments.pop(segment, None)
+            if interned is not None:
+                self._segments[interned] = interned
+                self.stats['hits'] += 1
+                return interned
+            self._segments[segment] = segment
+            self.stats['misses'] += 1
+            self.stats['bytes'] += len(segment)
+            while self.stats['bytes'] > self.max_bytes:
+                evicted, _ = self._segments.popitem(last=False)
+                self.stats['bytes'] -= len(evicted)
+            return segment
+
+    def clear(self):
+        with self._lock:
+            self._segments.clear()
+            self.stats['bytes'] = 0
+
+
+default_segment_table = SegmentTable()
+
+
+class CompactEmail(object):
+    """
+    A serialised email with just enough of the Email interface to be sent by SMTP, SMTPPool,
+    Dispatcher and Spool. The payload is compiled without 8BITMIME or SMTPUTF8, so it can be
+    sent to any server.
+    """
+    __slots__ = ('sender', 'recipients', 'segments')
+
+    def __init__(self, sender, recipients, segments):
+        """
+        :param sender: envelope sender address
+        :param recipients: envelope recipient addresses
+        :param segments: the payload as a sequence of bytes
+        """
+        self.sender = _intern(sender) if isinstance(sender, str) else sender
+        self.recipients = tuple(_intern(r) if isinstance(r, str) else r for r in recipients)
+        self.segments = tuple(segments)
+
+    @classmethod
+    def from_email(cls, email, segment_table=default_segment_table):
+        """
+        Serialise an Email, splitting its attachment parts into interned segments
+        :param email: Email object
+        :param segment_table: SegmentTable to intern the segments in, or None
+        :return: CompactEmail
+        """
+        payload = email.get_payload_bytes()
+        segments = [payload]
+        message = getattr(email, 'message', None)
+        if segment_table is not None and message is not None and message.is_multipart() \
+                and isinstance(payload, bytes) and not isinstance(payload, str):
+            from strudelpy.generator import serialise_part
+            segments = []
+            position = 0
+            # the first part holds the bodies, the rest are attachments and embedded images
+            for part in message.get_payload()[1:]:
+                data = serialise_part(part)
+                start = payload.find(data, position)
+                if start < 0:
+                    continue
+                segments.append(payload[position:start])
+                segments.append(segment_table.intern(data))
+                position = start + len(data)
+            segments.append(payload[position:])
+        return cls(email.sender, email.get_envelope_recipients(), segments)
+
+    def get_envelope_recipients(self):
+        return list(self.recipients)
+
+    def has_non_ascii_headers(self):
+        """
+        :return: True if the envelope addresses need SMTPUTF8
+        """
+        for address in (self.sender,) + self.recipients:
+            if any(ord(char) > 127 for char in address):
+                return True
+        return False
+
+    def get_payload_bytes(self, eight_bit=False, smtputf8=False):
+        return b''.join(self.segments)
+
+    def estimate_size(self, eight_bit=False, smtputf8=False):
+        """
+        :return: the exact size of the serialised message
+        """
+        return sum(len(segment) for segment in self.segments)
+
+    def get_payload(self):
+        payload = self.get_payload_bytes()
+        if isinstance(payload, str):
+            return payload
+        return payload.decode('ascii', 'surrogateescape')
+
+    def get_payload_stream(self, chunk_size=None, eight_bit=False, smtputf8=False):
+        """
+        :return: PayloadStream over the segments, so SMTP.send_stream writes them without
+                 joining them first
+        """
+        return PayloadStream(list(self.segments))
+
+    def get_size(self):
+        return sum(len(segment) for segment in self.segments)
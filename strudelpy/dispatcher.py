@@ -0,0 +1,220 @@
+"""
+Send emails from a pool of worker threads, each holding its own SMTP session.
+
+with Dispatcher(smtp, workers=8, queue_size=1000) as dispatcher:
+    futures = [dispatcher.submit(email) for email in emails]
+    results = [future.result() for future in futures]
+
+submit() blocks when the queue is full, so producers can't run ahead of the senders.
+"""
+
+import smtplib
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from six.moves import queue
+
+from strudelpy.pool import is_connection_error
+
+__all__ = ['Dispatcher']
+
+# errors which mean the session can no longer be trusted
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+def compile_email(email):
+    """
+    Serialise an Email, in a worker process when the dispatcher uses compile_processes
+    :return: (sender, envelope recipients, payload bytes)
+    """
+    return email.sender, email.get_envelope_recipients(), email.get_payload_bytes()
+
+
+class Job(object):
+    """
+    An email waiting to be sent, with the future its result is delivered to
+    """
+    def __init__(self, future, email, smtp, compiled=None):
+        self.future = future
+        self.email = email
+        self.smtp = smtp
+        self.compiled = compiled
+
+
+class Dispatcher(object):
+    """
+    Accepts Email objects into a bounded queue and sends them with `workers` threads.
+    Every worker keeps one SMTP session open, cloned from the SMTP configuration the email
+    was submitted with. At most `max_connections_per_host` sessions are open to any one
+    host:port at a time.
+
+    With compile_processes, messages are compiled in a process pool as soon as they are
+    submitted, so compilation of large messages doesn't contend with the sending threads.
+    """
+    def __init__(self, smtp, workers=4, queue_size=1000, max_connections_per_host=None,
+                 compile_processes=0):
+        """
+        :param smtp: the default SMTP configuration emails are sent with
+        :param workers: number of sending threads
+        :param queue_size: maximum number of emails waiting to be sent
+        :param max_connections_per_host: limit of sessions open to a single host:port
+        :param compile_processes: number of processes to compile messages in (0 to compile
+                                  in the sending threads)
+        """
+        self.smtp = smtp
+        self.max_connections_per_host = max_connections_per_host or workers
+        self.queue_size = queue_size
+        self._pending = deque()
+        # sessions held by workers, per (host, port)
+        self._sessions = {}
+        self._condition = threading.Condition()
+        self._compiler = ProcessPoolExecutor(compile_processes) if compile_processes else None
+        self.closed = False
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='strudelpy-dispatcher-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, email, smtp=None, block=True, timeout=None):
+        """
+        Queue an Email to be sent.
+        Blocks while the queue is full, unless block is False or the timeout expires, in
+        which case queue.Full is raised.
+        :param email: the Email to send
+        :param smtp: SMTP configuration to send this email with, instead of the default one
+        :return: a Future resolving to the refused recipients dict returned by SMTP.send
+        """
+        deadline = None if timeout is None else _now() + timeout
+        with self._condition:
+            while len(self._pending) >= self.queue_size and not self.closed:
+                remaining = None if deadline is None else deadline - _now()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full()
+                self._condition.wait(remaining)
+            if self.closed:
+                raise RuntimeError('Dispatcher is closed')
+            future = Future()
+            compiled = self._compiler.submit(compile_email, email) if self._compiler else None
+            self._pending.append(Job(future, email, smtp or self.smtp, compiled))
+            self._condition.notify_all()
+        return future
+
+    def send(self, email, smtp=None):
+        """
+        Send an Email through the dispatcher and wait for the result
+        """
+        return self.submit(email, smtp).result()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _next_job(self, current_host):
+        """
+        Wait for a job this worker may send: one for the host it already has a session with,
+        or for a host with fewer than max_connections_per_host sessions open.
+        Must be called holding the condition.
+        :return: Job, or None once the dispatcher is closed and the queue drained
+        """
+        while True:
+            for job in self._pending:
+                host = (job.smtp.host, job.smtp.port)
+                if host == current_host or self._sessions.get(host, 0) < self.max_connections_per_host:
+                    self._pending.remove(job)
+                    if host != current_host:
+                        if current_host is not None:
+                            self._sessions[current_host] -= 1
+                        self._sessions[host] = self._sessions.get(host, 0) + 1
+                    self._condition.notify_all()
+                    return job
+            if self.closed and not self._pending:
+                return None
+            self._condition.wait()
+
+    def _send(self, session, job):
+        if job.compiled is None:
+            return session.send(job.email)
+        sender, recipients, payload = job.compiled.result()
+        return session.send_compiled(sender, recipients, payload)
+
+    def _work(self):
+        session = session_config = None
+        current_host = None
+        try:
+            while True:
+                with self._condition:
+                    job = self._next_job(current_host)
+                if job is None:
+                    break
+                host = (job.smtp.host, job.smtp.port)
+                if session is not None and (host != current_host or session_config is not job.smtp):
+                    self._close_session(session)
+                    session = None
+                current_host = host
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                for attempt in (0, 1):
+                    try:
+                        if session is None:
+                            session_config = job.smtp
+                            session = job.smtp.clone()
+                            try:
+                                session.login()
+                            except Exception:
+                                # a session which failed to log in is never reused
+                                self._close_session(session)
+                                session = None
+                                raise
+                        job.future.set_result(self._send(session, job))
+                    except Exception as e:
+                        # refusals are the server's answer: only a lost session is retried
+                        if is_connection_error(e):
+                            self._close_session(session)
+                            session = None
+                            if not attempt:
+                                continue
+                        job.future.set_exception(e)
+                    break
+        finally:
+            self._close_session(session)
+            with self._condition:
+                if current_host is not None:
+                    self._sessions[current_host] -= 1
+                self._condition.notify_all()
+
+    def _close_session(self, session):
+        if session is None or session.client is None:
+            return
+        try:
+            session.close()
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            session.client.close()
+        session.client = None
+
+    def close(self, wait=True):
+        """
+        Stop accepting emails and stop the workers once the queue is drained
+        :param wait: block until all queued emails are sent
+        """
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        if self._compiler:
+            self._compiler.shutdown(wait=wait)
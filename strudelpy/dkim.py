@@ -0,0 +1,300 @@
+"""
+DKIM signing of serialised emails (RFC 6376, rsa-sha256).
+
+Email.dkim_signer = DKIMSigner('example.com', 'mail2024', open('/etc/dkim/mail2024.pem').read())
+
+Every payload is then signed when it is serialised, with the cryptography package (pip install
+strudelpy[dkim]). Private keys are parsed once per domain and selector, and the body hash (bh=)
+is memoized by body: MIME boundaries are derived from the content, so the emails of a mail
+merge, or an Email re-sent with other recipients, only have their headers hashed and signed.
+"""
+
+import base64
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+except ImportError:  # the dkim extra: pip install strudelpy[dkim]
+    serialization = None
+
+__all__ = ['DKIMSigner', 'load_private_key', 'DEFAULT_SIGNED_HEADERS']
+
+# the headers signed when they are present, as recommended by RFC 6376 5.4.1
+DEFAULT_SIGNED_HEADERS = ('From', 'Sender', 'Reply-To', 'Subject', 'Date', 'Message-ID', 'To', 'Cc',
+                          'MIME-Version', 'Content-Type', 'Content-Transfer-Encoding', 'In-Reply-To',
+                          'References', 'List-Id', 'List-Unsubscribe')
+
+CANONICALIZATIONS = ('simple', 'relaxed')
+
+CRLF = b'\r\n'
+LINE_END = re.compile(b'\r?\n')
+TRAILING_WSP = re.compile(b'[ \t]+\r\n')
+WSP = re.compile(b'[ \t]+')
+FIELD_END = re.compile(b'\r?\n(?![ \t])')
+HEADER_END = re.compile(b'\r?\n\r?\n')
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def load_private_key(domain, selector, pem):
+    """
+    Parse a private key, once per domain and selector: later calls with the same key return
+    the parsed key. A different key for the same domain and selector replaces it.
+    :param pem: an unencrypted PEM encoded RSA private key (PKCS #1 or PKCS #8), as text or bytes
+    :return: cryptography RSAPrivateKey
+    """
+    if serialization is None:
+        raise ImportError('DKIM signing requires the cryptography package: pip install strudelpy[dkim]')
+    cache_key = (domain.lower(), selector)
+    with _keys_lock:
+        cached = _keys.get(cache_key)
+        if cached is not None and cached[0] == pem:
+            return cached[1]
+    key = serialization.load_pem_private_key(pem if isinstance(pem, bytes) else pem.encode('ascii'), None)
+    if not isinstance(key, rsa.RSAPrivateKey):
+        raise ValueError('Expected an RSA private key')
+    with _keys_lock:
+        _keys[cache_key] = (pem, key)
+    return key
+
+
+class BodyHasher(object):
+    """
+    Incrementally canonicalize and hash a message body. Data is processed by whole lines, and
+    trailing empty lines are held back until a non empty line follows them.
+    """
+    def __init__(self, canonicalization='relaxed'):
+        self.relaxed = canonicalization == 'relaxed'
+        self.digest = hashlib.sha256()
+        self.buffer = b''
+        self.empty_lines = 0
+        self.started = False
+
+    def canonicalize(self, lines):
+        lines = LINE_END.sub(CRLF, lines)
+        if self.relaxed:
+            lines = WSP.sub(b' ', TRAILING_WSP.sub(CRLF, lines))
+        return lines
+
+    def update(self, data):
+        data = self.buffer + data
+        end = data.rfind(b'\n') + 1
+        self.buffer = data[end:]
+        if end:
+            self.write(self.canonicalize(data[:end]))
+
+    def write(self, lines):
+        end = len(lines)
+        while lines.endswith(CRLF, 0, end):
+            end -= 2
+        trailing = (len(lines) - end) // 2
+        content = lines[:end]
+        if content:
+            self.digest.update(CRLF * self.empty_lines + content)
+            self.started = True
+            self.empty_lines = trailing
+        else:
+            self.empty_lines += trailing
+
+    def finish(self):
+        """
+        :return: the base64 body hash
+        """
+        if self.buffer:
+            self.write(self.canonicalize(self.buffer + CRLF))
+            self.buffer = b''
+        if self.started or not self.relaxed:
+            # the last line ending, or the CRLF the simple canonicalization of an empty body is
+            self.digest.update(CRLF)
+        return base64.b64encode(self.digest.digest())
+
+
+def split_headers(data):
+    """
+    :param data: a header section, without the empty line ending it
+    :return: list of (lowercase name, field ending with CRLF), folded lines included
+    """
+    fields = []
+    for field in FIELD_END.split(data):
+        if field.strip():
+            fields.append((field.split(b':', 1)[0].strip().lower(), LINE_END.sub(CRLF, field) + CRLF))
+    return fields
+
+
+class DKIMSigner(object):
+    """
+    Signs serialised emails for a domain and selector.
+    """
+    def __init__(self, domain, selector, private_key, headers=DEFAULT_SIGNED_HEADERS,
+                 canonicalization='relaxed/relaxed', identity=None, expiration=None,
+                 timestamp=True, max_cached_bytes=16 * 1024 * 1024):
+        """
+        :param domain: the signing domain (d=)
+        :param selector: the selector of the public key in DNS (s=)
+        :param private_key: PEM encoded RSA private key
+        :param headers: names of the headers signed when the message has them. From is always signed
+        :param canonicalization: header/body canonicalization, each 'simple' or 'relaxed'
+        :param identity: optional agent or user identifier (i=)
+        :param expiration: seconds after signing when the signature expires (x=), None for never
+        :param timestamp: add the signing time (t=)
+        :param max_cached_bytes: total size of the bodies whose hash is memoized
+        """
+        header_canon, _, body_canon = canonicalization.partition('/')
+        body_canon = body_canon or 'simple'
+        if header_canon not in CANONICALIZATIONS or body_canon not in CANONICALIZATIONS:
+            raise ValueError('Unknown canonicalization {0}'.format(canonicalization))
+        self.domain = domain
+        self.selector = selector
+        self.private_key = private_key
+        self.key = load_private_key(domain, selector, private_key)
+        names = [name.lower() for name in headers]
+        self.headers = names if 'from' in names else ['from'] + names
+        self.header_canonicalization = header_canon
+        self.body_canonicalization = body_canon
+        self.identity = identity
+        self.expiration = expiration
+        self.timestamp = timestamp
+        self.max_cached_bytes = max_cached_bytes
+        self._body_hashes = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            'signed': 0,
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def get_body_hash(self, body):
+        """
+        :param body: the body of a message as bytes, or an iterable of its chunks
+        :return: the base64 body hash, memoized for bodies given as bytes
+        """
+        if not isinstance(body, bytes):
+            hasher = BodyHasher(self.body_canonicalization)
+            for chunk in body:
+                hasher.update(chunk)
+            return hasher.finish()
+        with self._lock:
+            body_hash = self._body_hashes.pop(body, None)
+            if body_hash is not None:
+                self._body_hashes[body] = body_hash
+                self.stats['hits'] += 1
+                return body_hash
+            self.stats['misses'] += 1
+        hasher = BodyHasher(self.body_canonicalization)
+        hasher.update(body)
+        body_hash = hasher.finish()
+        if len(body) <= self.max_cached_bytes:
+            with self._lock:
+                if body not in self._body_hashes:
+                    self._body_hashes[body] = body_hash
+                    self._cached_bytes += len(body)
+                while self._cached_bytes > self.max_cached_bytes:
+                    evicted, _ = self._body_hashes.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+        return body_hash
+
+    def canonicalize_header(self, field):
+        if self.header_canonicalization == 'simple':
+            return field
+        name, value = field.split(b':', 1)
+        value = WSP.sub(b' ', LINE_END.sub(b'', value)).strip(b' ')
+        return name.strip().lower() + b':' + value + CRLF
+
+    def format_field(self, names, body_hash):
+        """
+        :return: the DKIM-Signature field up to its empty b= tag
+        """
+        tags = [('v', '1'), ('a', 'rsa-sha256'),
+                ('c', '{0}/{1}'.format(self.header_canonicalization, self.body_canonicalization)),
+                ('d', self.domain), ('s', self.selector)]
+        if self.identity:
+            tags.append(('i', self.identity))
+        now = int(time.time())
+        if self.timestamp:
+            tags.append(('t', str(now)))
+        if self.expiration:
+            tags.append(('x', str(now + self.expiration)))
+        field = 'DKIM-Signature: ' + '; '.join('{0}={1}'.format(*tag) for tag in tags) + ';\r\n\t' + \
+                'h={0};\r\n\tbh={1};\r\n\tb='.format(':'.join(names), body_hash.decode('ascii'))
+        return field.encode('ascii')
+
+    def estimate_size(self):
+        """
+        :return: an upper bound of the size of the DKIM-Signature field added to a message
+        """
+        signature = ((self.key.key_size + 7) // 8 + 2) // 3 * 4
+        field = self.format_field(self.headers, b'=' * 44)
+        return len(field) + signature + 3 * ((signature - 1) // 72) + 2
+
+    def get_signature_header(self, headers, body):
+        """
+        Sign a message
+        :param headers: the header section of the message, as bytes
+        :param body: the body, as bytes or an iterable of byte chunks
+        :return: the DKIM-Signature field, without its final line ending
+        """
+        body_hash = self.get_body_hash(body)
+        fields = split_headers(headers)
+        signed = []
+        names = []
+        for name in self.headers:
+            # every instance of a header, last first (RFC 6376 5.4.2)
+            for field_name, field in reversed(fields):
+                if field_name == name.encode('ascii'):
+                    signed.append(self.canonicalize_header(field))
+                    names.append(name)
+        field = self.format_field(names, body_hash)
+        # the signature field is hashed with an empty b= and without a final line ending
+        signed.append(self.canonicalize_header(field + CRLF)[:-2])
+        signature = base64.b64encode(self.key.sign(b''.join(signed), padding.PKCS1v15(), hashes.SHA256()))
+        with self._lock:
+            self.stats['signed'] += 1
+        return field + b'\r\n\t'.join(signature[i:i + 72] for i in range(0, len(signature), 72))
+
+    def sign(self, payload):
+        """
+        :param payload: a serialised message, as bytes or text, with CRLF or LF line endings
+        :return: the payload with a DKIM-Signature header prepended, of the same type and with
+                 the same line endings
+        """
+        is_text = not isinstance(payload, bytes)
+        data = payload.encode('utf-8', 'surrogateescape') if is_text else payload
+        match = HEADER_END.search(data)
+        if match is None:
+            headers, body, crlf = data, b'', CRLF in data
+        else:
+            headers, body, crlf = data[:match.start()], data[match.end():], match.group().startswith(b'\r')
+        field = self.get_signature_header(headers, body)
+        field = field + CRLF if crlf else field.replace(CRLF, b'\n') + b'\n'
+        if is_text:
+            return field.decode('ascii') + payload
+        return field + payload
+
+    def sign_stream(self, stream):
+        """
+        Sign a PayloadStream, reading it once to hash the body
+        :return: the DKIM-Signature field with its line ending, as bytes
+        """
+        headers = b''
+        chunks = iter(stream)
+        body = []
+        for chunk in chunks:
+            headers += chunk
+            match = HEADER_END.search(headers)
+            if match:
+                body = [headers[match.end():]]
+                headers = headers[:match.start()]
+                break
+
+        def iter_body():
+            for chunk in body:
+                yield chunk
+            for chunk in chunks:
+                yield chunk
+        return self.get_signature_header(headers, iter_body()) + CRLF
@@ -0,0 +1,257 @@
+"""
+A transport writing emails to files instead of sending them: .eml files in a pickup
+directory, an mbox file or a maildir.
+
+with FileTransport('/var/spool/pickup', format='eml', fsync_every=100) as transport:
+    transport.send(email)
+
+It has the send(), send_many() and send_compiled() methods of SMTP, which only report an
+email as written once it is on disk. send_many() writes its emails in batches: with fsync, a
+batch is synced to disk with a single pass of fsyncs before its files are renamed into place
+(or before the mbox lock is released), so readers never see a message which could still be
+lost.
+"""
+
+import os
+import socket
+import threading
+import time
+
+from strudelpy.metrics import default_hooks
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+__all__ = ['FileTransport', 'FORMATS']
+
+FORMATS = ('eml', 'mbox', 'maildir')
+
+LF = b'\n'
+CRLF = b'\r\n'
+
+
+def mbox_quote(payload):
+    """
+    Escape the lines of a message which would be read as the start of a new message in an
+    mbox (mboxrd quoting: a > is added to lines matching >*From )
+    """
+    lines = payload.split(LF)
+    for i, line in enumerate(lines):
+        if line.lstrip(b'>').startswith(b'From '):
+            lines[i] = b'>' + line
+    return LF.join(lines)
+
+
+class FileTransport(object):
+    """
+    Writes emails as files. `format` is one of:
+    - eml: one <name>.eml file per email in the directory `path`, written in path/tmp and
+      renamed into place, with CRLF line endings (a pickup directory)
+    - maildir: one file per email in path/new, written in path/tmp first, with LF line endings
+    - mbox: emails appended to the file `path`, with LF line endings and mboxrd quoting
+    """
+    # callbacks timing the send stage (see strudelpy.metrics)
+    hooks = default_hooks
+
+    def __init__(self, path, format='eml', fsync=True, fsync_every=100, buffer_size=1024 * 1024,
+                 envelope_headers=False):
+        """
+        :param path: pickup or maildir directory, or mbox file. Created if missing
+        :param format: eml, maildir or mbox
+        :param fsync: sync the written files to disk before they are made visible
+        :param fsync_every: maximum number of emails of a send_many() call written per batch.
+                            Every call returns once all its emails are written
+        :param buffer_size: write a batch of send_many() once this many bytes are pending
+        :param envelope_headers: start every file with X-Sender and X-Receiver headers holding
+                                 the envelope, as pickup directories of some MTAs expect
+        """
+        if format not in FORMATS:
+            raise ValueError('Unknown format {0}, use one of {1}'.format(format, ', '.join(FORMATS)))
+        self.path = path
+        self.format = format
+        self.fsync = fsync
+        self.fsync_every = max(1, fsync_every or 1)
+        self.buffer_size = buffer_size
+        self.envelope_headers = envelope_headers
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        self._counter = 0
+        # the file written by the last send() or send_compiled()
+        self.last_name = None
+        self._pending = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        # set by login() and cleared by close(), as the connection of an SMTP is, for Spool
+        self.client = None
+        self.stats = {
+            'messages': 0,
+            'bytes': 0,
+            'flushes': 0,
+        }
+        if format == 'mbox':
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        else:
+            for directory in self.get_directories():
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_directories(self):
+        if self.format == 'maildir':
+            return [os.path.join(self.path, name) for name in ('tmp', 'new', 'cur')]
+        return [self.path, os.path.join(self.path, 'tmp')]
+
+    def login(self):
+        """
+        Nothing to connect to: present so the transport can be used where an SMTP is expected,
+        such as Spool.process()
+        """
+        self.client = self.path
+
+    def send(self, email):
+        """
+        Write an Email, returning once it is written
+        :return: an empty dict of refused recipients, as SMTP.send() returns
+        """
+        return self.send_compiled(email.sender, email.get_envelope_recipients(), email.get_payload_bytes())
+
+    def send_many(self, emails):
+        """
+        Write several Emails in batches, returning once all of them are written
+        :return: a list with a {recipient: (code, response)} dict per email, as SMTP.send_many()
+        """
+        written = []
+        for email in emails:
+            recipients = email.get_envelope_recipients()
+            written.append((recipients, self.add(email.sender, recipients, email.get_payload_bytes())))
+        self.flush()
+        results = []
+        for recipients, name in written:
+            reply = (250, ('2.0.0 Written ' + name).encode('utf-8'))
+            results.append(dict((recipient, reply) for recipient in recipients))
+        return results
+
+    def send_compiled(self, sender, recipients, payload, mail_options=()):
+        """
+        Write an already serialised payload, returning once it is written
+        :param payload: the message as string or bytes
+        :return: an empty dict of refused recipients, as SMTP.send_compiled() returns. The name
+                 of the file written (for mbox, the mbox path) is left in last_name
+        """
+        self.last_name = self.add(sender, recipients, payload)
+        self.flush()
+        return {}
+
+    def add(self, sender, recipients, payload):
+        """
+        Add a payload to the pending batch, which is written once it is full
+        :return: the name of the file the payload will be written to
+        """
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        with self.hooks.timed('send', path=self.path, recipients=len(recipients), bytes=len(payload)):
+            data = self.format_message(sender, recipients, payload)
+            with self._lock:
+                name = self.get_name()
+                self._pending.append((name, data))
+                self._pending_bytes += len(data)
+                self.stats['messages'] += 1
+                self.stats['bytes'] += len(data)
+                if len(self._pending) >= self.fsync_every or self._pending_bytes >= self.buffer_size:
+                    self._flush()
+        return name
+
+    def get_name(self):
+        """
+        :return: a unique file name for the next email, maildir style (time.Mmicroseconds
+                 PpidQcounter.hostname)
+        """
+        if self.format == 'mbox':
+            return self.path
+        self._counter += 1
+        now = time.time()
+        name = '{0}.M{1}P{2}Q{3}.{4}'.format(int(now), int(now % 1 * 1000000), os.getpid(),
+                                             self._counter, self.hostname)
+        return name + '.eml' if self.format == 'eml' else name
+
+    def format_message(self, sender, recipients, payload):
+        """
+        :return: the bytes written for a message, in the line endings of the format
+        """
+        if self.envelope_headers:
+            lines = ['X-Sender: <{0}>'.format(sender)] + ['X-Receiver: <{0}>'.format(r) for r in recipients]
+            payload = ('\r\n'.join(lines) + '\r\n').encode('utf-8') + payload
+        if self.format == 'eml':
+            return payload if payload.count(LF) == payload.count(CRLF) else \
+                payload.replace(CRLF, LF).replace(LF, CRLF)
+        payload = payload.replace(CRLF, LF)
+        if self.format == 'maildir':
+            return payload
+        if not payload.endswith(LF):
+            payload += LF
+        separator = 'From {0} {1}\n'.format(sender or 'MAILER-DAEMON', time.asctime(time.gmtime()))
+        return separator.encode('utf-8') + mbox_quote(payload) + LF
+
+    def flush(self):
+        """
+        Write (and sync) the pending emails
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        if not pending:
+            return
+        if self.format == 'mbox':
+            self.append_mbox([data for _, data in pending])
+        else:
+            self.write_files(pending)
+        self.stats['flushes'] += 1
+
+    def append_mbox(self, messages):
+        with open(self.path, 'ab') as mbox:
+            if fcntl is not None:
+                fcntl.lockf(mbox, fcntl.LOCK_EX)
+            try:
+                mbox.write(b''.join(messages))
+                mbox.flush()
+                if self.fsync:
+                    os.fsync(mbox.fileno())
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(mbox, fcntl.LOCK_UN)
+
+    def write_files(self, pending):
+        tmp = os.path.join(self.path, 'tmp')
+        target = os.path.join(self.path, 'new') if self.format == 'maildir' else self.path
+        for name, data in pending:
+            with open(os.path.join(tmp, name), 'wb') as message_file:
+                message_file.write(data)
+                if self.fsync:
+                    message_file.flush()
+                    os.fsync(message_file.fileno())
+        for name, _ in pending:
+            os.rename(os.path.join(tmp, name), os.path.join(target, name))
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            # make the renames durable
+            fd = os.open(target, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """
+        Write the pending emails
+        """
+        self.flush()
+        self.client = None
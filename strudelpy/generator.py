@@ -0,0 +1,92 @@
+"""
+Message generators which keep the serialisation of unchanging parts, so re-serialising a
+message after changing its headers only writes the headers again.
+Their MIME boundaries are derived from the content they separate, so messages with the same
+parts serialise to the same body whatever their headers.
+"""
+
+import hashlib
+import io
+import re
+from email.generator import Generator
+try:
+    from email.generator import BytesGenerator
+except ImportError:  # Python 2 only serialises to str
+    BytesGenerator = None
+
+__all__ = ['MemoGenerator', 'MemoBytesGenerator', 'memoize', 'serialise_part', 'BOUNDARY_LENGTH']
+
+MEMO_ATTRIBUTE = '_strudelpy_serialised'
+
+# length of the boundaries made by the generators, unless a counter suffix is needed
+BOUNDARY_LENGTH = 15 + 19 + 2
+
+
+def memoize(part):
+    """
+    Mark a MIME part as unchanging: its serialisation (of it and its subparts) is kept on it
+    and reused by the generators in this module. The part must not be modified afterwards.
+    :return: the part
+    """
+    setattr(part, MEMO_ATTRIBUTE, {})
+    return part
+
+
+class MemoizingMixin(object):
+    @classmethod
+    def _make_boundary(cls, text=None):
+        if text is None:
+            return super(MemoizingMixin, cls)._make_boundary(text)
+        # the same for str and bytes serialisations of the parts
+        data = text if isinstance(text, bytes) else text.encode('utf-8', 'surrogateescape')
+        token = int(hashlib.sha1(data.replace(b'\r\n', b'\n')).hexdigest(), 16) % 10 ** 19
+        boundary = ('=' * 15) + ('%019d' % token) + '=='
+        unique = boundary
+        counter = 0
+        while cls._compile_re('^--' + re.escape(unique) + '(--)?$', re.MULTILINE).search(text):
+            unique = boundary + '.' + str(counter)
+            counter += 1
+        return unique
+
+    def flatten(self, msg, unixfrom=False, linesep=None):
+        memo = getattr(msg, MEMO_ATTRIBUTE, None)
+        if memo is None:
+            return super(MemoizingMixin, self).flatten(msg, unixfrom, linesep)
+        policy = self.policy or msg.policy
+        key = (type(self), linesep or policy.linesep, getattr(policy, 'utf8', False), self.maxheaderlen, unixfrom)
+        data = memo.get(key)
+        if data is None:
+            output = self._fp
+            self._fp = self._new_buffer()
+            try:
+                super(MemoizingMixin, self).flatten(msg, unixfrom, linesep)
+                data = memo[key] = self._fp.getvalue()
+            finally:
+                self._fp = output
+        self._fp.write(data)
+
+
+class MemoGenerator(MemoizingMixin, Generator):
+    """
+    A Generator (writing str) which reuses the serialisation of memoized parts
+    """
+
+
+if BytesGenerator is not None:
+    class MemoBytesGenerator(MemoizingMixin, BytesGenerator):
+        """
+        A BytesGenerator which reuses the serialisation of memoized parts
+        """
+
+
+def serialise_part(part):
+    """
+    Serialise a subpart exactly as it is written inside a message serialised to bytes by
+    Email.get_payload_bytes() (reusing that serialisation if the part is memoized)
+    :return: bytes
+    """
+    from email.policy import compat32
+    output = io.BytesIO()
+    generator = MemoBytesGenerator(output, False, None, policy=compat32.clone(linesep='\r\n', max_line_length=0))
+    generator.flatten(part, linesep='\r\n')
+    return output.getvalue()
@@ -0,0 +1,200 @@
+"""
+Fast address header encoding.
+
+Building an address header with email.header.Header appends every address as a separate
+chunk, and Header then re-splits and re-folds the whole header on every encode, which is
+quadratic-ish in the number of addresses. AddressEncoder classifies every address once,
+memoizes the encoded form of the name/address pairs it has seen (a campaign sends the same
+From and Cc to every recipient), and folds the header lines directly.
+"""
+
+import re
+import threading
+from email.header import Header
+
+import six
+
+__all__ = ['AddressEncoder', 'EncodedHeader', 'default_address_encoder']
+
+# RFC 5322 2.1.1: lines SHOULD be no longer than 78 characters
+MAX_LINE_LENGTH = 78
+
+# characters which require a display name to be quoted (as email.utils.formataddr does)
+SPECIALS = re.compile(r'[][\\()<>@,:;".]')
+ESCAPES = re.compile(r'[\\"]')
+
+
+def quote_name(name):
+    """
+    :return: the display name, quoted if it contains special characters
+    """
+    if SPECIALS.search(name):
+        return u'"{0}"'.format(ESCAPES.sub(r'\\\g<0>', name))
+    return name
+
+
+def is_ascii(value):
+    try:
+        value.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+class EncodedHeader(Header):
+    """
+    A header value folded ahead of time. It is written as is by the email generators, so the
+    folding is not redone whenever the message is serialised.
+    """
+    def __init__(self, lines, utf8_lines, header_name=None):
+        """
+        :param lines: the folded lines, non ascii text written as RFC 2047 encoded words.
+                      Continuation lines start with a space
+        :param utf8_lines: the same, non ascii text written as is (for SMTPUTF8)
+        :param header_name: name of the header
+        """
+        Header.__init__(self, header_name=header_name)
+        self.lines = lines
+        self.utf8_lines = utf8_lines
+
+    def __str__(self):
+        if six.PY2:
+            return self.encode()
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return u''.join(self.utf8_lines)
+
+    def __eq__(self, other):
+        return six.text_type(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def append(self, s, charset=None, errors='strict'):
+        raise TypeError('EncodedHeader cannot be appended to')
+
+    def encode(self, splitchars=';, \t', maxlinelen=None, linesep='\n'):
+        return linesep.join(self.lines)
+
+    def fold_utf8(self, linesep='\n'):
+        """
+        :return: the folded header value with non ascii text written as is
+        """
+        return linesep.join(self.utf8_lines)
+
+
+class AddressEncoder(object):
+    """
+    Encodes lists of addresses into folded address headers (From, To, Cc, Bcc).
+    Addresses are either strings or (name, address) pairs. Their encoded forms are memoized.
+    """
+    def __init__(self, max_entries=100000, max_line_length=MAX_LINE_LENGTH):
+        """
+        :param max_entries: number of encoded addresses to keep. The memo is emptied when full
+        :param max_line_length: length at which header lines are folded
+        """
+        self.max_entries = max_entries
+        self.max_line_length = max_line_length
+        self._memo = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def __len__(self):
+        return len(self._memo)
+
+    def encode_word(self, text, charset):
+        """
+        :return: list of RFC 2047 encoded words for text
+        """
+        return Header(text, charset).encode().split()
+
+    def encode_address(self, address, charset='utf-8'):
+        """
+        :param address: an address string or (name, address) pair
+        :param charset: charset of the encoded words of non ascii text
+        :return: (tokens, utf8_tokens) - the space separated words of the encoded address, with
+                 non ascii text as encoded words and as is
+        """
+        if not isinstance(address, six.string_types):
+            address = tuple(address)
+        key = (charset, address)
+        encoded = self._memo.get(key)
+        if encoded is not None:
+            self.stats['hits'] += 1
+            return encoded
+        self.stats['misses'] += 1
+        if isinstance(address, six.string_types):
+            if is_ascii(address):
+                tokens = utf8_tokens = address.split(' ')
+            else:
+                tokens = self.encode_word(address, charset)
+                utf8_tokens = [address]
+        else:
+            name, email = address
+            if is_ascii(name) and is_ascii(email):
+                from email.utils import formataddr
+                tokens = utf8_tokens = formataddr((name, email)).split(' ')
+            else:
+                utf8_tokens = quote_name(name).split(' ') if name else []
+                utf8_tokens.append(u'<{0}>'.format(email))
+                tokens = self.encode_word(name, charset) if name else []
+                tokens.append(u'<{0}>'.format(email) if is_ascii(email)
+                              else u' '.join(self.encode_word(email, charset)))
+        encoded = (tuple(tokens), tuple(utf8_tokens))
+        with self._lock:
+            if len(self._memo) >= self.max_entries:
+                self._memo.clear()
+            self._memo[key] = encoded
+        return encoded
+
+    def fold(self, addresses, header_name, position):
+        """
+        Join the addresses with commas, folding the lines before a word which would make them
+        longer than max_line_length.
+        :param addresses: list of address token lists
+        :param header_name: name of the header, its length is taken into account in the first line
+        :param position: 0 to fold the encoded tokens, 1 for the utf8 ones
+        :return: list of lines
+        """
+        lines = []
+        line = []
+        length = len(header_name or '') + 2
+        limit = self.max_line_length
+        last = len(addresses) - 1
+        for i, tokens in enumerate(addresses):
+            tokens = tokens[position]
+            for j, token in enumerate(tokens):
+                if i < last and j == len(tokens) - 1:
+                    token += ','
+                if line and length + 1 + len(token) > limit:
+                    lines.append(u''.join(line))
+                    line = [u' ', token]
+                    length = 1 + len(token)
+                else:
+                    if line:
+                        line.append(u' ')
+                        length += 1
+                    line.append(token)
+                    length += len(token)
+        lines.append(u''.join(line))
+        return lines
+
+    def encode(self, addresses, header_name=None, charset='utf-8'):
+        """
+        :param addresses: list of address strings and (name, address) pairs
+        :param header_name: name of the header
+        :param charset: charset of the encoded words of non ascii text
+        :return: EncodedHeader
+        """
+        encoded = [self.encode_address(address, charset) for address in addresses]
+        return EncodedHeader(self.fold(encoded, header_name, 0), self.fold(encoded, header_name, 1),
+                             header_name=header_name)
+
+
+default_address_encoder = AddressEncoder()
@@ -0,0 +1,242 @@
+"""
+Instrumentation of the sending hot path.
+
+SMTP and Email report the duration of each stage of a send to the callbacks registered on
+their `hooks`, process wide by default:
+
+    connect     opening the connection (and the SSL handshake for ssl=True)
+    starttls    the STARTTLS handshake
+    login       authentication
+    compile     building the MIME tree (Email.compile_message)
+    serialise   writing the MIME tree out (Email.get_payload / get_payload_bytes)
+    send        the SMTP transaction, with the recipient count and payload size
+
+A callback is called as callback(stage, seconds, error, info) where error is the exception
+the stage raised, or None, and info is a dict of stage specific details. Exceptions raised by
+callbacks are logged and never reach the send.
+
+MetricsCollector is a callback which aggregates them into counters and latency histograms:
+
+collector = MetricsCollector().install()
+...
+collector.snapshot()    # dict
+collector.prometheus()  # Prometheus text exposition format
+"""
+
+import logging
+import threading
+import time
+
+__all__ = ['Hooks', 'MetricsCollector', 'default_hooks']
+
+_now = getattr(time, 'perf_counter', time.time)
+
+logger = logging.getLogger(__name__)
+
+# latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _NullTimer(object):
+    """
+    Stands in for a timer when no callbacks are registered, so instrumentation costs nothing
+    """
+    info = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Timer(object):
+    """
+    Times a stage and reports it to the hooks when it exits. Details which are only known
+    inside the stage can be added to `info`.
+    """
+    def __init__(self, hooks, stage, info):
+        self.hooks = hooks
+        self.stage = stage
+        self.info = info
+        self.start = None
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.hooks.emit(self.stage, _now() - self.start, exc_val, **self.info)
+        return False
+
+
+class Hooks(object):
+    """
+    A list of callbacks notified when an instrumented stage finishes
+    """
+    def __init__(self, *callbacks):
+        self.callbacks = list(callbacks)
+
+    def __bool__(self):
+        return bool(self.callbacks)
+
+    __nonzero__ = __bool__
+
+    def add(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+        return callback
+
+    def remove(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def timed(self, stage, **info):
+        """
+        :return: a context manager timing a stage, reporting it to the callbacks on exit
+        """
+        if not self.callbacks:
+            return _null_timer
+        return Timer(self, stage, info)
+
+    def emit(self, stage, seconds, error=None, **info):
+        for callback in list(self.callbacks):
+            try:
+                callback(stage, seconds, error, info)
+            except Exception:
+                # a broken callback must not make a delivered message look failed
+                logger.exception('Metrics callback %r failed on the %s stage', callback, stage)
+
+
+default_hooks = Hooks()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, observations at or below it), as Prometheus expects
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsCollector(object):
+    """
+    A hook callback counting stages, errors, messages, recipients and bytes sent, with a
+    latency histogram per stage
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: upper bounds of the latency histogram buckets, in seconds
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = _now()
+            self.stages = {}
+            self.errors = {}
+            self.messages = 0
+            self.recipients = 0
+            self.bytes = 0
+
+    def install(self, hooks=default_hooks):
+        """
+        Register this collector on a Hooks object, the process wide one by default
+        :return: self
+        """
+        hooks.add(self)
+        return self
+
+    def __call__(self, stage, seconds, error, info):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            if error is not None:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            elif stage == 'send':
+                self.messages += 1
+                self.recipients += info.get('recipients', 0)
+                self.bytes += info.get('bytes') or 0
+
+    def snapshot(self):
+        """
+        :return: dict of the current counters and histograms
+        """
+        with self._lock:
+            elapsed = _now() - self.started
+            return {
+                'messages': self.messages,
+                'recipients': self.recipients,
+                'bytes': self.bytes,
+                'messages_per_second': self.messages / elapsed if elapsed > 0 else 0.0,
+                'stages': dict(
+                    (stage, {
+                        'count': histogram.count,
+                        'errors': self.errors.get(stage, 0),
+                        'sum': histogram.sum,
+                        'buckets': histogram.cumulative(),
+                    })
+                    for stage, histogram in self.stages.items()
+                ),
+            }
+
+    def prometheus(self, prefix='strudelpy'):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP {0}_stage_seconds Duration of SMTP and message compilation stages'.format(prefix),
+            '# TYPE {0}_stage_seconds histogram'.format(prefix),
+        ]
+        for stage in sorted(snapshot['stages']):
+            stats = snapshot['stages'][stage]
+            for bound, count in stats['buckets']:
+                lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.format(
+                    prefix, stage, repr(float(bound)), count))
+            lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="+Inf"}} {2}'.format(
+                prefix, stage, stats['count']))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2}'.format(prefix, stage, repr(stats['sum'])))
+            lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(prefix, stage, stats['count']))
+        lines.append('# HELP {0}_stage_errors_total Stages which raised an error'.format(prefix))
+        lines.append('# TYPE {0}_stage_errors_total counter'.format(prefix))
+        for stage in sorted(snapshot['stages']):
+            lines.append('{0}_stage_errors_total{{stage="{1}"}} {2}'.format(
+                prefix, stage, snapshot['stages'][stage]['errors']))
+        for name, kind, description, value in (
+            ('messages_sent_total', 'counter', 'Messages sent', snapshot['messages']),
+            ('recipients_total', 'counter', 'Envelope recipients of sent messages', snapshot['recipients']),
+            ('bytes_sent_total', 'counter', 'Payload bytes sent', snapshot['bytes']),
+            ('messages_per_second', 'gauge', 'Messages sent per second since the collector started',
+             snapshot['messages_per_second']),
+        ):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, description))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            lines.append('{0}_{1} {2}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
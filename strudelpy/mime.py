@@ -0,0 +1,65 @@
+"""
+Mime type guessing from file extensions.
+
+The common extensions are looked up in a bundled table. Only other extensions go to the
+mimetypes module, which reads the system mime.types files the first time it is used, so
+importing strudelpy (and sending the usual attachments) does not pay for it.
+"""
+
+import os
+
+__all__ = ['COMMON_TYPES', 'guess_type']
+
+# extension: mime type, for the files usually attached to emails
+COMMON_TYPES = {
+    '.txt': 'text/plain',
+    '.html': 'text/html',
+    '.htm': 'text/html',
+    '.css': 'text/css',
+    '.csv': 'text/csv',
+    '.ics': 'text/calendar',
+    '.md': 'text/markdown',
+    '.xml': 'application/xml',
+    '.js': 'text/javascript',
+    '.json': 'application/json',
+    '.pdf': 'application/pdf',
+    '.rtf': 'application/rtf',
+    '.zip': 'application/zip',
+    '.tar': 'application/x-tar',
+    '.doc': 'application/msword',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.xls': 'application/vnd.ms-excel',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.ppt': 'application/vnd.ms-powerpoint',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.odt': 'application/vnd.oasis.opendocument.text',
+    '.ods': 'application/vnd.oasis.opendocument.spreadsheet',
+    '.odp': 'application/vnd.oasis.opendocument.presentation',
+    '.eml': 'message/rfc822',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.svg': 'image/svg+xml',
+    '.webp': 'image/webp',
+    '.ico': 'image/vnd.microsoft.icon',
+    '.tif': 'image/tiff',
+    '.tiff': 'image/tiff',
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/x-wav',
+    '.mp4': 'video/mp4',
+    '.mov': 'video/quicktime',
+}
+
+
+def guess_type(path):
+    """
+    :param path: file path or name
+    :return: the mime type of the file, or None if it cannot be guessed
+    """
+    mimetype = COMMON_TYPES.get(os.path.splitext(path)[1].lower())
+    if mimetype is None:
+        import mimetypes  # initialises itself (reading the system tables) on first use
+        mimetype = mimetypes.guess_type(path, False)[0]
+    return mimetype
@@ -0,0 +1,305 @@
+"""
+A pool of warm, authenticated SMTP connections.
+
+pool = SMTPPool(SMTP(host='smtp.example.com', port=465, username='me', password='secret', ssl=True),
+                size=4, max_messages=100, idle_timeout=60)
+with pool:
+    pool.send(email)
+
+"""
+
+import socket
+import smtplib
+import threading
+import time
+
+__all__ = ['SMTPPool']
+
+_now = getattr(time, 'monotonic', time.time)
+
+# errors which mean the underlying connection can no longer be trusted
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def is_connection_error(error):
+    """
+    :return: True if error means the connection was lost. On Python 3 every smtplib exception
+             is a socket.error (OSError), so of those only SMTPServerDisconnected counts: the
+             others are replies of a server which is still there
+    """
+    if isinstance(error, smtplib.SMTPException):
+        return isinstance(error, smtplib.SMTPServerDisconnected)
+    return isinstance(error, socket.error)
+
+
+class PooledConnection(object):
+    """
+    A single SMTP session owned by a pool, with the bookkeeping needed to decide when it
+    should be health checked, reset or evicted.
+    """
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created = _now()
+        self.last_used = self.created
+        self.messages_sent = 0
+        self.needs_reset = False
+
+    @property
+    def idle_time(self):
+        return _now() - self.last_used
+
+    def connect(self):
+        self.smtp.login()
+        self.created = self.last_used = _now()
+        self.messages_sent = 0
+        self.needs_reset = False
+
+    def is_alive(self):
+        """
+        Probe the connection with a NOOP
+        :return: True if the server answered with a 250
+        """
+        try:
+            return self.smtp.client.noop()[0] == 250
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            return False
+
+    def reset(self):
+        """
+        Issue a RSET to clear any half finished transaction
+        :return: True if the server accepted the reset
+        """
+        try:
+            return self.smtp.client.rset()[0] == 250
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            return False
+
+    def close(self):
+        """
+        Close the connection, quietly dropping the socket if the server is already gone
+        """
+        if self.smtp.client is None:
+            return
+        try:
+            self.smtp.close()
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            self.smtp.client.close()
+        self.smtp.client = None
+
+
+class SMTPPool(object):
+    """
+    Keep up to `size` authenticated connections to the server described by an SMTP object
+    and reuse them across sends, so the connect, TLS handshake and AUTH are only paid once
+    per connection rather than once per message.
+
+    Reused connections are RSET before every transaction, which also checks they are still
+    alive, and dead connections are replaced quietly. Connections are retired after
+    `max_messages` sends or `idle_timeout` seconds without use.
+    """
+    def __init__(self, smtp, size=4, max_messages=100, idle_timeout=60, health_check_interval=5,
+                 acquire_timeout=None, reset_on_reuse=True):
+        """
+        :param smtp: an SMTP instance used as the configuration for every pooled connection
+        :param size: maximum number of open connections
+        :param max_messages: retire a connection after this many messages (None for no limit)
+        :param idle_timeout: close connections unused for this many seconds (None for no limit)
+        :param health_check_interval: NOOP connections idle for longer than this before reuse
+        :param acquire_timeout: seconds to wait for a free connection before raising
+        :param reset_on_reuse: RSET connections before every reuse. If False, only connections
+                               whose last transaction failed are RSET, and the others are
+                               checked with NOOP after health_check_interval
+        """
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+        self.smtp = smtp
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.reset_on_reuse = reset_on_reuse
+        self._idle = []
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self.closed = False
+        self.stats = {
+            'connects': 0,
+            'reconnects': 0,
+            'reuses': 0,
+            'evictions': 0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._idle) + self._in_use
+
+    def _count(self, name):
+        with self._condition:
+            self.stats[name] += 1
+
+    def _new_connection(self):
+        connection = PooledConnection(self.smtp.clone())
+        connection.connect()
+        self._count('connects')
+        return connection
+
+    def _is_expired(self, connection):
+        if self.idle_timeout is not None and connection.idle_time > self.idle_timeout:
+            return True
+        if self.max_messages is not None and connection.messages_sent >= self.max_messages:
+            return True
+        return False
+
+    def _prepare(self, connection):
+        """
+        Make sure an idle connection is fit for another transaction, reconnecting it if not
+        """
+        healthy = True
+        if connection.needs_reset or self.reset_on_reuse:
+            healthy = connection.reset()
+            connection.needs_reset = False
+        elif connection.idle_time > self.health_check_interval:
+            healthy = connection.is_alive()
+        if healthy:
+            self._count('reuses')
+        else:
+            connection.close()
+            connection.connect()
+            self._count('reconnects')
+        return connection
+
+    def acquire(self):
+        """
+        Take a connection out of the pool, opening a new one if the pool is not full.
+        Blocks until a connection is released if all `size` connections are in use.
+        :return: PooledConnection
+        """
+        deadline = None if self.acquire_timeout is None else _now() + self.acquire_timeout
+        expired = []
+        try:
+            with self._condition:
+                while True:
+                    if self.closed:
+                        raise smtplib.SMTPException('Pool is closed')
+                    for stale in [c for c in self._idle if self._is_expired(c)]:
+                        self._idle.remove(stale)
+                        expired.append(stale)
+                        self.stats['evictions'] += 1
+                    if self._idle:
+                        connection = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.size:
+                        connection = None
+                        self._in_use += 1
+                        break
+                    remaining = None if deadline is None else deadline - _now()
+                    if remaining is not None and remaining <= 0:
+                        raise smtplib.SMTPException('Timed out waiting for a pooled connection')
+                    self._condition.wait(remaining)
+        finally:
+            # closing sends a QUIT, as prune() the expired connections are closed unlocked
+            for stale in expired:
+                stale.close()
+        # network round trips happen outside of the lock
+        try:
+            if connection is None:
+                return self._new_connection()
+            return self._prepare(connection)
+        except Exception:
+            if connection is not None:
+                connection.close()
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection, failed=False):
+        """
+        Return a connection to the pool.
+        :param connection: a PooledConnection previously returned by acquire()
+        :param failed: True if the last transaction on this connection did not complete
+        """
+        connection.last_used = _now()
+        connection.needs_reset = connection.needs_reset or failed
+        with self._condition:
+            self._in_use -= 1
+            if self.closed or self._is_expired(connection):
+                retire = True
+            else:
+                retire = False
+                self._idle.append(connection)
+            self._condition.notify()
+        if retire:
+            connection.close()
+            self._count('evictions')
+
+    def discard(self, connection):
+        """
+        Close a connection and free its slot in the pool
+        """
+        connection.close()
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    def send(self, email):
+        """
+        Send an Email over a pooled connection. If the connection turns out to be dead, it is
+        replaced and the send retried once on the new connection. Refusals of the server are
+        raised without a retry.
+        :return: the refused recipients dict returned by SMTP.send
+        """
+        connection = self.acquire()
+        for attempt in (0, 1):
+            try:
+                response = connection.smtp.send(email)
+            except Exception as e:
+                if not is_connection_error(e):
+                    self.release(connection, failed=True)
+                    raise
+                if attempt:
+                    self.discard(connection)
+                    raise
+                connection.close()
+                try:
+                    connection.connect()
+                except Exception:
+                    self.discard(connection)
+                    raise
+                self._count('reconnects')
+            else:
+                connection.messages_sent += 1
+                self.release(connection)
+                return response
+
+    def prune(self):
+        """
+        Close idle connections which exceeded their idle timeout or message limit
+        """
+        with self._condition:
+            expired = [c for c in self._idle if self._is_expired(c)]
+            for connection in expired:
+                self._idle.remove(connection)
+            self.stats['evictions'] += len(expired)
+        for connection in expired:
+            connection.close()
+        return len(expired)
+
+    def close(self):
+        """
+        Close all idle connections. Connections still in use are closed when released.
+        """
+        with self._condition:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
@@ -0,0 +1,21 @@
+"""
+Checks run before a message is sent, so messages the server is bound to refuse are not
+transferred at all.
+"""
+
+import smtplib
+
+__all__ = ['MessageTooLarge']
+
+
+class MessageTooLarge(smtplib.SMTPResponseException):
+    """
+    Raised instead of sending a message larger than the SIZE limit the server advertises. It
+    carries the 552 reply the server would have given, so it is handled as a permanent failure.
+    """
+    def __init__(self, size, limit, email=None):
+        message = '5.3.4 Message size {0} exceeds the maximum of {1} bytes'.format(size, limit)
+        super(MessageTooLarge, self).__init__(552, message.encode('ascii'))
+        self.size = size
+        self.limit = limit
+        self.email = email
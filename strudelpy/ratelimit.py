@@ -0,0 +1,251 @@
+"""
+Rate limiting and adaptive concurrency for sending through a provider's SMTP relay.
+
+limiter = RateLimiter(messages_per_second=10, recipients_per_minute=3000, connections_per_minute=20,
+                      max_concurrency=8)
+smtp.rate_limiter = limiter
+...
+limiter.get_state()
+
+Token buckets cap the message, recipient and connection rates. The number of sends in flight
+(across the threads and clones sharing the limiter) and the rates are adapted AIMD style:
+they are cut when the provider throttles (421/451/452 replies or dropped connections), and
+grow back step by step while sends succeed, up to the configured ceilings.
+"""
+
+import threading
+import time
+
+__all__ = ['RateLimiter', 'TokenBucket', 'THROTTLE_CODES']
+
+_now = getattr(time, 'monotonic', time.time)
+
+# replies providers use to say we are going too fast
+THROTTLE_CODES = (421, 451, 452)
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket: tokens are added at `rate` per second, up to `capacity`.
+    """
+    def __init__(self, rate, capacity=None, clock=_now):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens (the burst size). Defaults to one second of rate
+        :param clock: function returning the current time in seconds
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens=1):
+        """
+        Take tokens if they are available. Requests larger than the capacity are granted when
+        the bucket is full, leaving it in debt.
+        :return: 0 if the tokens were taken, otherwise the seconds to wait before retrying
+        """
+        with self._lock:
+            self.refill(self.clock())
+            needed = min(tokens, self.capacity)
+            # tolerate rounding, or waiting exactly the returned delay could fall short forever
+            if self.tokens >= needed - 1e-9:
+                self.tokens -= tokens
+                return 0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, tokens=1, sleep=time.sleep):
+        """
+        Block until the tokens are taken
+        :return: the seconds waited
+        """
+        waited = 0
+        delay = self.take(tokens)
+        while delay:
+            sleep(delay)
+            waited += delay
+            delay = self.take(tokens)
+        return waited
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.refill(self.clock())
+            self.rate = float(rate)
+
+
+class RateLimiter(object):
+    """
+    Shared by the SMTP objects sending through one provider. Every send acquires a
+    concurrency slot and message and recipient tokens, and reports its outcome.
+    """
+    def __init__(self, messages_per_second=None, recipients_per_minute=None, connections_per_minute=None,
+                 max_concurrency=None, min_concurrency=1, initial_concurrency=None, decrease=0.5,
+                 min_rate_factor=0.05, rate_increase=0.05, cooldown=1.0, clock=_now, sleep=time.sleep):
+        """
+        :param messages_per_second: message rate ceiling, None for no limit
+        :param recipients_per_minute: recipient rate ceiling, None for no limit
+        :param connections_per_minute: rate at which new connections may be opened, None for no limit
+        :param max_concurrency: maximum number of sends in flight, None for no limit
+        :param min_concurrency: the concurrency is never cut below this
+        :param initial_concurrency: concurrency to start with (defaults to max_concurrency)
+        :param decrease: factor applied to the concurrency and the rates when throttled
+        :param min_rate_factor: the rates are never cut below this fraction of their ceiling
+        :param rate_increase: fraction of the ceiling the rates grow by after each successful send
+        :param cooldown: seconds after a cut during which further throttling is not acted upon,
+                         as the sends in flight at the time of the cut are likely to be throttled too
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(initial_concurrency or max_concurrency or 0)
+        self.decrease = decrease
+        self.min_rate_factor = min_rate_factor
+        self.rate_increase = rate_increase
+        self.rate_factor = 1.0
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.ceilings = {
+            'messages': messages_per_second,
+            'recipients': recipients_per_minute / 60.0 if recipients_per_minute else None,
+            'connections': connections_per_minute / 60.0 if connections_per_minute else None,
+        }
+        self.buckets = {}
+        for name, rate in self.ceilings.items():
+            if rate:
+                capacity = None if name != 'recipients' else recipients_per_minute
+                self.buckets[name] = TokenBucket(rate, capacity, clock=clock)
+        self.in_flight = 0
+        self.last_cut = None
+        self._condition = threading.Condition()
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'throttled': 0,
+            'cuts': 0,
+            'connections': 0,
+            'waited': 0.0,
+        }
+
+    def get_concurrency_limit(self):
+        """
+        :return: the current number of sends allowed in flight, or None without a limit
+        """
+        if not self.max_concurrency:
+            return None
+        return max(self.min_concurrency, int(self.concurrency))
+
+    def connect(self):
+        """
+        Wait for a connection token. Called before every connection is opened
+        """
+        bucket = self.buckets.get('connections')
+        waited = bucket.acquire(1, self.sleep) if bucket else 0
+        with self._condition:
+            self.stats['connections'] += 1
+            self.stats['waited'] += waited
+
+    def acquire(self, recipients=1):
+        """
+        Wait for a concurrency slot and for the message and recipient tokens of a send.
+        Every acquire() must be followed by a release()
+        :param recipients: number of recipients of the message
+        """
+        start = self.clock()
+        with self._condition:
+            while self.get_concurrency_limit() is not None and self.in_flight >= self.get_concurrency_limit():
+                self._condition.wait()
+            self.in_flight += 1
+        waited = self.clock() - start
+        try:
+            for name, tokens in (('messages', 1), ('recipients', recipients)):
+                bucket = self.buckets.get(name)
+                if bucket:
+                    waited += bucket.acquire(tokens, self.sleep)
+        except BaseException:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self.stats['waited'] += waited
+
+    def release(self, results=None, error=None):
+        """
+        End a send and adapt the limits to its outcome
+        :param results: {recipient: (code, response)} dict of the send, or its refused recipients
+        :param error: the exception the send raised, if any
+        """
+        throttled = self.is_throttled(results, error)
+        with self._condition:
+            self.in_flight -= 1
+            if error is None:
+                self.stats['sent'] += 1
+            else:
+                self.stats['failed'] += 1
+            if throttled:
+                self.stats['throttled'] += 1
+                self.on_throttled()
+            elif error is None:
+                self.on_success()
+            self._condition.notify_all()
+
+    def is_throttled(self, results=None, error=None):
+        """
+        :return: True if the outcome of a send says the provider is throttling us
+        """
+        if error is not None:
+            results = getattr(error, 'recipients', None) or results
+            code = getattr(error, 'smtp_code', None)
+            if code in THROTTLE_CODES:
+                return True
+            if code is None and not results and isinstance(error, EnvironmentError):
+                # the connection was dropped (SMTPServerDisconnected or a socket error)
+                return True
+        for reply in (results or {}).values():
+            if reply and reply[0] in THROTTLE_CODES:
+                return True
+        return False
+
+    def on_throttled(self):
+        now = self.clock()
+        if self.last_cut is not None and now - self.last_cut < self.cooldown:
+            return
+        self.last_cut = now
+        self.stats['cuts'] += 1
+        if self.max_concurrency:
+            self.concurrency = max(float(self.min_concurrency), self.concurrency * self.decrease)
+        self.set_rate_factor(max(self.min_rate_factor, self.rate_factor * self.decrease))
+
+    def on_success(self):
+        if self.max_concurrency and self.concurrency < self.max_concurrency:
+            # one more slot per window of successful sends, as TCP congestion avoidance does
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1.0 / max(self.concurrency, 1))
+        if self.rate_factor < 1:
+            self.set_rate_factor(min(1.0, self.rate_factor + self.rate_increase))
+
+    def set_rate_factor(self, factor):
+        self.rate_factor = factor
+        for name, bucket in self.buckets.items():
+            if name != 'connections':
+                bucket.set_rate(self.ceilings[name] * factor)
+
+    def get_state(self):
+        """
+        :return: dict with the current limits, the sends in flight and the counters
+        """
+        with self._condition:
+            state = dict(self.stats)
+            state.update({
+                'concurrency': self.get_concurrency_limit(),
+                'in_flight': self.in_flight,
+                'rate_factor': self.rate_factor,
+                'rates': dict((name, bucket.rate) for name, bucket in self.buckets.items()),
+                'tokens': dict((name, bucket.tokens) for name, bucket in self.buckets.items()),
+            })
+            return state
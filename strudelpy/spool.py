@@ -0,0 +1,337 @@
+"""
+A durable on-disk queue of compiled emails, retried with exponential backoff.
+
+spool = Spool('/var/spool/myapp')
+spool.add(email)
+...
+spool.process(smtp)  # send what is due, e.g. from a periodic job
+
+Layout of the spool directory:
+    tmp/        files being written, renamed into messages/ once complete
+    messages/   <id>.eml payloads and <id>.json envelopes
+    bounced/    payloads and envelopes of messages which permanently failed or expired
+    index       append-only log of state changes, one JSON record per line
+
+The index is the source of truth: on start it is replayed to rebuild the schedule, holding
+only ids, timestamps and attempt counts in memory, never the messages themselves.
+"""
+
+import heapq
+import json
+import os
+import random
+import smtplib
+import socket
+import threading
+import time
+import uuid
+
+__all__ = ['Spool']
+
+# errors which mean the session can no longer be trusted
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def is_temporary(code):
+    """
+    :return: True if an SMTP reply code is a temporary (4xx) failure or no reply at all
+    """
+    return not 500 <= code < 600
+
+
+class SpoolEntry(object):
+    """
+    The schedule of a spooled message. Slotted, as a recovered spool may hold millions.
+    """
+    __slots__ = ('id', 'created', 'attempts', 'next_attempt')
+
+    def __init__(self, message_id, created, attempts=0, next_attempt=None):
+        self.id = message_id
+        self.created = created
+        self.attempts = attempts
+        self.next_attempt = created if next_attempt is None else next_attempt
+
+
+class Spool(object):
+    """
+    Stores compiled payloads and their envelopes in a directory, and sends them when due.
+    Temporary failures (4xx replies, dropped connections) are retried with jittered
+    exponential backoff, permanent failures (5xx) and messages older than max_age are bounced:
+    moved to bounced/ and passed to on_bounce.
+    """
+    def __init__(self, path, max_age=5 * 24 * 3600, base_delay=60, max_delay=4 * 3600,
+                 fsync=True, on_bounce=None):
+        """
+        :param path: spool directory, created if missing
+        :param max_age: seconds after which an undelivered message is bounced
+        :param base_delay: delay before the first retry, doubled for every following attempt
+        :param max_delay: upper bound of the retry delay
+        :param fsync: fsync messages and index records before considering them written
+        :param on_bounce: function called with (message_id, sender, recipients, reason) for
+                          every bounced message
+        """
+        self.path = path
+        self.max_age = max_age
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.on_bounce = on_bounce
+        self.entries = {}
+        self._schedule = []
+        self._lock = threading.RLock()
+        for directory in ('tmp', 'messages', 'bounced'):
+            if not os.path.isdir(os.path.join(path, directory)):
+                os.makedirs(os.path.join(path, directory))
+        self.index_path = os.path.join(path, 'index')
+        self.recover()
+        self._index = open(self.index_path, 'a')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self._index.close()
+
+    def get_path(self, message_id, extension, directory='messages'):
+        return os.path.join(self.path, directory, message_id + extension)
+
+    def recover(self):
+        """
+        Rebuild the schedule by replaying the index. Records cut short by a crash are ignored.
+        """
+        entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index:
+                for line in index:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    op = record.get('op')
+                    if op == 'add':
+                        entries[record['id']] = SpoolEntry(record['id'], record['created'])
+                    elif op == 'defer' and record['id'] in entries:
+                        entry = entries[record['id']]
+                        entry.attempts = record['attempts']
+                        entry.next_attempt = record['next']
+                    elif op in ('done', 'bounce'):
+                        entries.pop(record['id'], None)
+        with self._lock:
+            self.entries = entries
+            self._schedule = [(entry.next_attempt, entry.id) for entry in entries.values()]
+            heapq.heapify(self._schedule)
+
+    def compact(self):
+        """
+        Rewrite the index with only the records needed to describe the pending messages
+        """
+        with self._lock:
+            temp_path = os.path.join(self.path, 'tmp', 'index')
+            with open(temp_path, 'w') as index:
+                for entry in self.entries.values():
+                    index.write(json.dumps({'op': 'add', 'id': entry.id, 'created': entry.created}) + '\n')
+                    if entry.attempts:
+                        index.write(json.dumps({'op': 'defer', 'id': entry.id, 'attempts': entry.attempts,
+                                                'next': entry.next_attempt}) + '\n')
+                self._sync(index)
+            self._index.close()
+            os.rename(temp_path, self.index_path)
+            self._index = open(self.index_path, 'a')
+
+    def _sync(self, file_object):
+        file_object.flush()
+        if self.fsync:
+            os.fsync(file_object.fileno())
+
+    def _log(self, **record):
+        with self._lock:
+            self._index.write(json.dumps(record) + '\n')
+            self._sync(self._index)
+
+    def _write(self, message_id, extension, data):
+        """
+        Write a message file atomically: to tmp/ first, then renamed into messages/
+        """
+        temp_path = self.get_path(message_id, extension, 'tmp')
+        with open(temp_path, 'wb') as output:
+            output.write(data)
+            self._sync(output)
+        os.rename(temp_path, self.get_path(message_id, extension))
+
+    def add(self, email):
+        """
+        Compile an Email and spool it
+        :return: the spooled message id
+        """
+        return self.add_compiled(email.sender, email.get_envelope_recipients(), email.get_payload_bytes())
+
+    def add_compiled(self, sender, recipients, payload, now=None):
+        """
+        Spool an already serialised payload
+        :return: the spooled message id
+        """
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        message_id = uuid.uuid4().hex
+        created = time.time() if now is None else now
+        self._write(message_id, '.eml', payload)
+        self._write_envelope(message_id, sender, recipients)
+        self._log(op='add', id=message_id, created=created)
+        with self._lock:
+            self.entries[message_id] = SpoolEntry(message_id, created)
+            heapq.heappush(self._schedule, (created, message_id))
+        return message_id
+
+    def _write_envelope(self, message_id, sender, recipients):
+        self._write(message_id, '.json', json.dumps({'sender': sender, 'recipients': recipients}).encode('utf-8'))
+
+    def read(self, message_id):
+        """
+        :return: (sender, recipients, payload) of a spooled message
+        """
+        with open(self.get_path(message_id, '.json'), 'rb') as envelope_file:
+            envelope = json.loads(envelope_file.read().decode('utf-8'))
+        with open(self.get_path(message_id, '.eml'), 'rb') as payload_file:
+            payload = payload_file.read()
+        return envelope['sender'], envelope['recipients'], payload
+
+    def get_delay(self, attempts):
+        """
+        :return: seconds to wait before the next attempt, with jitter between half and all of
+                 the exponential delay
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def due(self, now=None):
+        """
+        Pop the ids of messages due for delivery from the schedule
+        """
+        now = time.time() if now is None else now
+        while True:
+            with self._lock:
+                if not self._schedule or self._schedule[0][0] > now:
+                    return
+                next_attempt, message_id = heapq.heappop(self._schedule)
+                entry = self.entries.get(message_id)
+            # skip stale schedule items left by deferrals and completed messages
+            if entry is not None and entry.next_attempt == next_attempt:
+                yield message_id
+
+    def defer(self, message_id, reason, now=None):
+        """
+        Schedule another attempt, or bounce the message if it's past max_age
+        """
+        now = time.time() if now is None else now
+        entry = self.entries[message_id]
+        if now - entry.created >= self.max_age:
+            return self.bounce(message_id, 'Expired after %d attempts: %s' % (entry.attempts + 1, reason))
+        entry.attempts += 1
+        entry.next_attempt = now + self.get_delay(entry.attempts)
+        self._log(op='defer', id=message_id, attempts=entry.attempts, next=entry.next_attempt,
+                  error=str(reason))
+        with self._lock:
+            heapq.heappush(self._schedule, (entry.next_attempt, message_id))
+        return 'deferred'
+
+    def bounce(self, message_id, reason, recipients=None):
+        """
+        Give up on a message, or on some of its recipients
+        :param recipients: the recipients which failed, if not all of them
+        """
+        sender, all_recipients, _ = self.read(message_id)
+        if recipients is None or set(recipients) >= set(all_recipients):
+            for extension in ('.eml', '.json'):
+                os.rename(self.get_path(message_id, extension), self.get_path(message_id, extension, 'bounced'))
+            self._log(op='bounce', id=message_id, error=str(reason))
+            with self._lock:
+                self.entries.pop(message_id, None)
+            recipients = all_recipients
+        if self.on_bounce:
+            self.on_bounce(message_id, sender, recipients, reason)
+        return 'bounced'
+
+    def done(self, message_id):
+        self._log(op='done', id=message_id)
+        with self._lock:
+            self.entries.pop(message_id, None)
+        for extension in ('.eml', '.json'):
+            os.remove(self.get_path(message_id, extension))
+        return 'sent'
+
+    def deliver(self, smtp, message_id, now=None):
+        """
+        Attempt to deliver one spooled message over a logged in SMTP object
+        :return: one of 'sent', 'deferred' or 'bounced'
+        """
+        sender, recipients, payload = self.read(message_id)
+        try:
+            refused = smtp.send_compiled(sender, recipients, payload)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except smtplib.SMTPResponseException as e:
+            if is_temporary(e.smtp_code):
+                return self.defer(message_id, e, now)
+            return self.bounce(message_id, e)
+        if not refused:
+            return self.done(message_id)
+        permanent = dict((r, reply) for r, reply in refused.items() if not is_temporary(reply[0]))
+        temporary = [r for r in recipients if r in refused and r not in permanent]
+        if temporary:
+            if permanent:
+                self.bounce(message_id, permanent, recipients=list(permanent))
+            self._write_envelope(message_id, sender, temporary)
+            return self.defer(message_id, dict((r, refused[r]) for r in temporary), now)
+        if len(permanent) == len(recipients):
+            return self.bounce(message_id, permanent)
+        self.bounce(message_id, permanent, recipients=list(permanent))
+        return self.done(message_id)
+
+    def process(self, smtp, now=None, limit=None):
+        """
+        Send the messages which are due. The SMTP object is logged in if it isn't already,
+        and re-logged in if the connection drops. If the server can't be reached, the
+        remaining messages are left for the next run.
+        :param smtp: SMTP object to send with
+        :param limit: maximum number of messages to attempt
+        :return: dict with the number of messages sent, deferred and bounced
+        """
+        counts = {'sent': 0, 'deferred': 0, 'bounced': 0}
+        opened = False
+        try:
+            for i, message_id in enumerate(self.due(now)):
+                if limit is not None and i >= limit:
+                    with self._lock:
+                        heapq.heappush(self._schedule, (self.entries[message_id].next_attempt, message_id))
+                    break
+                if smtp.client is None:
+                    try:
+                        smtp.login()
+                        opened = True
+                    except CONNECTION_ERRORS + (smtplib.SMTPException,) as e:
+                        self._close_session(smtp)
+                        counts[self.defer(message_id, e, now)] += 1
+                        break
+                try:
+                    counts[self.deliver(smtp, message_id, now)] += 1
+                except CONNECTION_ERRORS as e:
+                    self._close_session(smtp)
+                    counts[self.defer(message_id, e, now)] += 1
+        finally:
+            if opened:
+                self._close_session(smtp)
+        return counts
+
+    def _close_session(self, smtp):
+        """
+        Close the connection of an SMTP object, quietly dropping the socket if the server is
+        already gone
+        """
+        if smtp.client is None:
+            return
+        try:
+            smtp.close()
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            if hasattr(smtp.client, 'close'):
+                smtp.client.close()
+        smtp.client = None
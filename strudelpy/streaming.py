@@ -0,0 +1,264 @@
+"""
+Helpers to serialise and transmit messages in bounded chunks, so file attachments are never
+held in memory as a whole.
+"""
+
+import base64
+import mmap
+import os
+import re
+
+__all__ = ['PayloadStream', 'quote_data', 'iter_quoted_data', 'iter_bdat_chunks', 'get_wire_size', 'get_encoded_size',
+           'is_7bit', 'is_7bit_file', 'has_long_lines', 'STREAM_CHUNK_SIZE', 'BDAT_CHUNK_SIZE', 'MAX_LINE_LENGTH']
+
+CRLF = b'\r\n'
+
+# a whole number of 57 byte groups, each of which encodes to a single 76 character base64 line
+STREAM_CHUNK_SIZE = 57 * 1024
+
+# size of the BDAT chunks (RFC 3030) messages are sent in
+BDAT_CHUNK_SIZE = 1024 * 1024
+
+# the longest line SMTP allows, without its CRLF (RFC 5321 4.5.3.1.6)
+MAX_LINE_LENGTH = 998
+
+_encodebytes = getattr(base64, 'encodebytes', None) or base64.encodestring
+
+_line_ending = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+_leading_dot = re.compile(br'(?m)^\.')
+_ascii = bytes(bytearray(range(128)))
+
+
+def _quote_lines(data):
+    return _leading_dot.sub(b'..', _line_ending.sub(CRLF, data))
+
+
+def has_long_lines(data, limit=MAX_LINE_LENGTH):
+    """
+    :param data: bytes
+    :return: True if a line of data is longer than limit
+    """
+    return any(len(line) > limit for line in data.splitlines())
+
+
+def is_7bit(text):
+    """
+    :param text: str or bytes
+    :return: True if text can be sent as it is: ascii, without lines longer than SMTP allows
+    """
+    try:
+        data = text if isinstance(text, bytes) else text.encode('ascii')
+        data.decode('ascii')
+    except UnicodeError:
+        return False
+    return not has_long_lines(data)
+
+
+def is_7bit_file(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    The streaming version of is_7bit: the file is read chunk by chunk
+    :param path: path to the file
+    :return: True if the file can be sent as it is
+    """
+    line = 0
+    for chunk in iter_file_chunks(path, chunk_size):
+        if chunk.translate(None, _ascii):
+            return False
+        lengths = [len(piece) for piece in _line_ending.split(chunk)]
+        # the first line of a chunk continues the last line of the previous one
+        lengths[0] += line
+        if max(lengths) > MAX_LINE_LENGTH:
+            return False
+        line = lengths[-1]
+    return True
+
+
+def get_wire_size(data):
+    """
+    :return: the size of data once its LF line endings are sent as CRLF
+    """
+    return len(data) + data.count(b'\n') - data.count(CRLF)
+
+
+def get_encoded_size(size, encoding='base64'):
+    """
+    :param size: size of a file in bytes
+    :param encoding: 'base64', or None for files included as they are
+    :return: the size of the file once encoded as iter_base64 does, with CRLF line endings
+    """
+    if encoding != 'base64':
+        return size
+    lines, remainder = divmod(size, 57)
+    # 57 bytes encode to a 76 character line
+    return lines * 78 + ((remainder + 2) // 3 * 4 + 2 if remainder else 0)
+
+
+def quote_data(payload):
+    """
+    Prepare a message payload for the DATA command: normalise line endings to CRLF, escape
+    leading dots and append the end of data marker.
+    :param payload: the message as bytes
+    :return: bytes ready to be written to the socket after a 354 reply
+    """
+    payload = _quote_lines(payload)
+    if not payload.endswith(CRLF):
+        payload += CRLF
+    return payload + b'.' + CRLF
+
+
+def iter_quoted_data(chunks):
+    """
+    The streaming version of quote_data. Chunks are cut at line boundaries so line endings
+    and leading dots are handled correctly across chunks.
+    :param chunks: an iterable of bytes
+    :return: generator of bytes ready to be written to the socket after a 354 reply
+    """
+    tail = b''
+    for chunk in chunks:
+        data = tail + chunk if tail else chunk
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            yield _quote_lines(data[:cut])
+        tail = data[cut:]
+    if tail:
+        yield _quote_lines(tail) + CRLF
+    yield b'.' + CRLF
+
+
+def normalise_line_endings(data):
+    """
+    :return: data with CRLF line endings. Data which already has them is returned as is,
+             after counting its line endings rather than rewriting it
+    """
+    crlf = data.count(CRLF)
+    if data.count(b'\n') == crlf and data.count(b'\r') == crlf:
+        return data
+    return _line_ending.sub(CRLF, data)
+
+
+def iter_bdat_chunks(payload, chunk_size=BDAT_CHUNK_SIZE):
+    """
+    Cut a payload into the chunks of BDAT commands. Unlike DATA, BDAT needs no dot stuffing
+    and no end of data marker: an already serialised payload with CRLF line endings is sent
+    as it is, in slices which share its memory.
+    :param payload: the message as bytes, or an iterable of bytes (e.g. a PayloadStream)
+    :param chunk_size: maximum size of a chunk
+    :return: generator of bytes-like chunks
+    """
+    if isinstance(payload, bytes):
+        payload = normalise_line_endings(payload)
+        if not payload.endswith(CRLF):
+            payload += CRLF
+        view = memoryview(payload)
+        for offset in range(0, len(payload), chunk_size):
+            yield view[offset:offset + chunk_size]
+        return
+    # line endings are normalised up to the last line feed of the data read so far, so a CRLF
+    # split across two chunks is seen whole
+    buffered = []
+    size = 0
+    tail = b''
+    for chunk in payload:
+        data = tail + chunk if tail else chunk
+        cut = data.rfind(b'\n') + 1
+        tail = data[cut:]
+        if not cut:
+            continue
+        data = normalise_line_endings(data[:cut])
+        buffered.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            data = b''.join(buffered)
+            for offset in range(0, len(data) - chunk_size + 1, chunk_size):
+                yield data[offset:offset + chunk_size]
+            rest = data[len(data) - len(data) % chunk_size:]
+            buffered = [rest] if rest else []
+            size = len(rest)
+    if tail:
+        buffered.append(normalise_line_endings(tail) + CRLF)
+    if buffered:
+        yield b''.join(buffered)
+
+
+def iter_file_chunks(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the content of a file in chunks of chunk_size bytes (the last one may be shorter),
+    memory mapping the file where the platform allows it.
+    """
+    with open(path, 'rb') as source:
+        try:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError, mmap.error):
+            # empty files and some file systems can't be mapped
+            mapped = None
+        if mapped is None:
+            chunk = source.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = source.read(chunk_size)
+            return
+        try:
+            for offset in range(0, len(mapped), chunk_size):
+                yield mapped[offset:offset + chunk_size]
+        finally:
+            mapped.close()
+
+
+def iter_base64(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the base64 encoding of a file in 76 character lines, exactly as
+    email.encoders.encode_base64 would produce it.
+    :param chunk_size: raw bytes encoded at a time. Must be a multiple of 57
+    """
+    if chunk_size % 57:
+        raise ValueError('chunk_size must be a multiple of 57')
+    for chunk in iter_file_chunks(path, chunk_size):
+        yield _encodebytes(chunk)
+
+
+class PayloadStream(object):
+    """
+    A serialised message made of in-memory segments (headers, bodies, boundaries) and file
+    segments which are read and encoded from disk each time the stream is iterated.
+    """
+    def __init__(self, segments, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        :param segments: list of bytes, or (path, encoding) tuples where encoding is 'base64'
+                         or None for files included as they are
+        :param chunk_size: size of the chunks file segments are read in
+        """
+        self.segments = segments
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            path, encoding = segment
+            if encoding == 'base64':
+                chunks = iter_base64(path, self.chunk_size)
+            else:
+                chunks = iter_file_chunks(path, self.chunk_size)
+            for chunk in chunks:
+                yield chunk
+
+    def read(self):
+        """
+        :return: the whole payload as bytes
+        """
+        return b''.join(self)
+
+    def get_size(self):
+        """
+        :return: the size of the payload on the wire (before dot stuffing), computed from the
+                 file sizes without reading the files
+        """
+        size = 0
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                size += get_wire_size(segment)
+            else:
+                path, encoding = segment
+                size += get_encoded_size(os.stat(path).st_size, encoding)
+        return size
@@ -0,0 +1,161 @@
+"""
+Precompiled emails for high volume mail merge.
+
+template = EmailTemplate(sender='me@example.com', subject='Hello $name',
+                         text='Dear $name, your invoice is attached', attachments=['/path/to/invoice.pdf'])
+for name, address in customers:
+    smtp.send(template.render(recipients=[address], name=name))
+
+The MIME structure, boundaries, static headers and encoded attachments are compiled once.
+Rendering only encodes the recipients, subject, dates and bodies, and splices them between
+the pre-rendered segments.
+"""
+
+import re
+import uuid
+from email.charset import Charset
+from email.policy import compat32
+from email.utils import formatdate, make_msgid
+from string import Template
+
+from strudelpy import Email
+from strudelpy.streaming import get_wire_size, normalise_line_endings
+
+__all__ = ['EmailTemplate', 'RenderedEmail']
+
+# the header folding used by Message.as_string()
+_header_policy = compat32.clone(max_line_length=0)
+
+
+def fold_header(name, value):
+    """
+    :return: the header value as Message.as_string() would write it, without the name
+    """
+    return _header_policy.fold(name, value)[len(name) + 2:-1]
+
+
+# headers regenerated for every rendered email
+PERSONALISED_HEADERS = ('To', 'Subject', 'Date', 'Message-ID')
+
+
+class RenderedEmail(Email):
+    """
+    An Email rendered from an EmailTemplate. It behaves like any other Email, but its payload
+    is already serialised, as 7bit text: it is sent, streamed, compacted and signed as it is,
+    rather than compiled from the fields.
+    """
+    def __init__(self, payload, **kwargs):
+        super(RenderedEmail, self).__init__(**kwargs)
+        self.payload = payload
+
+    def compile_message(self, eight_bit=False, smtputf8=False):
+        """
+        :return: the Message parsed from the rendered payload
+        """
+        from email import message_from_string
+        self.message = message_from_string(self.payload)
+        self.compiled = True
+        return self.message
+
+    def get_payload(self):
+        return self.sign(self.payload)
+
+    def get_payload_bytes(self, eight_bit=False, smtputf8=False):
+        # the rendered payload is 7bit, which is valid whatever the server supports
+        return self.sign(self.get_wire_payload())
+
+    def get_stream_segments(self, eight_bit=False, smtputf8=False):
+        return [self.get_wire_payload()]
+
+    def get_wire_payload(self):
+        """
+        :return: the rendered payload as bytes with CRLF line endings, as Email.get_payload_bytes()
+        """
+        return normalise_line_endings(self.payload.encode('ascii'))
+
+    def estimate_size(self, eight_bit=False, smtputf8=False):
+        size = get_wire_size(self.payload.encode('ascii'))
+        if self.dkim_signer is not None:
+            size += self.dkim_signer.estimate_size()
+        return size
+
+
+class EmailTemplate(object):
+    """
+    An email compiled once and rendered for many recipients.
+    The subject, text and html may contain $placeholders (string.Template syntax) which are
+    filled in by render().
+    """
+    def __init__(self, sender=None, cc=[], bcc=[], subject=None, text=None, html=None,
+                 charset=None, attachments=[], embedded=[], headers=[]):
+        self.email = Email(sender=sender, recipients=[], cc=cc, bcc=bcc, subject=subject,
+                           text=text, html=html, charset=charset, attachments=attachments,
+                           embedded=embedded, headers=headers)
+        self.charset = Charset(self.email.charset)
+        self.subject = Template(subject or '')
+        self.bodies = {}
+        if text:
+            self.bodies['plain'] = Template(text)
+        if html:
+            self.bodies['html'] = Template(html)
+        # bodies without placeholders are only encoded once
+        self.static_bodies = dict(
+            (subtype, self.encode_body(body.template))
+            for subtype, body in self.bodies.items() if not body.pattern.search(body.template)
+        )
+        self.segments = self.compile()
+
+    def compile(self):
+        """
+        Serialise the message once with markers in place of the personalised headers and
+        bodies.
+        :return: list of static strings and marker keys
+        """
+        marker_prefix = 'strudelpy-template-{0}-'.format(uuid.uuid4().hex)
+        message = self.email.compile_message()
+        headers = message.items()
+        for name, _ in headers:
+            del message[name]
+        for name, value in headers:
+            message[name] = marker_prefix + name if name in PERSONALISED_HEADERS else value
+            if name == 'From':
+                message['To'] = marker_prefix + 'To'
+        for part in message.walk():
+            if part.get_content_maintype() == 'text' and part.get_content_subtype() in self.bodies \
+                    and 'Content-Disposition' not in part:
+                part.set_payload(marker_prefix + part.get_content_subtype())
+        pieces = re.split('({0}[A-Za-z-]+)'.format(re.escape(marker_prefix)), message.as_string())
+        segments = []
+        for piece in pieces:
+            if piece.startswith(marker_prefix):
+                segments.append((piece[len(marker_prefix):],))
+            elif piece:
+                segments.append(piece)
+        return segments
+
+    def encode_body(self, body):
+        return self.charset.body_encode(body)
+
+    def render(self, recipients, **context):
+        """
+        Render the template for one set of recipients
+        :param recipients: A list of email address or list/tuple of (name, email) pairs.
+        :param context: values for the $placeholders in the subject and bodies
+        :return: RenderedEmail
+        """
+        if type(recipients) not in (list, tuple):
+            recipients = [recipients]
+        email = self.email
+        subject = self.subject.substitute(context)
+        values = {
+            'To': fold_header('To', email.format_email_address('to', recipients)),
+            'Subject': fold_header('Subject', email.get_header('subject', subject)),
+            'Date': fold_header('Date', formatdate(localtime=True)),
+            'Message-ID': fold_header('Message-ID', make_msgid(str(uuid.uuid4()))),
+        }
+        for subtype, body in self.bodies.items():
+            values[subtype] = self.static_bodies.get(subtype) or self.encode_body(body.substitute(context))
+        payload = ''.join(values[segment[0]] if type(segment) is tuple else segment
+                          for segment in self.segments)
+        return RenderedEmail(payload, sender=email.sender, recipients=recipients, cc=email.cc,
+                             bcc=email.bcc, subject=subject, charset=email.charset)
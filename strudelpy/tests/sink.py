@@ -0,0 +1,237 @@
+"""
+An in-process SMTP server which accepts and discards mail, for tests and benchmarks.
+
+with SMTPSink(latency=0.001, extensions=('PIPELINING', '8BITMIME')) as sink:
+    smtp = SMTP(sink.host, sink.port)
+    ...
+    sink.stats['messages']
+
+It runs an asyncio server in a background thread, so blocking clients can use it from the
+main thread. Replies to any command can be overridden to simulate 4xx/5xx failures.
+"""
+
+import asyncio
+import random
+import threading
+
+__all__ = ['SMTPSink']
+
+DEFAULT_EXTENSIONS = ('PIPELINING', '8BITMIME')
+
+
+class SMTPSink(object):
+    """
+    A minimal ESMTP server. Authentication always succeeds, messages are counted and, with
+    keep_messages, stored in `messages` as (sender, recipients, data) tuples. Messages are
+    accepted with DATA, and with BDAT if CHUNKING is one of the extensions.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, extensions=DEFAULT_EXTENSIONS,
+                 auth=True, replies=None, keep_messages=False, seed=None, tls_context=None,
+                 implicit_tls=False):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, 0 to pick a free one
+        :param latency: seconds to wait before every reply
+        :param extensions: ESMTP extensions advertised in the EHLO reply
+        :param auth: advertise and accept AUTH PLAIN and LOGIN
+        :param replies: dict of command (e.g. 'RCPT') to a (code, text) reply, or to a function
+                        receiving the command argument and returning a reply or None for the
+                        default one
+        :param keep_messages: store the received messages
+        :param seed: seed of the random generator available to reply functions as `random`
+        :param tls_context: server side ssl.SSLContext. STARTTLS is advertised if it is set
+        :param implicit_tls: use TLS from the start of the connection (as SMTP_SSL does)
+                             instead of STARTTLS
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.extensions = list(extensions)
+        if auth:
+            self.extensions.append('AUTH PLAIN LOGIN')
+        self.tls_context = tls_context
+        self.implicit_tls = implicit_tls
+        if tls_context and not implicit_tls:
+            self.extensions.append('STARTTLS')
+        self.replies = replies or {}
+        self.keep_messages = keep_messages
+        self.random = random.Random(seed)
+        self.messages = []
+        self.stats = {
+            'connections': 0,
+            'messages': 0,
+            'recipients': 0,
+            'bytes': 0,
+            'commands': {},
+            'tls_resumed': 0,
+        }
+        self.loop = None
+        self.server = None
+        self._thread = None
+        self._tasks = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle, self.host, self.port,
+                                     ssl=self.tls_context if self.implicit_tls else None))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+            self.server.close()
+            for task in self._tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, name='strudelpy-sink')
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def get_reply(self, command, argument, default):
+        reply = self.replies.get(command)
+        if callable(reply):
+            reply = reply(argument)
+        return reply or default
+
+    async def handle(self, reader, writer):
+        self._tasks.add(asyncio.current_task())
+        self.stats['connections'] += 1
+        try:
+            await self.session(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def reply(self, writer, code, text):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        lines = text if isinstance(text, (list, tuple)) else [text]
+        writer.write(b''.join(
+            ('%d%s%s\r\n' % (code, '-' if i < len(lines) - 1 else ' ', line)).encode('utf-8')
+            for i, line in enumerate(lines)
+        ))
+        await writer.drain()
+
+    def count_resumed(self, writer):
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session_reused:
+            self.stats['tls_resumed'] += 1
+
+    async def session(self, reader, writer):
+        self.count_resumed(writer)
+        await self.reply(writer, 220, 'strudelpy sink ESMTP')
+        sender = None
+        recipients = []
+        chunks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8', 'replace').strip().partition(' ')
+            command = command.upper()
+            self.stats['commands'][command] = self.stats['commands'].get(command, 0) + 1
+            if command == 'EHLO':
+                code, text = self.get_reply(command, argument, (250, ['sink'] + self.extensions))
+            elif command == 'HELO':
+                code, text = self.get_reply(command, argument, (250, 'sink'))
+            elif command == 'AUTH':
+                if argument.upper().startswith('LOGIN'):
+                    for prompt in ('VXNlcm5hbWU6', 'UGFzc3dvcmQ6')[1 if ' ' in argument else 0:]:
+                        await self.reply(writer, 334, prompt)
+                        await reader.readline()
+                code, text = self.get_reply(command, argument, (235, '2.7.0 Authentication successful'))
+            elif command == 'MAIL':
+                code, text = self.get_reply(command, argument, (250, '2.1.0 OK'))
+                sender = argument if code < 400 else None
+                recipients = []
+                chunks = []
+            elif command == 'RCPT':
+                code, text = self.get_reply(command, argument, (250, '2.1.5 OK'))
+                if code < 400:
+                    recipients.append(argument)
+            elif command == 'DATA':
+                if sender is None or not recipients:
+                    code, text = 503, '5.5.1 Bad sequence of commands'
+                else:
+                    await self.reply(writer, 354, 'End data with <CR><LF>.<CR><LF>')
+                    data = await self.read_data(reader)
+                    code, text = self.get_reply(command, argument, (250, '2.0.0 OK queued'))
+                    if code < 400:
+                        self.received(sender, recipients, data)
+                sender = None
+                recipients = []
+            elif command == 'BDAT' and 'CHUNKING' in self.extensions:
+                size, _, last = argument.partition(' ')
+                chunk = await reader.readexactly(int(size))
+                if sender is None or not recipients:
+                    code, text = 503, '5.5.1 Bad sequence of commands'
+                else:
+                    chunks.append(chunk)
+                    code, text = self.get_reply(command, argument, (250, '2.0.0 %d octets received' % len(chunk)))
+                    if code >= 400:
+                        sender = None
+                        recipients = []
+                    elif last.upper() == 'LAST':
+                        self.received(sender, recipients, b''.join(chunks))
+                        sender = None
+                        recipients = []
+                if code >= 400 or last.upper() == 'LAST':
+                    chunks = []
+            elif command == 'STARTTLS' and 'STARTTLS' in self.extensions:
+                await self.reply(writer, 220, '2.0.0 Ready to start TLS')
+                await writer.start_tls(self.tls_context)
+                self.count_resumed(writer)
+                sender = None
+                recipients = []
+                continue
+            elif command == 'RSET':
+                sender = None
+                recipients = []
+                chunks = []
+                code, text = 250, '2.0.0 OK'
+            elif command == 'NOOP':
+                code, text = 250, '2.0.0 OK'
+            elif command == 'QUIT':
+                await self.reply(writer, 221, '2.0.0 Bye')
+                return
+            else:
+                code, text = 502, '5.5.2 Command not recognised'
+            await self.reply(writer, code, text)
+
+    def received(self, sender, recipients, data):
+        self.stats['messages'] += 1
+        self.stats['recipients'] += len(recipients)
+        self.stats['bytes'] += len(data)
+        if self.keep_messages:
+            self.messages.append((sender, recipients, data))
+
+    async def read_data(self, reader):
+        lines = []
+        while True:
+            line = await reader.readline()
+            if not line or line == b'.\r\n':
+                return b''.join(lines)
+            lines.append(line[1:] if line.startswith(b'.') else line)
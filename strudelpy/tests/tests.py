@@ -9,12 +9,29 @@ By default it will attempt to connect to a 'fake' one that can be run using:
 
 Set TEST_CONFIG_NAME to one of the keys in TEST_CONFIGURATIONS to test a specific configuration
 """
+import base64
+import binascii
 import os
+import re
+import six
 import smtplib
+import shutil
 import socket
+import ssl
+import subprocess
+import sys
+import tempfile
 import unittest
-from strudelpy import Email, SMTP
-from strudelpy import InvalidConfiguration
+from email.header import decode_header, make_header
+from email.utils import getaddresses
+from strudelpy import Email, SMTP, SMTPPool, PartCache, Spool, TLSSessionCache, SegmentTable
+from strudelpy import InvalidConfiguration, quote_data, Hooks, MetricsCollector, AddressEncoder
+from strudelpy import RateLimiter, TokenBucket, FileTransport, DKIMSigner, CapabilityCache
+from strudelpy.streaming import iter_quoted_data
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
 
 TEST_CONFIG_NAME = 'fake'
 
@@ -94,11 +111,187 @@ class TestEmailSend(unittest.TestCase):
             no_sender = True
         self.assertEqual(no_sender, True)
 
+    def test_get_envelope_recipients(self):
+        email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENT_PAIRS'],
+                      cc=['cc@example.com'], bcc='bcc@example.com', subject="Subject")
+        self.assertEqual(email.get_envelope_recipients(),
+                         [pair[1] for pair in TEST_CONFIG['RECIPIENT_PAIRS']] +
+                         ['cc@example.com', 'bcc@example.com'])
+
+    def test_quote_data(self):
+        self.assertEqual(quote_data(b'Subject: dots\n\n.leading\r\nend'),
+                         b'Subject: dots\r\n\r\n..leading\r\nend\r\n.\r\n')
+
+    def test_payload_stream_matches_payload(self):
+        def normalise(payload):
+            payload = re.sub(r'={15}\d+==', 'BOUNDARY', payload)
+            payload = re.sub(r'(Date|Message-ID): .*', '', payload)
+            # the streamed embedded image part only carries one Content-Transfer-Encoding
+            return payload.replace('Content-Transfer-Encoding: base64\n' * 2,
+                                   'Content-Transfer-Encoding: base64\n')
+
+        kwargs = dict(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                      subject='Test: test_payload_stream_matches_payload',
+                      text='Simple text only body', html='<img src="cid:cat.jpg">',
+                      attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')],
+                      embedded=[os.path.join(BASE_DIR, 'tests', 'cat.jpg')])
+        stream = Email(**kwargs).get_payload_stream(chunk_size=57 * 4)
+        self.assertEqual(normalise(stream.read().decode('ascii')),
+                         normalise(Email(**kwargs).get_payload()))
+        self.assertEqual(b''.join(iter_quoted_data(stream)), quote_data(stream.read()))
+
+    @unittest.skipIf(six.PY2, 'message_from_bytes requires Python 3')
+    def test_payload_stream_encodes_files(self):
+        from email import message_from_bytes
+        path = tempfile.mkdtemp()
+        contents = {'blob': b'\x00\x89PNG\r\n.\n\xff' * 100, 'notes.txt': 'Grüße\n'.encode('utf-8')}
+        for name, content in contents.items():
+            with open(os.path.join(path, name), 'wb') as attached_file:
+                attached_file.write(content)
+        try:
+            email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                          subject='Test: test_payload_stream_encodes_files', text='Grüße',
+                          attachments=[os.path.join(path, name) for name in sorted(contents)])
+            email.get_payload_bytes(eight_bit=True)
+            message = message_from_bytes(email.get_payload_stream().read())
+            parts = [part for part in message.walk() if not part.is_multipart()]
+            # the 8bit body compiled before doesn't leak into the stream
+            self.assertEqual(parts[0]['Content-Transfer-Encoding'], 'base64')
+            for part in parts[-2:]:
+                self.assertEqual(part['Content-Transfer-Encoding'], 'base64')
+                self.assertEqual(part.get_payload(decode=True), contents[part.get_filename()])
+        finally:
+            shutil.rmtree(path)
+
+    def test_part_cache(self):
+        cache = PartCache()
+        attachment = os.path.join(BASE_DIR, 'tests', 'doctest.doc')
+        parts = []
+        for i in range(3):
+            email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                          subject='Test: test_part_cache', text='Simple text only body')
+            email.part_cache = cache
+            parts.append(email.get_file_attachment(attachment))
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['hits'], 2)
+        self.assertEqual(parts[0].as_string(), parts[2].as_string())
+        self.assertTrue(parts[1].get_payload() is parts[2].get_payload())
+
+    def test_part_cache_eviction(self):
+        email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                      subject='Test: test_part_cache_eviction', text='Simple text only body')
+        email.part_cache = PartCache(max_bytes=50000)
+        email.get_file_attachment(os.path.join(BASE_DIR, 'tests', 'doctest.doc'))
+        email.get_embedded_image(os.path.join(BASE_DIR, 'tests', 'cat.jpg'))
+        self.assertTrue(email.part_cache.stats['evictions'] >= 1)
+        self.assertTrue(email.part_cache.stats['bytes'] <= 50000)
+
+    @unittest.skipIf(six.PY2, 'bytes serialisation requires Python 3')
+    def test_payload_bytes_eight_bit(self):
+        email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENT_PAIRS'],
+                      subject='Test: עברית test_payload_bytes_eight_bit',
+                      text='Simple text only body בעברית',
+                      html='<strong>Complicated עברית</strong>')
+        seven_bit = email.get_payload_bytes()
+        eight_bit = email.get_payload_bytes(eight_bit=True)
+        self.assertTrue(b'Content-Transfer-Encoding: 8bit\r\n' in eight_bit)
+        self.assertTrue('בעברית'.encode('utf-8') in eight_bit)
+        self.assertTrue(b'Content-Transfer-Encoding: base64\r\n' in seven_bit)
+        self.assertTrue(len(eight_bit) < len(seven_bit))
+        self.assertFalse('Subject: Test: עברית'.encode('utf-8') in eight_bit)
+        utf8 = email.get_payload_bytes(eight_bit=True, smtputf8=True)
+        self.assertTrue('Subject: Test: עברית'.encode('utf-8') in utf8)
+        # a body with lines over the SMTP limit is transfer encoded all the same
+        email.html = '<p>%s</p>' % ('עברית ' * 200)
+        long_lines = email.get_payload_bytes(eight_bit=True)
+        self.assertTrue(b'Content-Transfer-Encoding: 8bit\r\n' in long_lines)
+        self.assertTrue(max(len(line) for line in long_lines.split(b'\r\n')) <= 998)
+
+    def test_recompile_on_change(self):
+        def normalise(payload):
+            payload = re.sub(r'={15}\d+==', 'BOUNDARY', payload)
+            return re.sub(r'(Date|Message-ID): .*', '', payload)
+
+        kwargs = dict(sender=TEST_CONFIG['FROM'], recipients=list(TEST_CONFIG['RECIPIENTS']),
+                      subject='Test: test_recompile_on_change', text='Simple text only body',
+                      html='<strong>html body</strong>',
+                      attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')])
+        email = Email(**kwargs)
+        email.get_payload()
+        body, attachment = email.message.get_payload()
+        email.subject = 'Test: test_recompile_on_change 2'
+        email.add_recipient(('Mario Plumber', 'mario@example.com'))
+        self.assertEqual(email.get_changes(), set(['headers']))
+        payload = email.get_payload()
+        self.assertTrue(email.message.get_payload(0) is body)
+        expected = Email(**dict(kwargs, subject='Test: test_recompile_on_change 2',
+                                recipients=email.recipients))
+        self.assertEqual(normalise(payload), normalise(expected.get_payload()))
+
+        email.attachments = email.attachments + [os.path.join(BASE_DIR, 'tests', 'cat.jpg')]
+        email.text = 'Changed text body'
+        self.assertEqual(email.get_changes(), set(['body', 'parts']))
+        payload = email.get_payload()
+        self.assertTrue(email.message.get_payload(1) is attachment)
+        expected = Email(**dict(kwargs, subject='Test: test_recompile_on_change 2', text='Changed text body',
+                                recipients=email.recipients, attachments=email.attachments))
+        self.assertEqual(normalise(payload), normalise(expected.get_payload()))
+
+    @unittest.skipIf(six.PY2, 'bytes serialisation requires Python 3')
+    def test_compact(self):
+        table = SegmentTable()
+        compacts = []
+        for i in range(2):
+            email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                          subject='Test: test_compact %d' % i, text='Simple text only body',
+                          attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')],
+                          embedded=[os.path.join(BASE_DIR, 'tests', 'cat.jpg')])
+            payload = email.get_payload_bytes()
+            compacts.append(email.compact(table))
+            self.assertEqual(compacts[-1].get_payload_bytes(), payload)
+            self.assertTrue(email.message is None)
+        self.assertEqual(compacts[0].get_envelope_recipients(), TEST_CONFIG['RECIPIENTS'])
+        self.assertEqual(table.stats['hits'], 2)
+        self.assertTrue(compacts[0].segments[1] is compacts[1].segments[1])
+        self.assertFalse(hasattr(compacts[0], '__dict__'))
+
+    def test_has_non_ascii_headers(self):
+        self.assertFalse(Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENT_PAIRS'],
+                               subject='Subject', text='בעברית').has_non_ascii_headers())
+        self.assertTrue(Email(sender=TEST_CONFIG['FROM'], recipients=[('הראל', 'harel@example.com')],
+                              subject='Subject').has_non_ascii_headers())
+
     def test_format_email_address(self):
         email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'], subject="Subject")
         header = email.format_email_address('from', TEST_CONFIG['RECIPIENTS'])
         self.assertEqual(str(header), "harel@harelmalka.com")
 
+    def test_address_encoder(self):
+        encoder = AddressEncoder()
+        addresses = [('Recipient %d' % i, 'rcpt%d@example.com' % i) for i in range(200)]
+        addresses += ['plain@example.com', (u'הראל', 'harel@example.com'), ('Smith, John', 'js@example.com')]
+        header = encoder.encode(addresses, header_name='To')
+        folded = header.encode(linesep='\r\n')
+        self.assertTrue(all(len(line) <= 78 for line in ('To: ' + folded).split('\r\n')))
+        self.assertTrue(all(ord(char) < 128 for char in folded))
+        decoded = six.text_type(make_header(decode_header(folded.replace('\r\n', ''))))
+        self.assertEqual(getaddresses([decoded]), [a if isinstance(a, tuple) else ('', a) for a in addresses])
+        self.assertEqual(getaddresses([header.fold_utf8().replace('\n', '')]), getaddresses([decoded]))
+        encoder.encode(addresses[:10], header_name='Cc')
+        self.assertEqual(encoder.stats, {'hits': 10, 'misses': len(addresses)})
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'lazy imports require Python 3.7')
+    def test_lazy_imports(self):
+        probe = ('import sys; from strudelpy import Email, SMTP; '
+                 'print(" ".join(m for m in ("smtplib", "ssl", "asyncio", "mimetypes", "email.mime.base") '
+                 'if m in sys.modules))')
+        loaded = subprocess.check_output([sys.executable, '-c', probe], cwd=os.path.dirname(BASE_DIR))
+        self.assertEqual(loaded.strip(), b'')
+        from strudelpy import AsyncSMTP, Dispatcher  # noqa: F401
+        from strudelpy.mime import guess_type
+        self.assertEqual(guess_type('/tmp/Report.PDF'), 'application/pdf')
+        self.assertEqual(guess_type('/tmp/archive.tar.gz'), 'application/x-tar')
+
 
     def test_simple_text_only_single_recipient(self):
         with self.smtp as smtp:
@@ -214,6 +407,906 @@ class TestEmailSend(unittest.TestCase):
         self.assertTrue(timedout)
         self.assertTrue('timed out' in message)
 
+    def test_send_stream_attachments(self):
+        with self.smtp as smtp:
+            response = smtp.send_stream(Email(sender=TEST_CONFIG['FROM'],
+                                              recipients=TEST_CONFIG['RECIPIENTS'],
+                                              subject='Test: test_send_stream_attachments',
+                                              text='Simple text only body',
+                                              attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc'),
+                                                           os.path.join(BASE_DIR, 'tests', 'cat.jpg')]))
+        self.assertEqual(response, {})
+
+    def test_send_many(self):
+        emails = [Email(sender=TEST_CONFIG['FROM'],
+                        recipients=TEST_CONFIG['RECIPIENTS'],
+                        subject='Test: test_send_many %d' % i,
+                        text='Simple text only body') for i in range(3)]
+        with self.smtp as smtp:
+            results = smtp.send_many(emails)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertEqual(sorted(result.keys()), sorted(TEST_CONFIG['RECIPIENTS']))
+            self.assertTrue(all(reply[0] == 250 for reply in result.values()))
+
+    def test_recipients_split_across_transactions(self):
+        self.smtp.max_recipients = 1
+        with self.smtp as smtp:
+            response = smtp.send(Email(sender=TEST_CONFIG['FROM'],
+                                       recipients=TEST_CONFIG['RECIPIENT_PAIRS'],
+                                       subject='Test: test_recipients_split_across_transactions',
+                                       text='Simple text only body'))
+        self.assertEqual(response, {})
+
+
+class TestSMTPPool(unittest.TestCase):
+    def setUp(self):
+        self.smtp = SMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                         username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                         ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'])
+
+    def get_email(self, subject):
+        return Email(sender=TEST_CONFIG['FROM'],
+                     recipients=TEST_CONFIG['RECIPIENTS'],
+                     subject=subject,
+                     text='Simple text only body')
+
+    def test_pool_reuses_connection(self):
+        with SMTPPool(self.smtp, size=1) as pool:
+            for i in range(3):
+                response = pool.send(self.get_email('Test: test_pool_reuses_connection %d' % i))
+                self.assertEqual(response, {})
+            self.assertEqual(pool.stats['connects'], 1)
+            self.assertEqual(pool.stats['reuses'], 2)
+
+    def test_pool_max_messages_eviction(self):
+        with SMTPPool(self.smtp, size=1, max_messages=1) as pool:
+            pool.send(self.get_email('Test: test_pool_max_messages_eviction 1'))
+            pool.send(self.get_email('Test: test_pool_max_messages_eviction 2'))
+            self.assertEqual(pool.stats['connects'], 2)
+            self.assertEqual(pool.stats['evictions'], 2)
+
+    def test_pool_reconnects_dead_connection(self):
+        with SMTPPool(self.smtp, size=1, health_check_interval=0) as pool:
+            connection = pool.acquire()
+            connection.smtp.client.close()
+            pool.release(connection)
+            response = pool.send(self.get_email('Test: test_pool_reconnects_dead_connection'))
+            self.assertEqual(response, {})
+            self.assertEqual(pool.stats['reconnects'], 1)
+
+    @unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+    def test_pool_resets_reused_connection(self):
+        from strudelpy.tests.sink import SMTPSink
+        for reset_on_reuse, resets in ((True, 2), (False, 0)):
+            with SMTPSink() as sink:
+                with SMTPPool(SMTP(sink.host, sink.port), size=1, reset_on_reuse=reset_on_reuse) as pool:
+                    for i in range(3):
+                        self.assertEqual(pool.send(self.get_email('Test: test_pool_resets %d' % i)), {})
+                    self.assertEqual(pool.stats['reuses'], 2)
+                self.assertEqual(sink.stats['commands'].get('RSET', 0), resets)
+
+    @unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+    def test_pool_does_not_retry_refusals(self):
+        from strudelpy.tests.sink import SMTPSink
+        with SMTPSink(replies={'RCPT': (550, '5.1.1 No such user')}) as sink:
+            with SMTPPool(SMTP(sink.host, sink.port), size=1) as pool:
+                self.assertRaises(smtplib.SMTPRecipientsRefused, pool.send,
+                                  self.get_email('Test: test_pool_does_not_retry_refusals'))
+                self.assertEqual(pool.stats['reconnects'], 0)
+                self.assertEqual(len(pool), 1)
+            self.assertEqual(sink.stats['connections'], 1)
+            self.assertEqual(sink.stats['commands']['MAIL'], 1)
+
+
+class TestSpool(unittest.TestCase):
+    class ReplySMTP(object):
+        """
+        Stands in for SMTP, answering each send with the next of a list of replies
+        """
+        def __init__(self, *replies):
+            self.replies = list(replies)
+            self.client = None
+            self.closes = 0
+
+        def login(self):
+            self.client = True
+
+        def close(self):
+            self.closes += 1
+            self.client = None
+
+        def send_compiled(self, sender, recipients, payload):
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.bounces = []
+        self.spool = Spool(self.path, base_delay=10, max_age=100,
+                           on_bounce=lambda *args: self.bounces.append(args))
+        self.smtp = SMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                         username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                         ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'])
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+
+    def add(self, now=0):
+        return self.spool.add_compiled(TEST_CONFIG['FROM'], ['a@example.com', 'b@example.com'],
+                                       b'Subject: spooled\r\n\r\nbody\r\n', now=now)
+
+    def test_spool_send(self):
+        self.spool.add(Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                             subject='Test: test_spool_send', text='Simple text only body'))
+        self.assertEqual(self.spool.process(self.smtp), {'sent': 1, 'deferred': 0, 'bounced': 0})
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'messages')), [])
+
+    def test_spool_retry_with_backoff(self):
+        message_id = self.add()
+        smtp = self.ReplySMTP(smtplib.SMTPResponseException(451, 'try later'), {})
+        self.assertEqual(self.spool.process(smtp, now=1)['deferred'], 1)
+        entry = self.spool.entries[message_id]
+        self.assertEqual(entry.attempts, 1)
+        self.assertTrue(6 <= entry.next_attempt <= 11)
+        self.assertEqual(self.spool.process(smtp, now=5)['sent'], 0)
+        self.assertEqual(self.spool.process(smtp, now=11)['sent'], 1)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_spool_bounces(self):
+        permanent = self.add(now=0)
+        expired = self.add(now=0.5)
+        smtp = self.ReplySMTP(smtplib.SMTPResponseException(550, 'no such user'),
+                              socket.error('connection reset'))
+        self.assertEqual(self.spool.process(smtp, now=101)['bounced'], 2)
+        self.assertEqual(sorted(bounce[0] for bounce in self.bounces), sorted([permanent, expired]))
+        self.assertEqual(len(os.listdir(os.path.join(self.path, 'bounced'))), 4)
+
+    def test_spool_closes_broken_session(self):
+        self.add()
+        self.add()
+        smtp = self.ReplySMTP(socket.error('connection reset'), {})
+        self.assertEqual(self.spool.process(smtp, now=1), {'sent': 1, 'deferred': 1, 'bounced': 0})
+        # the broken session is closed before logging in again, and the new one at the end
+        self.assertEqual(smtp.closes, 2)
+
+    def test_spool_partial_refusal(self):
+        message_id = self.add()
+        smtp = self.ReplySMTP({'a@example.com': (550, b'no such user'),
+                               'b@example.com': (452, b'mailbox full')})
+        self.assertEqual(self.spool.process(smtp, now=1)['deferred'], 1)
+        self.assertEqual(self.bounces[0][2], ['a@example.com'])
+        self.assertEqual(self.spool.read(message_id)[1], ['b@example.com'])
+
+    def test_spool_recover(self):
+        deferred = self.add(now=0)
+        done = self.add(now=0.5)
+        smtp = self.ReplySMTP(socket.error('connection reset'), {})
+        self.spool.process(smtp, now=1)
+        self.spool.close()
+        with open(os.path.join(self.path, 'index'), 'a') as index:
+            index.write('{"op": "add", "id": "trunc')
+        self.spool = Spool(self.path)
+        self.assertEqual(list(self.spool.entries), [deferred])
+        self.assertEqual(self.spool.entries[deferred].attempts, 1)
+        self.assertFalse(os.path.exists(self.spool.get_path(done, '.eml')))
+        self.spool.compact()
+        self.spool.close()
+        self.spool = Spool(self.path)
+        self.assertEqual(self.spool.entries[deferred].attempts, 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def get_email(self, subject):
+        return Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                     subject=subject, text='Simple text only body')
+
+    def test_hooks(self):
+        events = []
+        email = self.get_email('Test: test_hooks')
+        email.hooks = Hooks(lambda stage, seconds, error, info: events.append((stage, error)))
+        email.get_payload_bytes()
+        self.assertEqual(events, [('compile', None), ('serialise', None)])
+        hooks = Hooks(lambda stage, seconds, error, info: events.append((stage, error, info)))
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            with hooks.timed('send', recipients=1):
+                raise smtplib.SMTPServerDisconnected()
+        stage, error, info = events[-1]
+        self.assertEqual((stage, info), ('send', {'recipients': 1}))
+        self.assertIsInstance(error, smtplib.SMTPServerDisconnected)
+
+    @unittest.skipIf(six.PY2, 'assertLogs requires Python 3')
+    def test_broken_callback(self):
+        events = []
+
+        def broken(stage, seconds, error, info):
+            raise ValueError('broken callback')
+        email = self.get_email('Test: test_broken_callback')
+        email.hooks = Hooks(broken, lambda stage, seconds, error, info: events.append(stage))
+        with self.assertLogs('strudelpy.metrics', 'ERROR') as logs:
+            self.assertTrue(email.get_payload_bytes())
+        self.assertEqual(events, ['compile', 'serialise'])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_collector(self):
+        collector = MetricsCollector(buckets=(0.1, 1))
+        collector('send', 0.05, None, {'recipients': 2, 'bytes': 100})
+        collector('send', 0.5, None, {'recipients': 1, 'bytes': 50})
+        collector('send', 5, smtplib.SMTPServerDisconnected(), {'recipients': 1, 'bytes': 50})
+        snapshot = collector.snapshot()
+        self.assertEqual((snapshot['messages'], snapshot['recipients'], snapshot['bytes']), (2, 3, 150))
+        self.assertEqual(snapshot['stages']['send']['buckets'], [(0.1, 1), (1, 2)])
+        self.assertEqual(snapshot['stages']['send']['errors'], 1)
+        text = collector.prometheus()
+        self.assertIn('strudelpy_stage_seconds_bucket{stage="send",le="1.0"} 2\n', text)
+        self.assertIn('strudelpy_stage_seconds_bucket{stage="send",le="+Inf"} 3\n', text)
+        self.assertIn('strudelpy_messages_sent_total 2\n', text)
+
+    def test_send_metrics(self):
+        collector = MetricsCollector()
+        smtp = SMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                    username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                    ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'])
+        smtp.hooks = Hooks(collector)
+        with smtp:
+            smtp.send(self.get_email('Test: test_send_metrics'))
+        snapshot = collector.snapshot()
+        self.assertEqual(snapshot['messages'], 1)
+        self.assertGreater(snapshot['bytes'], 0)
+        self.assertEqual(snapshot['stages']['connect']['count'], 1)
+
+
+@unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+class TestSMTPSink(unittest.TestCase):
+    def get_email(self, subject, recipients=None):
+        return Email(sender=TEST_CONFIG['FROM'], recipients=recipients or TEST_CONFIG['RECIPIENTS'],
+                     subject=subject, text='Simple text only body')
+
+    def test_sink_send(self):
+        from strudelpy.tests.sink import SMTPSink
+        with SMTPSink(keep_messages=True) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                self.assertEqual(smtp.send(self.get_email('Test: test_sink_send')), {})
+            self.assertEqual(sink.stats['messages'], 1)
+            sender, recipients, data = sink.messages[0]
+            self.assertEqual(len(recipients), len(TEST_CONFIG['RECIPIENTS']))
+            self.assertTrue(data.endswith(b'\r\n\r\nSimple text only body\r\n'))
+
+    def test_sink_replies(self):
+        from strudelpy.tests.sink import SMTPSink
+        replies = {'RCPT': lambda argument: (451, '4.3.0 Try again later') if 'b@' in argument else None}
+        with SMTPSink(replies=replies) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                results = smtp.send_many([self.get_email('Test: test_sink_replies',
+                                                         ['a@example.com', 'b@example.com'])])
+            self.assertEqual(results[0]['a@example.com'][0], 250)
+            self.assertEqual(results[0]['b@example.com'][0], 451)
+            self.assertEqual(sink.stats['commands']['MAIL'], 1)
+
+    def test_smtputf8_transaction(self):
+        from strudelpy.tests.sink import SMTPSink
+        with SMTPSink(extensions=('PIPELINING', '8BITMIME', 'SMTPUTF8'), keep_messages=True) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                self.assertEqual(smtp.send(self.get_email('Test: test_smtputf8', ['עברית@example.com'])), {})
+                # the next transactions of the session are sent with ascii commands again
+                self.assertEqual(smtp.client.command_encoding, 'ascii')
+                self.assertEqual(smtp.send(self.get_email('Test: test_smtputf8')), {})
+            self.assertEqual(sink.messages[0][1], ['TO:<עברית@example.com>'])
+            self.assertEqual(sink.stats['messages'], 2)
+
+    def test_bdat(self):
+        from strudelpy.tests.sink import SMTPSink
+        email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'], subject='Test: test_bdat',
+                      text='.leading dot\nSimple text only body',
+                      attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')])
+        for extensions in (('PIPELINING', 'CHUNKING'), ('CHUNKING',), ('PIPELINING',)):
+            with SMTPSink(extensions=extensions + ('8BITMIME',), keep_messages=True) as sink:
+                with SMTP(sink.host, sink.port, bdat_chunk_size=4096) as smtp:
+                    self.assertEqual(smtp.send(email), {})
+                    self.assertEqual(smtp.send_stream(email, chunk_size=57 * 4), {})
+                self.assertEqual(sink.messages[0][2], email.get_payload_bytes(eight_bit=True))
+                self.assertTrue(b'\r\n.leading dot\r\n' in sink.messages[0][2])
+                stream = sink.messages[1][2]
+                self.assertEqual(stream.count(b'\n'), stream.count(b'\r\n'))
+                if 'CHUNKING' in extensions:
+                    self.assertTrue(sink.stats['commands']['BDAT'] > 2)
+                    self.assertFalse('DATA' in sink.stats['commands'])
+                else:
+                    self.assertEqual(sink.stats['commands']['DATA'], 2)
+
+    def test_send_stream_eight_bit(self):
+        from strudelpy.tests.sink import SMTPSink
+        email = self.get_email('Test: test_send_stream_eight_bit')
+        email.text = 'Grüße'
+        with SMTPSink(keep_messages=True) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                self.assertEqual(smtp.send_stream(email), {})
+            sender, _, data = sink.messages[0]
+            self.assertTrue(sender.endswith(' BODY=8BITMIME'))
+            self.assertTrue('Grüße'.encode('utf-8') in data)
+
+    def test_coalesce(self):
+        from strudelpy import Coalescer
+        from strudelpy.tests.sink import SMTPSink
+        emails = [self.get_email('Test: test_coalesce', [recipient])
+                  for recipient in ('a@one.example', 'b@one.example', 'c@two.example', 'd@one.example')]
+        emails.append(self.get_email('Test: another subject', ['e@one.example']))
+        emails.append(self.get_email('Test: test_coalesce', ['f@one.example', 'a@one.example']))
+        replies = {'RCPT': lambda argument: (550, '5.1.1 No such user') if 'b@' in argument else None}
+        coalescer = Coalescer(max_recipients=2)
+        with SMTPSink(replies=replies, keep_messages=True) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                results = coalescer.send(smtp, emails)
+            self.assertEqual(sink.stats['commands']['MAIL'], 4)
+            # b@ is refused, in a transaction of its own domain with a@
+            self.assertEqual(sorted(recipients for _, recipients, _ in sink.messages),
+                             [['TO:<a@one.example>'], ['TO:<c@two.example>'],
+                              ['TO:<d@one.example>', 'TO:<f@one.example>'], ['TO:<e@one.example>']])
+            merged = sink.messages[0][2]
+            self.assertTrue(b'\r\nTo: undisclosed-recipients:;\r\n' in merged)
+            self.assertFalse(b'a@one.example' in merged)
+        self.assertEqual([sorted(result) for result in results],
+                         [['a@one.example'], ['b@one.example'], ['c@two.example'], ['d@one.example'],
+                          ['e@one.example'], ['a@one.example', 'f@one.example']])
+        self.assertEqual(results[1]['b@one.example'][0], 550)
+        self.assertEqual(results[5]['a@one.example'][0], 250)
+        self.assertEqual(coalescer.stats['transactions'], 4)
+
+    def test_coalesce_multipart(self):
+        from strudelpy import Coalescer
+        from strudelpy.tests.sink import SMTPSink
+        emails = []
+        for index in range(5):
+            email = self.get_email('Test: test_coalesce_multipart', ['user%d@one.example' % index])
+            email.html = '<b>html body</b>'
+            email.attachments = [os.path.join(BASE_DIR, 'tests', 'doctest.doc')]
+            emails.append(email)
+        coalescer = Coalescer()
+        # messages compiled with random boundaries are grouped too
+        groups = coalescer.group(emails, lambda email: (email.get_root_message().as_bytes(), []))
+        self.assertEqual([group.members for group in groups], [[0, 1, 2, 3, 4]])
+        with SMTPSink(keep_messages=True) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                results = coalescer.send(smtp, emails)
+            self.assertEqual(sink.stats['commands']['MAIL'], 1)
+            self.assertEqual(len(sink.messages[0][1]), 5)
+        self.assertEqual([list(result.values())[0][0] for result in results], [250] * 5)
+
+    def test_size_limit(self):
+        from strudelpy import MessageTooLarge
+        from strudelpy.tests.sink import SMTPSink
+        email = self.get_email('Test: test_size_limit')
+        email.attachments = [os.path.join(BASE_DIR, 'tests', 'doctest.doc')]
+        # estimated from the fields and the size of the file, without building the message
+        email.get_root_message = lambda: self.fail('estimate_size() built the message')
+        estimate = email.estimate_size()
+        del email.get_root_message
+        payload = email.get_payload_bytes()
+        self.assertTrue(abs(estimate - len(payload)) < 10)
+        # until the email changes, the size of its last payload is known
+        self.assertEqual(email.estimate_size(), len(payload))
+        email.subject = 'Test: test_size_limit again'
+        self.assertEqual(email.estimate_size(), estimate + len(' again'))
+        with SMTPSink(extensions=('PIPELINING', '8BITMIME', 'SIZE 10000')) as sink:
+            with SMTP(sink.host, sink.port) as smtp:
+                self.assertRaises(MessageTooLarge, smtp.send, email)
+                self.assertRaises(MessageTooLarge, smtp.send_stream, email)
+                self.assertRaises(MessageTooLarge, smtp.send_compiled, email.sender, email.recipients, payload)
+                self.assertEqual(smtp.send(self.get_email('Test: test_size_limit')), {})
+            oversized = []
+            with SMTP(sink.host, sink.port, oversized_handler=oversized.append) as smtp:
+                results = smtp.send_many([email, self.get_email('Test: test_size_limit')])
+            self.assertEqual(sink.stats['commands']['MAIL'], 2)
+        self.assertEqual([error.email for error in oversized], [email])
+        self.assertTrue(oversized[0].size > oversized[0].limit == 10000)
+        self.assertEqual(sorted(results[0]), sorted(email.get_envelope_recipients()))
+        self.assertEqual(set(code for code, _ in results[0].values()), set([552]))
+
+    def test_capability_cache(self):
+        from strudelpy.tests.sink import SMTPSink
+        path = os.path.join(tempfile.mkdtemp(), 'capabilities.json')
+        replies = {'AUTH': lambda argument: (535, '5.7.8 Bad mechanism') if argument.startswith('PLAIN') else None}
+        with SMTPSink(replies=replies) as sink:
+            smtp = SMTP(sink.host, sink.port, username='user', password='secret')
+            smtp.capabilities = CapabilityCache(path)
+            for _ in range(2):
+                with smtp.clone():
+                    pass
+            # PLAIN is only tried by the first session
+            self.assertEqual(sink.stats['commands']['AUTH'], 3)
+        entry = CapabilityCache(path).get(smtp.get_capability_key())
+        self.assertEqual((entry['esmtp'], entry['auth']), (True, 'LOGIN'))
+        shutil.rmtree(os.path.dirname(path))
+        # a server without ESMTP or AUTH: HELO and the raw AUTH LOGIN fallback straight away
+        with SMTPSink(replies={'EHLO': (502, '5.5.1 Unrecognized command')}, auth=False) as sink:
+            smtp.port = sink.port
+            smtp.capabilities = CapabilityCache()
+            for _ in range(2):
+                with smtp.clone() as session:
+                    self.assertEqual(session.send(self.get_email('Test: test_capability_cache')), {})
+            self.assertEqual(sink.stats['connections'], 2)
+            self.assertEqual((sink.stats['commands']['EHLO'], sink.stats['commands']['HELO']), (1, 2))
+        self.assertEqual(smtp.capabilities.stats['fallbacks'], 2)
+        self.assertEqual(smtp.capabilities.stats['helo_skipped'], 1)
+
+    def test_capability_cache_auth_changes(self):
+        from strudelpy.tests.sink import SMTPSink
+        auth_reply = [(502, '5.5.1 Unrecognized command')]
+        with SMTPSink(replies={'AUTH': lambda argument: auth_reply[0]}, auth=False) as sink:
+            smtp = SMTP(sink.host, sink.port, username='user', password='secret')
+            smtp.capabilities = CapabilityCache()
+            key = smtp.get_capability_key()
+            with smtp.clone():
+                pass
+            # a server taking no authentication is asked again by the next session
+            self.assertEqual(smtp.capabilities.get(key)['auth'], None)
+            auth_reply[0] = None
+            with smtp.clone():
+                pass
+            self.assertEqual(smtp.capabilities.get(key)['auth'], 'fallback')
+            # the cached login is refused: forgotten, negotiated again and reported
+            auth_reply[0] = (535, '5.7.8 Bad credentials')
+            session = smtp.clone()
+            self.assertRaises(smtplib.SMTPAuthenticationError, session.login)
+            session.client.close()
+            self.assertEqual(smtp.capabilities.get(key)['auth'], None)
+            self.assertEqual(smtp.capabilities.stats['fallbacks'], 4)
+
+
+@unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+class TestSMTPCluster(unittest.TestCase):
+    def get_email(self):
+        return Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                     subject='Test: TestSMTPCluster', text='Simple text only body')
+
+    def test_is_retryable(self):
+        from strudelpy.cluster import is_retryable
+        self.assertTrue(is_retryable(smtplib.SMTPServerDisconnected('gone')))
+        self.assertTrue(is_retryable(socket.error('reset')))
+        self.assertTrue(is_retryable(smtplib.SMTPSenderRefused(451, b'4.3.0 Try again', 'a@example.com')))
+        self.assertFalse(is_retryable(smtplib.SMTPDataError(554, b'5.7.1 Rejected')))
+        self.assertFalse(is_retryable(smtplib.SMTPNotSupportedError('SMTPUTF8 not supported')))
+        self.assertFalse(is_retryable(smtplib.SMTPException('No suitable authentication method found.')))
+
+    def test_failover_and_probing(self):
+        from strudelpy import SMTPCluster
+        from strudelpy.tests.sink import SMTPSink
+        failing = [True]
+        replies = {'MAIL': lambda argument: (451, '4.3.0 Local error') if failing[0] else None}
+        with SMTPSink() as good, SMTPSink(replies=replies) as bad:
+            now = [0.0]
+            with SMTPCluster([SMTP(good.host, good.port), (SMTP(bad.host, bad.port), 2)], min_samples=2,
+                             ejection_time=10, clock=lambda: now[0]) as cluster:
+                for _ in range(10):
+                    self.assertEqual(cluster.send(self.get_email()), {})
+                self.assertEqual(good.stats['messages'], 10)
+                state = cluster.get_state()
+                self.assertEqual([relay['healthy'] for relay in state], [True, False])
+                self.assertEqual(state[1]['stats']['failures'], 2)
+                failing[0] = False
+                now[0] += 10
+                cluster.send(self.get_email())
+                self.assertEqual(cluster.get_state()[1]['stats']['probes'], 1)
+                self.assertTrue(cluster.get_state()[1]['healthy'])
+                self.assertEqual(bad.stats['messages'], 1)
+
+    def test_weighted(self):
+        from strudelpy import SMTPCluster
+        from strudelpy.tests.sink import SMTPSink
+        with SMTPSink() as first, SMTPSink() as second:
+            with SMTPCluster([SMTP(first.host, first.port), (SMTP(second.host, second.port), 3)],
+                             strategy='weighted') as cluster:
+                for _ in range(8):
+                    cluster.send(self.get_email())
+            self.assertEqual((first.stats['messages'], second.stats['messages']), (2, 6))
+
+
+@unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+class TestTLSResumption(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.path, 'cert.pem')
+        key = os.path.join(cls.path, 'key.pem')
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                   '-keyout', key, '-out', cls.cert, '-days', '1',
+                                   '-subj', '/CN=localhost'], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.path)
+            raise unittest.SkipTest('openssl is required to create a test certificate')
+        cls.server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        cls.server_context.load_cert_chain(cls.cert, key)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def send(self, implicit_tls):
+        from strudelpy.tests.sink import SMTPSink
+        cert = self.cert
+        with SMTPSink(tls_context=self.server_context, implicit_tls=implicit_tls) as sink:
+            smtp = SMTP('localhost', sink.port, ssl=implicit_tls, tls=not implicit_tls,
+                        tls_version=ssl.PROTOCOL_TLS_CLIENT,
+                        tls_context_handler=lambda context: context.load_verify_locations(cert))
+            smtp.tls_sessions = TLSSessionCache()
+            for i in range(3):
+                with smtp.clone() as session:
+                    session.send(Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                                       subject='Test: test_tls_resumption', text='Simple text only body'))
+            self.assertEqual(sink.stats['messages'], 3)
+            self.assertEqual(sink.stats['tls_resumed'], 2)
+        self.assertEqual(smtp.tls_sessions.stats['handshakes'], 3)
+        self.assertEqual(smtp.tls_sessions.stats['resumed'], 2)
+
+    def test_starttls_resumption(self):
+        self.send(implicit_tls=False)
+
+    def test_ssl_resumption(self):
+        self.send(implicit_tls=True)
+
+
+class TestFileTransport(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def get_emails(self, count):
+        return [Email(sender=TEST_CONFIG['FROM'], recipients=['a@example.com', 'b@example.com'],
+                      subject='Test: file transport {0}'.format(i), text='From the start\nline') for i in range(count)]
+
+    def test_eml_batches(self):
+        pickup = os.path.join(self.path, 'pickup')
+        transport = FileTransport(pickup, fsync_every=2, envelope_headers=True)
+        results = transport.send_many(self.get_emails(3))
+        self.assertEqual(sorted(results[0]), ['a@example.com', 'b@example.com'])
+        self.assertEqual(results[0]['a@example.com'][0], 250)
+        # written in a batch of two and one of the rest, before the results are returned
+        names = sorted(name for name in os.listdir(pickup) if name.endswith('.eml'))
+        self.assertEqual(len(names), 3)
+        self.assertEqual(transport.stats['flushes'], 2)
+        transport.send(self.get_emails(1)[0])
+        self.assertEqual(len([name for name in os.listdir(pickup) if name.endswith('.eml')]), 4)
+        transport.close()
+        self.assertEqual(os.listdir(os.path.join(pickup, 'tmp')), [])
+        with open(os.path.join(pickup, names[0]), 'rb') as eml:
+            data = eml.read()
+        self.assertTrue(data.startswith(b'X-Sender: <' + TEST_CONFIG['FROM'].encode('ascii') + b'>\r\n'))
+        self.assertEqual(data.count(b'\n'), data.count(b'\r\n'))
+        self.assertEqual(transport.stats['flushes'], 3)
+
+    def test_spool_to_pickup(self):
+        pickup = os.path.join(self.path, 'pickup')
+        spool = Spool(os.path.join(self.path, 'spool'))
+        for email in self.get_emails(2):
+            spool.add(email)
+        transport = FileTransport(pickup, fsync=False)
+        self.assertEqual(spool.process(transport), {'sent': 2, 'deferred': 0, 'bounced': 0})
+        names = [name for name in os.listdir(pickup) if name.endswith('.eml')]
+        self.assertEqual(len(names), 2)
+        self.assertTrue(transport.last_name in names)
+        # delivered messages are done: nothing is written again on the next run
+        self.assertEqual(spool.process(transport), {'sent': 0, 'deferred': 0, 'bounced': 0})
+        self.assertEqual(len([name for name in os.listdir(pickup) if name.endswith('.eml')]), 2)
+        spool.close()
+
+    def test_mbox_and_maildir(self):
+        import mailbox
+        mbox_path = os.path.join(self.path, 'archive.mbox')
+        with FileTransport(mbox_path, format='mbox') as transport:
+            for email in self.get_emails(3):
+                transport.send(email)
+        mbox = mailbox.mbox(mbox_path, create=False)
+        subjects = [six.text_type(make_header(decode_header(message['Subject']))) for message in mbox]
+        mbox.close()
+        self.assertEqual(subjects,
+                         ['Test: file transport {0}'.format(i) for i in range(3)])
+        with FileTransport(os.path.join(self.path, 'Maildir'), format='maildir', fsync=False) as transport:
+            transport.send_many(self.get_emails(2))
+        maildir = mailbox.Maildir(os.path.join(self.path, 'Maildir'), create=False)
+        self.assertEqual(sorted(six.text_type(make_header(decode_header(message['Subject']))) for message in maildir),
+                         ['Test: file transport 0', 'Test: file transport 1'])
+
+
+@unittest.skipIf(cryptography is None, 'DKIM signing requires the cryptography package')
+class TestDKIM(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(BASE_DIR, 'tests', 'dkim.pem')) as key_file:
+            self.signer = DKIMSigner('example.com', 'test', key_file.read())
+
+    def test_body_hash(self):
+        # RFC 6376 3.4.3 and 3.4.4: the hashes of an empty body
+        self.assertEqual(self.signer.get_body_hash(b''), b'47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=')
+        simple = DKIMSigner('example.com', 'test', self.signer.private_key, canonicalization='simple/simple')
+        self.assertEqual(simple.get_body_hash(b'\r\n\r\n'), b'frcCV1k9oG9oKj3dpUqdJg1PxRT2RSN/XKdLCPjaYaY=')
+        body = b'Hello  \t world \r\nline\r\n\r\n\r\n'
+        expected = self.signer.get_body_hash(b'Hello world\r\nline\r\n')
+        self.assertEqual(self.signer.get_body_hash(body), expected)
+        # the same body read in chunks, split mid line
+        self.assertEqual(self.signer.get_body_hash([body[:4], body[4:15], body[15:]]), expected)
+        self.assertEqual(self.signer.get_body_hash(body), expected)
+        self.assertEqual(self.signer.stats['hits'], 1)
+
+    def test_sign_email(self):
+        email = Email(sender=TEST_CONFIG['FROM'], recipients=['a@example.com'], subject='Test: dkim',
+                      text='Simple text only body', html='<b>html</b>')
+        email.dkim_signer = self.signer
+        for recipient in ('b@example.com', 'c@example.com'):
+            email.recipients = [recipient]
+            payload = email.get_payload_bytes()
+        self.assertTrue(payload.startswith(b'DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=test;'))
+        self.assertEqual(self.signer.stats, {'signed': 2, 'hits': 1, 'misses': 1})
+        field = re.match(b'DKIM-Signature: (.*?)\r\n(?![ \t])', payload, re.S).group(1)
+        tags = dict(tag.split(b'=', 1) for tag in re.sub(b'\\s+', b'', field).split(b';'))
+        self.assertTrue(tags[b'h'].startswith(b'from:subject:date:message-id:to:'))
+        # the signature decrypts to a PKCS #1 v1.5 SHA-256 DigestInfo
+        from cryptography.hazmat.primitives.asymmetric import padding
+        info = self.signer.key.public_key().recover_data_from_signature(
+            base64.b64decode(tags[b'b']), padding.PKCS1v15(), None)
+        self.assertTrue(info.startswith(binascii.unhexlify('3031300d060960864801650304020105000420')))
+
+    def test_sign_multipart_emails(self):
+        # separate emails with the same parts get the same boundaries, so the same body hash
+        emails = [Email(sender=TEST_CONFIG['FROM'], recipients=[recipient], subject='Test: dkim',
+                        text='Simple text body', html='<b>html</b>',
+                        attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')])
+                  for recipient in ('a@example.com', 'b@example.com', 'c@example.com')]
+        bodies = set()
+        for email in emails:
+            email.dkim_signer = self.signer
+            bodies.add(email.get_payload_bytes().split(b'\r\n\r\n', 1)[1])
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(self.signer.stats, {'signed': 3, 'hits': 2, 'misses': 1})
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.clock = lambda: self.now[0]
+
+    def sleep(self, seconds):
+        self.now[0] += seconds
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, clock=self.clock)
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertEqual(bucket.take(), 0.5)
+        self.assertEqual(bucket.acquire(1, self.sleep), 0.5)
+        # larger than the capacity: granted once the bucket is full, leaving it in debt
+        self.assertEqual(bucket.acquire(5, self.sleep), 1.0)
+        self.assertEqual(bucket.tokens, -3)
+
+    def test_adaptive_limits(self):
+        limiter = RateLimiter(messages_per_second=10, recipients_per_minute=600, max_concurrency=8,
+                              cooldown=1, clock=self.clock, sleep=self.sleep)
+        limiter.acquire(2)
+        limiter.release({'a@example.com': (250, b'OK'), 'b@example.com': (451, b'4.7.0 Slow down')})
+        state = limiter.get_state()
+        self.assertEqual((state['concurrency'], state['rate_factor'], state['cuts']), (4, 0.5, 1))
+        self.assertEqual(state['rates'], {'messages': 5.0, 'recipients': 5.0})
+        # a dropped connection within the cooldown does not cut again
+        limiter.acquire()
+        limiter.release(error=smtplib.SMTPServerDisconnected('Connection unexpectedly closed'))
+        self.assertEqual(limiter.get_state()['cuts'], 1)
+        self.assertEqual(limiter.get_state()['throttled'], 2)
+        for _ in range(40):
+            limiter.acquire()
+            limiter.release({})
+        state = limiter.get_state()
+        self.assertEqual((state['concurrency'], state['rate_factor'], state['in_flight']), (8, 1.0, 0))
+        self.assertFalse(limiter.is_throttled(error=smtplib.SMTPDataError(554, b'5.7.1 Rejected')))
+
+
+@unittest.skipIf(six.PY2, 'templates require Python 3')
+class TestEmailTemplate(unittest.TestCase):
+    def normalise(self, payload):
+        payload = re.sub(r'={15}\d+==', 'BOUNDARY', payload)
+        return re.sub(r'(Date|Message-ID): .*', '', payload)
+
+    def test_render_matches_email(self):
+        from strudelpy import EmailTemplate
+        template = EmailTemplate(sender=TEST_CONFIG['FROM'], subject='Hello $name',
+                                 text='Simple text body for $name', html='<b>HTML עברית $name</b>',
+                                 attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')],
+                                 embedded=[os.path.join(BASE_DIR, 'tests', 'cat.jpg')])
+        for name, address in TEST_CONFIG['RECIPIENT_PAIRS']:
+            rendered = template.render([(name, address)], name=name)
+            email = Email(sender=TEST_CONFIG['FROM'], recipients=[(name, address)],
+                          subject='Hello %s' % name, text='Simple text body for %s' % name,
+                          html='<b>HTML עברית %s</b>' % name,
+                          attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')],
+                          embedded=[os.path.join(BASE_DIR, 'tests', 'cat.jpg')])
+            self.assertEqual(self.normalise(rendered.get_payload()), self.normalise(email.get_payload()))
+            self.assertEqual(rendered.get_envelope_recipients(), [address])
+
+    def test_render_missing_placeholder(self):
+        from strudelpy import EmailTemplate
+        template = EmailTemplate(sender=TEST_CONFIG['FROM'], subject='Hello $name', text='Body')
+        self.assertRaises(KeyError, template.render, TEST_CONFIG['RECIPIENTS'])
+
+    def test_render_non_ascii_attachment(self):
+        from email import message_from_bytes
+        from strudelpy import EmailTemplate
+        path = os.path.join(tempfile.mkdtemp(), 'note.txt')
+        with open(path, 'wb') as note:
+            note.write(u'Grüße, שלום\n'.encode('utf-8'))
+        template = EmailTemplate(sender=TEST_CONFIG['FROM'], subject='Hello $name', text='Body for $name',
+                                 attachments=[path])
+        rendered = template.render(TEST_CONFIG['RECIPIENTS'], name='you')
+        payload = rendered.get_payload_bytes()
+        shutil.rmtree(os.path.dirname(path))
+        attachment = [part for part in message_from_bytes(payload).walk() if part.get_filename()][0]
+        self.assertEqual(attachment.get_payload(decode=True), u'Grüße, שלום\n'.encode('utf-8'))
+
+    def test_stream_and_compact_rendered(self):
+        from strudelpy import EmailTemplate
+        template = EmailTemplate(sender=TEST_CONFIG['FROM'], subject='Hello $name', text='Body for $name',
+                                 attachments=[os.path.join(BASE_DIR, 'tests', 'doctest.doc')])
+        rendered = template.render(TEST_CONFIG['RECIPIENTS'], name='you')
+        payload = rendered.get_payload_bytes()
+        self.assertEqual(payload.count(b'\n'), payload.count(b'\r\n'))
+        self.assertEqual(rendered.estimate_size(), len(payload))
+        self.assertTrue(b'Body for you' in base64.b64decode(payload.split(b'base64\r\n\r\n')[1].split(b'\r\n')[0]))
+        self.assertEqual(rendered.get_payload_stream().read(), payload)
+        self.assertEqual(rendered.compact(release=False).get_payload_bytes(), payload)
+        self.assertEqual(rendered.compile_message()['Subject'], '=?utf-8?q?Hello_you?=')
+
+    def test_send_rendered(self):
+        from strudelpy import EmailTemplate
+        template = EmailTemplate(sender=TEST_CONFIG['FROM'], subject='Test: test_send_rendered $name',
+                                 text='Simple text body for $name')
+        smtp = SMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                    username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                    ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'])
+        with smtp:
+            for name, address in TEST_CONFIG['RECIPIENT_PAIRS']:
+                self.assertEqual(smtp.send(template.render([(name, address)], name=name)), {})
+
+
+@unittest.skipIf(six.PY2, 'the dispatcher requires Python 3')
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.smtp = SMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                         username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                         ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'])
+
+    def get_emails(self, count):
+        return [Email(sender=TEST_CONFIG['FROM'],
+                      recipients=TEST_CONFIG['RECIPIENTS'],
+                      subject='Test: test_dispatcher %d' % i,
+                      text='Simple text only body') for i in range(count)]
+
+    def test_dispatch(self):
+        from strudelpy import Dispatcher
+        with Dispatcher(self.smtp, workers=3, queue_size=2, max_connections_per_host=2) as dispatcher:
+            futures = [dispatcher.submit(email) for email in self.get_emails(6)]
+            self.assertEqual([future.result() for future in futures], [{}] * 6)
+
+    def test_dispatch_compile_processes(self):
+        from strudelpy import Dispatcher
+        with Dispatcher(self.smtp, workers=2, compile_processes=2) as dispatcher:
+            futures = [dispatcher.submit(email) for email in self.get_emails(4)]
+            self.assertEqual([future.result() for future in futures], [{}] * 4)
+
+    def test_backpressure(self):
+        from six.moves import queue
+        from strudelpy import Dispatcher
+        dispatcher = Dispatcher(self.smtp, workers=0, queue_size=1)
+        emails = self.get_emails(2)
+        future = dispatcher.submit(emails[0])
+        self.assertRaises(queue.Full, dispatcher.submit, emails[1], block=False)
+        self.assertRaises(queue.Full, dispatcher.submit, emails[1], timeout=0.1)
+        future.cancel()
+        dispatcher.close()
+
+    @unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+    def test_login_failure(self):
+        from strudelpy import Dispatcher
+        from strudelpy.tests.sink import SMTPSink
+        failing = [True]
+        replies = {'AUTH': lambda argument: (535, '5.7.8 Authentication failed') if failing[0] else None}
+        emails = self.get_emails(2)
+        with SMTPSink(replies=replies) as sink:
+            smtp = SMTP(sink.host, sink.port, username='user', password='secret')
+            with Dispatcher(smtp, workers=1) as dispatcher:
+                self.assertRaises(smtplib.SMTPAuthenticationError, dispatcher.submit(emails[0]).result)
+                failing[0] = False
+                self.assertEqual(dispatcher.submit(emails[1]).result(), {})
+            # the session which failed to log in was dropped and the next job logged in again
+            self.assertEqual(sink.stats['connections'], 2)
+            self.assertEqual(sink.stats['messages'], 1)
+
+    @unittest.skipIf(six.PY2, 'the SMTP sink requires Python 3')
+    def test_refusal_is_not_retried(self):
+        from strudelpy import Dispatcher
+        from strudelpy.tests.sink import SMTPSink
+        with SMTPSink(replies={'DATA': (554, '5.7.1 Message rejected')}) as sink:
+            with Dispatcher(SMTP(sink.host, sink.port), workers=1) as dispatcher:
+                self.assertRaises(smtplib.SMTPDataError, dispatcher.submit(self.get_emails(1)[0]).result)
+            self.assertEqual((sink.stats['connections'], sink.stats['commands']['DATA']), (1, 1))
+
+
+@unittest.skipIf(six.PY2, 'asyncio transport requires Python 3')
+class TestAsyncSMTP(unittest.TestCase):
+    def get_smtp(self, **kwargs):
+        from strudelpy import AsyncSMTP
+        return AsyncSMTP(host=TEST_CONFIG['SMTP_HOST'], port=TEST_CONFIG['SMTP_PORT'],
+                         username=TEST_CONFIG['SMTP_USER'], password=TEST_CONFIG['SMTP_PASS'],
+                         ssl=TEST_CONFIG['SSL'], tls=TEST_CONFIG['TLS'], **kwargs)
+
+    def run_async(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_async_send(self):
+        async def send():
+            async with self.get_smtp() as smtp:
+                return await smtp.send(Email(sender=TEST_CONFIG['FROM'],
+                                             recipients=TEST_CONFIG['RECIPIENTS'],
+                                             subject='Test: test_async_send',
+                                             text='Simple text only body'))
+        self.assertEqual(self.run_async(send()), {})
+
+    def test_async_concurrent_sends(self):
+        import asyncio
+
+        async def send():
+            async with self.get_smtp(max_connections=3) as smtp:
+                responses = await asyncio.gather(*[
+                    smtp.send(Email(sender=TEST_CONFIG['FROM'],
+                                    recipients=TEST_CONFIG['RECIPIENTS'],
+                                    subject='Test: test_async_concurrent_sends %d' % i,
+                                    text='Simple text only body'))
+                    for i in range(6)
+                ])
+                return responses, smtp._open
+        responses, connections = self.run_async(send())
+        self.assertEqual(responses, [{}] * 6)
+        self.assertEqual(connections, 3)
+
+    def test_async_cancelled_send(self):
+        import asyncio
+        from strudelpy import AsyncSMTP
+        from strudelpy.tests.sink import SMTPSink
+
+        async def send(sink):
+            async with AsyncSMTP(sink.host, sink.port, max_connections=1) as smtp:
+                email = Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                              subject='Test: test_async_cancelled_send', text='Simple text only body')
+                task = asyncio.ensure_future(smtp.send(email))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                # the interrupted session is dropped rather than handed to the next send
+                return await asyncio.wait_for(smtp.send(email), 5)
+        with SMTPSink(latency=0.1) as sink:
+            self.assertEqual(self.run_async(send(sink)), {})
+            self.assertEqual(sink.stats['connections'], 2)
+            self.assertEqual(sink.stats['messages'], 1)
+
+    def test_async_login_without_auth(self):
+        from strudelpy import AsyncSMTP
+        from strudelpy.tests.sink import SMTPSink
+
+        async def send(sink):
+            async with AsyncSMTP(sink.host, sink.port, username='user', password='secret') as smtp:
+                return await smtp.send(Email(sender=TEST_CONFIG['FROM'], recipients=TEST_CONFIG['RECIPIENTS'],
+                                             subject='Test: test_async_login_without_auth',
+                                             text='Simple text only body'))
+        with SMTPSink(auth=False, replies={'AUTH': (502, '5.5.1 Unrecognized command')}) as sink:
+            self.assertEqual(self.run_async(send(sink)), {})
+        with SMTPSink(auth=False, replies={'AUTH': (535, '5.7.8 Authentication failed')}) as sink:
+            self.assertRaises(smtplib.SMTPAuthenticationError, self.run_async, send(sink))
+            self.assertEqual(sink.stats['messages'], 0)
 
 
 if __name__ == '__main__':
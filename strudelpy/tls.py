@@ -0,0 +1,125 @@
+"""
+TLS helpers: SSLContext creation and a cache of TLS sessions, so reconnecting to a host
+resumes the previous session instead of running a full handshake.
+"""
+
+import threading
+from collections import OrderedDict
+
+__all__ = ['TLSSessionCache', 'create_tls_context', 'default_tls_session_cache']
+
+
+def create_tls_context(tls_version=None, tls_context_handler=None):
+    """
+    Build the SSLContext used for STARTTLS.
+    :param tls_version: ssl.PROTOCOL_* constant. If not set, the default context is used
+    :param tls_context_handler: optional function receiving the SSLContext to configure it
+    :return: ssl.SSLContext
+    """
+    import ssl
+    if tls_version:
+        context = ssl.SSLContext(tls_version)
+        if tls_context_handler:
+            tls_context_handler(context)
+    else:
+        context = ssl.create_default_context()
+    return context
+
+
+class ResumingContext(object):
+    """
+    Wraps an SSLContext so sockets it wraps resume the cached session of a host, and new
+    sessions are stored in the cache. Everything else is delegated to the context.
+    """
+    def __init__(self, context, cache, key):
+        self.context = context
+        self.cache = cache
+        self.key = key
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        session = self.cache.get(self.key)
+        if session is not None:
+            kwargs['session'] = session
+        wrapped = self.context.wrap_socket(sock, *args, **kwargs)
+        self.cache.record_handshake(self.key, wrapped)
+        return wrapped
+
+    def store(self, sock):
+        """
+        Keep the session of a socket wrapped by this context. TLS 1.3 servers send their
+        session tickets after the handshake, so this is worth calling once the server has
+        replied to a command.
+        """
+        self.cache.store(self.key, sock)
+
+
+class TLSSessionCache(object):
+    """
+    An LRU cache of client TLS sessions keyed by SSLContext and (host, port), with handshake
+    counters. Sessions can only be resumed with the SSLContext they were created by.
+    """
+    def __init__(self, max_sessions=256):
+        """
+        :param max_sessions: maximum number of hosts to keep a session for
+        """
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'handshakes': 0,
+            'resumed': 0,
+            'sessions': 0,
+        }
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        """
+        :return: the ssl.SSLSession stored for key, or None
+        """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                self._sessions[key] = session
+            return session
+
+    def store(self, key, sock):
+        """
+        Keep the session of a TLS socket for the next connection
+        """
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            self.stats['sessions'] = len(self._sessions)
+
+    def record_handshake(self, key, sock):
+        with self._lock:
+            self.stats['handshakes'] += 1
+            if getattr(sock, 'session_reused', False):
+                self.stats['resumed'] += 1
+        self.store(key, sock)
+
+    def wrap(self, context, address):
+        """
+        :param context: the ssl.SSLContext to wrap
+        :param address: (host, port) the context will connect to
+        :return: a context to give smtplib in place of `context`, resuming sessions with address
+        """
+        return ResumingContext(context, self, (context,) + tuple(address))
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self.stats['sessions'] = 0
+
+
+default_tls_session_cache = TLSSessionCache()